@@ -0,0 +1,11 @@
+"""
+Load testing harness for j2lsnek
+
+Simulates JJ2 game servers listing themselves on port 10054, clients fetching lists and statistics from ports 10053,
+10055, 10057 and 10058, and ServerNet mirrors sending updates to port 10056, and reports throughput, latency and
+resource usage of the list server as JSON, so results for different versions can be compared.
+
+Run with `python3 -m bench --help` from the repository root. Simulated servers and mirrors connect from addresses in
+127.0.0.0/8 other than 127.0.0.1 (so the per-IP limits of the list server don't get in the way), which works out of the
+box on Linux but may need aliases for the loopback interface elsewhere.
+"""
@@ -0,0 +1,239 @@
+"""
+Run a j2lsnek load test, or compare the results of two load tests
+
+Examples:
+  python3 -m bench run --launch --servers 50 --clients 20 --mirrors 3 --duration 60 --output results.json
+  python3 -m bench run --host 127.0.0.1 --pid 1234 --clients 50
+  python3 -m bench compare before.json after.json
+"""
+import subprocess
+import argparse
+import tempfile
+import datetime
+import pathlib
+import sqlite3
+import socket
+import shutil
+import json
+import time
+import sys
+
+from bench import metrics, simulators
+
+
+def launch(target, directory, mirrors):
+    """
+    Start a list server to benchmark
+
+    The list server runs in its own directory, so it gets a fresh database; the addresses the fake mirrors connect
+    from are added to the mirrors table beforehand.
+
+    :param target: Path to j2lsnek.py
+    :param directory: Directory to run in
+    :param mirrors: List of addresses to register as mirrors
+    :return: subprocess.Popen object
+    """
+    dbconn = sqlite3.connect(str(pathlib.Path(directory).joinpath("servers.db")))
+    dbconn.execute("CREATE TABLE mirrors (name TEXT, address TEXT, lifesign INTEGER DEFAULT 0)")
+    dbconn.executemany("INSERT INTO mirrors (name, address) VALUES (?, ?)",
+                       [("bench-mirror-%i" % i, address) for i, address in enumerate(mirrors)])
+    dbconn.commit()
+    dbconn.close()
+
+    process = subprocess.Popen([sys.executable, str(target)], cwd=directory, stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    return process
+
+
+def wait_for(host, port, timeout=60):
+    """
+    Wait until something is listening at a port
+
+    :param host: Host
+    :param port: Port
+    :param timeout: Seconds to wait at most
+    :return: Seconds it took, or None if it timed out
+    """
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return time.time() - start
+        except OSError:
+            time.sleep(0.05)
+
+    return None
+
+
+def run(args):
+    """
+    Run load test
+
+    :param args: Parsed command line arguments
+    :return: Results, dictionary
+    """
+    process = None
+    directory = None
+    database = args.database
+    pid = args.pid
+
+    mirror_addresses = [simulators.source_address(2, i) for i in range(0, args.mirrors)]
+
+    if args.launch:
+        directory = tempfile.mkdtemp(prefix="j2lsnek-bench-")
+        process = launch(args.target, directory, mirror_addresses)
+        pid = process.pid
+        database = str(pathlib.Path(directory).joinpath("servers.db"))
+        startup = wait_for(args.host, 10057)
+        if startup is None:
+            process.kill()
+            raise RuntimeError("List server did not start listening within a minute")
+    else:
+        startup = None
+
+    admin = None
+    if args.certfile and args.keyfile:
+        admin = lambda: metrics.admin_request(args.host, "get-stats", args.certfile, args.keyfile)
+
+    recorder = metrics.recorder()
+    entities = []
+    entities += [simulators.game_server(args.host, recorder, i, args.update_interval, args.lifetime)
+                 for i in range(0, args.servers)]
+    entities += [simulators.list_client(args.host, recorder, i, args.client_interval) for i in range(0, args.clients)]
+    entities += [simulators.fake_mirror(args.host, recorder, i, args.mirror_interval, args.mirror_servers)
+                 for i in range(0, args.mirrors)]
+
+    samplers = []
+    if pid:
+        samplers.append(metrics.process_sampler(pid))
+    if database:
+        samplers.append(metrics.database_prober(database))
+
+    before = admin() if admin else None
+
+    for sampler in samplers:
+        sampler.start()
+
+    start = time.time()
+    for entity in entities:
+        entity.start()
+        time.sleep(args.ramp_up / max(1, len(entities)))
+
+    time.sleep(max(0, args.duration - (time.time() - start)))
+    duration = time.time() - start
+
+    for entity in entities:
+        entity.halt()
+    for entity in entities:
+        entity.join(timeout=15)
+
+    after = admin() if admin else None
+
+    for sampler in samplers:
+        sampler.halt()
+
+    results = {
+        "label": args.label,
+        "target": str(args.target) if args.launch else args.host,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "duration": round(duration, 2),
+        "startup": round(startup, 3) if startup is not None else None,
+        "simulated": {"servers": args.servers, "clients": args.clients, "mirrors": args.mirrors},
+        "ports": recorder.summary(duration),
+        "process": None,
+        "database_probe": None,
+        "database_lock": None
+    }
+
+    for sampler in samplers:
+        if isinstance(sampler, metrics.process_sampler):
+            results["process"] = sampler.summary()
+        else:
+            results["database_probe"] = sampler.summary()
+
+    if before and after:
+        acquired = after["database-lock"]["acquired"] - before["database-lock"]["acquired"]
+        waited = after["database-lock"]["waited"] - before["database-lock"]["waited"]
+        results["database_lock"] = {"acquired": acquired, "waited": round(waited, 4),
+                                    "mean": round(waited / acquired * 1000, 3) if acquired else None,
+                                    "max": round(after["database-lock"]["max"] * 1000, 2),
+                                    "threads": after["threads"]}
+
+    if process:
+        try:
+            process.stdin.write(b"q\n")
+            process.stdin.flush()
+            process.wait(timeout=60)
+        except (OSError, subprocess.TimeoutExpired):
+            process.kill()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def compare(args):
+    """
+    Compare two result files
+
+    :param args: Parsed command line arguments
+    :return: Nothing
+    """
+    with open(args.before) as input:
+        before = json.load(input)
+    with open(args.after) as input:
+        after = json.load(input)
+
+    print("%-16s %14s %14s %14s %14s" % ("port", "req/s before", "req/s after", "p99 before", "p99 after"))
+    for port in sorted(set(before["ports"]) | set(after["ports"])):
+        old = before["ports"].get(port, {})
+        new = after["ports"].get(port, {})
+        print("%-16s %14s %14s %14s %14s" % (port, old.get("throughput"), new.get("throughput"), old.get("p99"),
+                                            new.get("p99")))
+
+    for section in ("process", "database_probe", "database_lock"):
+        print("%s: %s -> %s" % (section, json.dumps(before.get(section)), json.dumps(after.get(section))))
+
+
+parser = argparse.ArgumentParser(prog="python3 -m bench", description="j2lsnek load testing harness")
+commands = parser.add_subparsers(dest="command")
+
+runner = commands.add_parser("run", help="Run a load test")
+runner.add_argument("--host", default="127.0.0.1", help="List server to test")
+runner.add_argument("--launch", action="store_true", help="Start a fresh list server to test, in a temporary folder")
+runner.add_argument("--target", default=pathlib.Path(__file__).parent.parent.joinpath("j2lsnek.py"), type=pathlib.Path,
+                    help="j2lsnek.py to launch, defaults to the one in this repository")
+runner.add_argument("--pid", type=int, help="Process ID of list server, to sample thread count and memory usage")
+runner.add_argument("--database", help="Path to list server database, to probe for lock contention")
+runner.add_argument("--certfile", help="Client certificate for admin API, to retrieve lock wait statistics")
+runner.add_argument("--keyfile", help="Client certificate key for admin API")
+runner.add_argument("--servers", type=int, default=20, help="Amount of simulated game servers")
+runner.add_argument("--clients", type=int, default=10, help="Amount of simulated list clients")
+runner.add_argument("--mirrors", type=int, default=0, help="Amount of simulated ServerNet mirrors")
+runner.add_argument("--mirror-servers", type=int, default=20, help="Amount of servers per simulated mirror")
+runner.add_argument("--duration", type=float, default=30, help="Duration of test, in seconds")
+runner.add_argument("--ramp-up", type=float, default=2, help="Seconds over which to start simulated entities")
+runner.add_argument("--update-interval", type=float, default=1.0, help="Seconds between game server updates")
+runner.add_argument("--lifetime", type=float, default=20.0, help="Seconds after which game servers relist")
+runner.add_argument("--client-interval", type=float, default=0.0, help="Seconds between client requests")
+runner.add_argument("--mirror-interval", type=float, default=1.0, help="Seconds between mirror messages")
+runner.add_argument("--label", default="", help="Label to include in results, e.g. a version number")
+runner.add_argument("--output", help="File to write JSON results to, instead of stdout")
+
+comparer = commands.add_parser("compare", help="Compare two result files")
+comparer.add_argument("before", help="Earlier results")
+comparer.add_argument("after", help="Later results")
+
+args = parser.parse_args()
+
+if args.command == "run":
+    results = run(args)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+elif args.command == "compare":
+    compare(args)
+else:
+    parser.print_help()
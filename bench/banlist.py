@@ -0,0 +1,142 @@
+"""
+Benchmark banlist imports and connection checks with big banlists
+
+Run with `python3 -m bench.banlist` from the repository root. For each banlist size, generates a CSV blocklist (mostly
+plain addresses, some masks with wildcards, a few whitelist entries with reserved names), and times what an
+import-banlist call does with it: parsing, adding it to a database in one transaction, and rebuilding the ban index.
+It then times the checks done for every connection and server listing against that index, for addresses that are and
+are not banned. Exits with a non-zero status if the index disagrees with a plain fnmatch check of the same entries.
+"""
+import argparse
+import tempfile
+import fnmatch
+import logging
+import pathlib
+import sqlite3
+import random
+import types
+import time
+import sys
+
+from helpers import banlist, schema
+
+
+def blocklist(size, rng):
+    """
+    Generate a blocklist
+
+    :param size: Amount of entries
+    :param rng: random.Random instance
+    :return: CSV file contents
+    """
+    lines = ["address,type,note,reserved"]
+    for i in range(0, size):
+        if i % 100 == 0:
+            lines.append("10.%i.*,ban,range," % rng.randint(0, 255))
+        elif i % 1000 == 1:
+            lines.append("172.16.%i.%i,whitelist,,server%i" % (rng.randint(0, 255), rng.randint(0, 255), i))
+        else:
+            lines.append("%i.%i.%i.%i,ban,abuse report," % (rng.randint(11, 223), rng.randint(0, 255),
+                                                            rng.randint(0, 255), rng.randint(0, 255)))
+
+    return "\n".join(lines) + "\n"
+
+
+def percentiles(durations):
+    """
+    Summarise durations
+
+    :param durations: List of durations, in seconds
+    :return: String with median, 99th percentile and maximum in microseconds
+    """
+    durations = sorted(durations)
+    return "p50 %8.2f us  p99 %8.2f us  max %8.2f us" % (
+        durations[len(durations) // 2] * 1000000, durations[int(len(durations) * 0.99)] * 1000000,
+        durations[-1] * 1000000)
+
+
+def run(size, checks, rng, path):
+    """
+    Import a blocklist and time checks against it
+
+    :param size: Amount of banlist entries
+    :param checks: Amount of checks to time
+    :param rng: random.Random instance
+    :param path: Database file to use
+    :return: List of failure descriptions
+    """
+    failures = []
+    text = blocklist(size, rng)
+
+    dbconn = sqlite3.connect(path, isolation_level=None)
+    schema.migrate(dbconn, types.SimpleNamespace(log=logging.getLogger("banlist"), address="127.0.0.1"))
+
+    start = time.perf_counter()
+    entries, invalid = banlist.parse(text, "csv", "127.0.0.1")
+    parsed = time.perf_counter()
+
+    dbconn.execute("BEGIN")
+    dbconn.executemany("INSERT OR IGNORE INTO banlist (address, type, note, origin, reserved, updated) "
+                       "VALUES (?, ?, ?, ?, ?, ?)", [entry + (0,) for entry in entries])
+    dbconn.execute("COMMIT")
+    stored = time.perf_counter()
+
+    dbconn.row_factory = sqlite3.Row
+    rows = dbconn.execute("SELECT * FROM banlist").fetchall()
+    index = banlist.ban_index([], rows)
+    built = time.perf_counter()
+    dbconn.close()
+
+    print("%6i entries: parse %7.1f ms, store %7.1f ms, build index %7.1f ms (%i invalid)" % (
+        len(entries), (parsed - start) * 1000, (stored - parsed) * 1000, (built - stored) * 1000, invalid))
+
+    banned = [entry[0].replace("*", "1.1") for entry in entries if entry[1] == "ban"]
+    addresses = [rng.choice(banned) for i in range(0, checks // 2)] + \
+                ["%i.%i.%i.%i" % (rng.randint(11, 223), rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+                 for i in range(0, checks // 2)]
+    rng.shuffle(addresses)
+
+    durations = []
+    results = {}
+    for address in addresses:
+        start = time.perf_counter()
+        results[address] = index.banned(address)
+        durations.append(time.perf_counter() - start)
+    print("        banned(): %s" % percentiles(durations))
+
+    durations = []
+    for i in range(0, checks):
+        name = "server%i" % rng.randint(0, size)
+        start = time.perf_counter()
+        index.reserved(name, "192.0.2.1")
+        durations.append(time.perf_counter() - start)
+    print("      reserved(): %s" % percentiles(durations))
+
+    # compare with checking every entry with fnmatch, as the banlist used to be checked, for some of the addresses
+    masks = [entry[0] for entry in entries if entry[1] == "ban"]
+    for address in addresses[:20]:
+        expected = any([fnmatch.fnmatch(address, mask) for mask in masks])
+        if results[address] != expected:
+            failures.append("%s: index says %s, fnmatch says %s" % (address, results[address], expected))
+
+    return failures
+
+
+parser = argparse.ArgumentParser(prog="python3 -m bench.banlist", description="Benchmark big banlists")
+parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000], help="Banlist sizes to test")
+parser.add_argument("--checks", type=int, default=20000, help="Checks to time per banlist size")
+parser.add_argument("--seed", type=int, default=10054, help="Random seed")
+args = parser.parse_args()
+
+rng = random.Random(args.seed)
+failures = []
+
+with tempfile.TemporaryDirectory() as directory:
+    for size in args.sizes:
+        failures += run(size, args.checks, rng, str(pathlib.Path(directory).joinpath("banlist-%i.db" % size)))
+
+for failure in failures:
+    print("FAIL %s" % failure)
+print("%i failure(s)" % len(failures))
+
+sys.exit(1 if failures else 0)
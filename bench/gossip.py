@@ -0,0 +1,256 @@
+"""
+Simulate relaying ServerNet messages between mirrors
+
+Run with `python3 -m bench.gossip` from the repository root. Starts a process per simulated mirror, each listening at
+its own loopback address (127.0.0.10 and up), and sends messages to them from this process as a list server would:
+directly to every mirror, or via mirrors that pass them on (see SERVERNET_FANOUT and helpers.servernet.relay_plan()).
+Mirrors decode messages, drop duplicates and pass messages on with the same code the list server uses.
+
+For each amount of mirrors and fan-out, reports how long it took for a message to reach all mirrors, and how many bytes
+the origin and the busiest mirror sent per message. With --down, some mirrors are not started, to check that the
+mirrors they were to pass messages on to still get them. Exits with a non-zero status if any reachable mirror missed a
+message or got one twice.
+"""
+import multiprocessing
+import threading
+import argparse
+import socket
+import random
+import queue
+import time
+import sys
+
+from helpers import servernet
+
+
+def address(index):
+    """
+    Get the address of a simulated mirror
+
+    :param index: Mirror number
+    :return: Loopback address
+    """
+    return "127.0.0.%i" % (10 + index)
+
+
+class relayer:
+    """
+    Send messages as a list server would, keeping track of how much was sent
+    """
+
+    def __init__(self, port, fanout, name):
+        """
+        Set up relayer
+
+        :param port: Port mirrors listen at
+        :param fanout: Mirrors to send to directly at most, 0 for all
+        :param name: Address of this mirror
+        """
+        self.port = port
+        self.fanout = fanout
+        self.name = name
+        self.sent = 0
+        self.lock = threading.Lock()
+
+    def forward(self, payload, recipients):
+        """
+        Send a message to a list of mirrors, relaying it via some of them if a fan-out is set
+
+        :param payload: Message
+        :param recipients: Addresses to send to
+        :return: List of sending threads
+        """
+        recipients = [recipient for recipient in recipients if recipient != self.name]
+        random.shuffle(recipients)
+        message = servernet.encode_payload(payload, binary=True, compress=True)
+
+        threads = []
+        for recipient, relayed in servernet.relay_plan(recipients, self.fanout, recipients):
+            data = servernet.encode_relay(message, relayed) if relayed else message
+            thread = threading.Thread(target=self.send, args=(recipient, data, payload, relayed))
+            thread.start()
+            threads.append(thread)
+
+        return threads
+
+    def send(self, recipient, data, payload, relayed):
+        """
+        Send a message to one mirror
+
+        If the mirror can not be reached, the mirrors it was to pass the message on to are sent it instead.
+
+        :param recipient: Address
+        :param data: Encoded message
+        :param payload: Message, decoded
+        :param relayed: Addresses the recipient is to pass the message on to
+        :return: Nothing
+        """
+        try:
+            connection = socket.create_connection((recipient, self.port), timeout=5)
+            connection.sendall(data)
+            connection.close()
+            with self.lock:
+                self.sent += len(data)
+        except OSError:
+            if relayed:
+                for thread in self.forward(payload, relayed):
+                    thread.join()
+
+
+def mirror(index, port, fanout, results, stop):
+    """
+    Run a simulated mirror, until told to stop
+
+    :param index: Mirror number
+    :param port: Port to listen at
+    :param fanout: Mirrors to send to directly at most when passing messages on
+    :param results: Queue to report received messages and bytes sent to
+    :param stop: Event that is set when the simulation is over
+    :return: Nothing
+    """
+    name = address(index)
+    sender = relayer(port, fanout, name)
+    log = servernet.message_log()
+
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((name, port))
+    server.listen(64)
+    server.settimeout(0.2)
+    results.put(("ready", name))
+
+    def handle(connection):
+        buffer = bytearray()
+        while True:
+            data = connection.recv(65536)
+            if not data:
+                break
+            buffer.extend(data)
+        connection.close()
+
+        received = time.time()
+        payload = servernet.decode_message(buffer)
+        if log.seen(payload["origin"], payload["id"]):
+            results.put(("duplicate", name, payload["id"]))
+            return
+
+        results.put(("received", name, payload["id"], received))
+        if payload.get("relay"):
+            sender.forward(payload, payload["relay"])
+
+    while not stop.is_set():
+        try:
+            connection, client = server.accept()
+        except socket.timeout:
+            continue
+        threading.Thread(target=handle, args=(connection,), daemon=True).start()
+
+    server.close()
+    results.put(("sent", name, sender.sent))
+
+
+def simulate(mirrors, fanout, messages, port, down, rng):
+    """
+    Send messages to simulated mirrors and measure how they spread
+
+    :param mirrors: Amount of mirrors
+    :param fanout: Mirrors to send to directly at most, 0 for all
+    :param messages: Amount of messages to send
+    :param port: Port mirrors listen at
+    :param down: Amount of mirrors that are not started, i.e. unreachable
+    :param rng: random.Random instance
+    :return: List of failure descriptions
+    """
+    failures = []
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+
+    unreachable = set(rng.sample(range(0, mirrors), down))
+    processes = [multiprocessing.Process(target=mirror, args=(index, port, fanout, results, stop))
+                 for index in range(0, mirrors) if index not in unreachable]
+    for process in processes:
+        process.start()
+    for process in processes:
+        results.get(timeout=30)
+
+    origin = relayer(port, fanout, "origin")
+    everyone = [address(index) for index in range(0, mirrors)]
+    convergence = []
+    duplicates = 0
+    origin_sent = []
+
+    for number in range(0, messages):
+        data = [{"id": "10.0.0.%i:10052" % i, "players": rng.randint(0, 32), "lifesign": 1792390000 + number}
+                for i in range(0, 20)]
+        payload = {"action": "server", "data": data, "origin": "origin.example", "id": "1.%i" % number}
+
+        before = origin.sent
+        start = time.time()
+        origin.forward(payload, everyone)
+
+        received = {}
+        while len(received) < len(processes) and time.time() - start < 10:
+            try:
+                result = results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if result[0] == "received" and result[2] == payload["id"]:
+                received[result[1]] = result[3]
+            elif result[0] == "duplicate":
+                duplicates += 1
+
+        time.sleep(0.05)  # let the origin's sending threads finish counting
+        origin_sent.append(origin.sent - before)
+        if len(received) < len(processes):
+            failures.append("%i mirrors, fan-out %i: message %i reached %i of %i mirrors" % (
+                mirrors, fanout, number, len(received), len(processes)))
+        else:
+            convergence.append(max(received.values()) - start)
+
+    stop.set()
+    sent = {}
+    while len(sent) < len(processes):
+        result = results.get(timeout=30)
+        if result[0] == "sent":
+            sent[result[1]] = result[2]
+        elif result[0] == "duplicate":
+            duplicates += 1
+    for process in processes:
+        process.join()
+
+    if duplicates:
+        failures.append("%i mirrors, fan-out %i: %i duplicate(s) received" % (mirrors, fanout, duplicates))
+
+    convergence = sorted(convergence) or [0]
+    print("%7i %7i %5i %9.1f ms %9.1f ms %11i B %11i B %11i B" % (
+        mirrors, fanout, down, convergence[len(convergence) // 2] * 1000, convergence[-1] * 1000,
+        sum(origin_sent) // messages, max(sent.values() or [0]) // messages,
+        (sum(origin_sent) + sum(sent.values())) // messages))
+
+    return failures
+
+
+parser = argparse.ArgumentParser(prog="python3 -m bench.gossip", description="Simulate relaying ServerNet messages")
+parser.add_argument("--mirrors", type=int, nargs="+", default=[3, 10, 30], help="Amounts of mirrors to simulate")
+parser.add_argument("--fanouts", type=int, nargs="+", default=[0, 2, 4], help="Fan-outs to test; 0 sends directly")
+parser.add_argument("--messages", type=int, default=20, help="Messages to send per simulation")
+parser.add_argument("--down", type=int, default=0, help="Mirrors that are unreachable")
+parser.add_argument("--port", type=int, default=10156, help="Port simulated mirrors listen at")
+parser.add_argument("--seed", type=int, default=10056, help="Random seed")
+args = parser.parse_args()
+
+rng = random.Random(args.seed)
+random.seed(args.seed)
+failures = []
+
+print("%7s %7s %5s %12s %12s %13s %13s %13s" % ("mirrors", "fan-out", "down", "p50 spread", "max spread",
+                                                  "origin/msg", "busiest/msg", "total/msg"))
+for mirrors in args.mirrors:
+    for fanout in args.fanouts:
+        failures += simulate(mirrors, fanout, args.messages, args.port, min(args.down, mirrors - 1), rng)
+
+for failure in failures:
+    print("FAIL %s" % failure)
+print("%i failure(s)" % len(failures))
+
+sys.exit(1 if failures else 0)
@@ -0,0 +1,252 @@
+import threading
+import sqlite3
+import socket
+import json
+import math
+import time
+import ssl
+
+
+class recorder:
+    """
+    Thread-safe collection of latency samples and errors, per port
+    """
+
+    def __init__(self):
+        """
+        Set up recorder
+        """
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.bytes = {}
+
+    def add(self, port, latency, size=0):
+        """
+        Record a successful request
+
+        :param port: Port the request was made to
+        :param latency: Time it took, in seconds
+        :param size: Amount of bytes received
+        :return: Nothing
+        """
+        with self.lock:
+            self.samples.setdefault(port, []).append(latency)
+            self.bytes[port] = self.bytes.get(port, 0) + size
+
+    def error(self, port, reason):
+        """
+        Record a failed request
+
+        :param port: Port the request was made to
+        :param reason: Short description of what went wrong
+        :return: Nothing
+        """
+        with self.lock:
+            errors = self.errors.setdefault(port, {})
+            errors[reason] = errors.get(reason, 0) + 1
+
+    def summary(self, duration):
+        """
+        Summarise recorded requests
+
+        :param duration: Duration of the benchmark, in seconds, to calculate throughput with
+        :return: Dictionary with results per port
+        """
+        with self.lock:
+            ports = set(self.samples) | set(self.errors)
+            result = {}
+            for port in sorted(ports, key=str):
+                samples = sorted(self.samples.get(port, []))
+                result[str(port)] = {
+                    "requests": len(samples),
+                    "errors": self.errors.get(port, {}),
+                    "throughput": round(len(samples) / duration, 2) if duration else 0,
+                    "bytes": self.bytes.get(port, 0),
+                    "p50": percentile(samples, 50),
+                    "p99": percentile(samples, 99),
+                    "max": round(samples[-1] * 1000, 2) if samples else None
+                }
+
+        return result
+
+
+def percentile(samples, percent):
+    """
+    Get percentile of sorted samples
+
+    :param samples: Sorted list of latencies, in seconds
+    :param percent: Percentile to get, e.g. 99
+    :return: Percentile in milliseconds, or None if there are no samples
+    """
+    if not samples:
+        return None
+
+    index = max(0, int(math.ceil(len(samples) * percent / 100)) - 1)
+    return round(samples[index] * 1000, 2)
+
+
+class process_sampler(threading.Thread):
+    """
+    Periodically sample thread count and memory usage of the list server process
+
+    Reads /proc, so this only works on Linux; elsewhere nothing is sampled.
+    """
+    looping = True
+
+    def __init__(self, pid, interval=1.0):
+        """
+        Set up sampler
+
+        :param pid: Process ID of list server
+        :param interval: Seconds between samples
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.threads = []
+        self.rss = []
+
+    def run(self):
+        """
+        Sample until halted
+
+        :return: Nothing
+        """
+        while self.looping:
+            try:
+                with open("/proc/%i/status" % self.pid) as status:
+                    for line in status:
+                        if line.startswith("Threads:"):
+                            self.threads.append(int(line.split()[1]))
+                        elif line.startswith("VmRSS:"):
+                            self.rss.append(int(line.split()[1]) * 1024)
+            except (OSError, ValueError, IndexError):
+                pass
+
+            time.sleep(self.interval)
+
+    def halt(self):
+        """
+        Stop sampling
+
+        :return: Nothing
+        """
+        self.looping = False
+
+    def summary(self):
+        """
+        Summarise samples
+
+        :return: Dictionary with maximum and final thread count and resident set size in bytes
+        """
+        return {
+            "threads_max": max(self.threads) if self.threads else None,
+            "threads_last": self.threads[-1] if self.threads else None,
+            "rss_max": max(self.rss) if self.rss else None,
+            "rss_last": self.rss[-1] if self.rss else None
+        }
+
+
+class database_prober(threading.Thread):
+    """
+    Measure how long it takes to get a write lock on the list server's database
+
+    This is a rough indication of database contention that works without access to the list server's admin API.
+    """
+    looping = True
+
+    def __init__(self, database, interval=0.5):
+        """
+        Set up prober
+
+        :param database: Path to SQLite database
+        :param interval: Seconds between probes
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.database = database
+        self.interval = interval
+        self.samples = []
+
+    def run(self):
+        """
+        Probe until halted
+
+        :return: Nothing
+        """
+        while self.looping:
+            try:
+                dbconn = sqlite3.connect(self.database, timeout=10, isolation_level=None)
+                start = time.perf_counter()
+                dbconn.execute("BEGIN IMMEDIATE")
+                self.samples.append(time.perf_counter() - start)
+                dbconn.execute("ROLLBACK")
+                dbconn.close()
+            except sqlite3.Error:
+                pass
+
+            time.sleep(self.interval)
+
+    def halt(self):
+        """
+        Stop probing
+
+        :return: Nothing
+        """
+        self.looping = False
+
+    def summary(self):
+        """
+        Summarise probes
+
+        :return: Dictionary with probe count and p50/p99/max wait in milliseconds
+        """
+        samples = sorted(self.samples)
+        return {
+            "probes": len(samples),
+            "p50": percentile(samples, 50),
+            "p99": percentile(samples, 99),
+            "max": round(samples[-1] * 1000, 2) if samples else None
+        }
+
+
+def admin_request(host, action, certfile, keyfile, data=None, timeout=5):
+    """
+    Send a request to the list server's admin API on port 10059
+
+    :param host: List server host
+    :param action: API action
+    :param certfile: Client certificate
+    :param keyfile: Client certificate key
+    :param data: API payload, dictionary
+    :param timeout: Socket timeout
+    :return: Decoded JSON response, or None if no valid response was received
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.load_cert_chain(certfile, keyfile)
+
+    connection = socket.create_connection((host, 10059), timeout=timeout)
+    connection = context.wrap_socket(connection)
+    connection.sendall(json.dumps({"action": action, "data": [data if data else {}], "origin": "web"}).encode("ascii"))
+
+    response = bytearray()
+    try:
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            response.extend(chunk)
+    except (socket.timeout, ssl.SSLError, OSError):
+        pass
+
+    connection.close()
+
+    try:
+        return json.loads(response.decode("ascii", "ignore"))
+    except ValueError:
+        return None
+
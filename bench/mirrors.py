@@ -0,0 +1,267 @@
+"""
+Checks for delivering ServerNet messages to mirrors that can not always be reached
+
+Run with `python3 -m bench.mirrors` from the repository root, while no list server is running on this machine: the
+simulated mirror listens at port 10056 of a loopback address (127.0.0.20 by default), as mirrors always do. Messages
+are sent to it as a list server would, with the mirror down for a few attempts, and the checks verify that banlist
+changes sent in the meantime still arrive, in order, once the mirror is back. A received message that is to be passed
+on is also checked to only be passed on to known mirrors. Exits with a non-zero status if any check fails.
+"""
+import argparse
+import tempfile
+import logging
+import pathlib
+import sqlite3
+import socket
+import config
+import types
+import json
+import sys
+
+from handlers.api import servernet_handler
+from helpers import servernet
+
+
+class mirror:
+    """
+    Simulated mirror, that can be up or down
+    """
+
+    def __init__(self, address):
+        """
+        Set up mirror, down
+
+        :param address: Address to listen at
+        """
+        self.address = address
+        self.server = None
+
+    def up(self):
+        """
+        Start listening
+
+        :return: Nothing
+        """
+        self.server = socket.socket()
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.address, 10056))
+        self.server.listen(64)
+        self.server.settimeout(0.5)
+
+    def down(self):
+        """
+        Stop listening
+
+        :return: Nothing
+        """
+        if self.server:
+            self.server.close()
+            self.server = None
+
+    def receive(self):
+        """
+        Get the messages that were sent to the mirror
+
+        :return: List of decoded messages
+        """
+        received = []
+        while True:
+            try:
+                connection, client = self.server.accept()
+            except socket.timeout:
+                return received
+
+            buffer = bytearray()
+            while True:
+                data = connection.recv(65536)
+                if not data:
+                    break
+                buffer.extend(data)
+            connection.close()
+            received.append(servernet.decode_message(buffer))
+
+
+class flaky(servernet.broadcaster):
+    """
+    Broadcaster for a mirror that goes down after receiving one message
+    """
+    sent = False
+
+    def send(self, data):
+        """
+        Send one message to the mirror, if it is the first
+
+        :param data: Message to send
+        :return: True if sent successfully, False if not
+        """
+        if self.sent:
+            return False
+
+        self.sent = True
+        return servernet.broadcaster.send(self, data)
+
+
+def listserver(*addresses):
+    """
+    Set up what a broadcaster or ServerNet handler needs of a list server
+
+    Messages the list server would broadcast are recorded rather than sent.
+
+    :param addresses: Addresses of the mirrors the list server knows
+    :return: Object with mirrors, log, address, ip, broadcast and broadcasts attributes
+    """
+    dbconn = sqlite3.connect(config.DATABASE)
+    dbconn.execute("CREATE TABLE mirrors (name TEXT, address TEXT, lifesign INTEGER DEFAULT 0)")
+    dbconn.executemany("INSERT INTO mirrors (name, address) VALUES (?, ?)",
+                       [("mirror%i" % i, address) for i, address in enumerate(addresses)])
+    dbconn.commit()
+    dbconn.close()
+
+    ls = types.SimpleNamespace(mirrors=servernet.mirror_directory(), log=logging.getLogger("mirrors"),
+                               address="list.example", ip="127.0.0.1", broadcasts=[])
+    ls.broadcast = lambda **kwargs: ls.broadcasts.append(kwargs)
+    ls.mirrors.load()
+
+    return ls
+
+
+def send(ls, address, action, number):
+    """
+    Send a message to the mirror as a list server would, and wait for it to be sent
+
+    :param ls: List server, see listserver()
+    :param address: Mirror address
+    :param action: Message action
+    :param number: Message number, used as its ID and in its data
+    :return: Nothing
+    """
+    if action == "add-banlist":
+        data = [{"address": "10.0.0.%i" % number, "type": "ban", "note": "", "origin": ls.address, "reserved": ""}]
+    else:
+        data = [{"id": "10.0.0.%i:10052" % number, "players": number}]
+
+    payload = {"action": action, "data": data, "origin": ls.address, "id": "1.%i" % number}
+    if not ls.mirrors.allow(address):
+        ls.mirrors.defer(address, action, json.dumps(payload))
+        return
+
+    sender = servernet.broadcaster(ip=address, data=json.dumps(payload), ls=ls, payload=payload)
+    sender.start()
+    sender.join()
+
+
+def check_retry(address):
+    """
+    Check that banlist changes sent while a mirror is down arrive once it is back
+
+    The mirror is down for fewer attempts than it takes to open its circuit breaker, so the changes are lost unless
+    failed sends are kept as well as messages that were not sent at all.
+
+    :param address: Address for the simulated mirror
+    :return: List of failure descriptions
+    """
+    failures = []
+    ls = listserver(address)
+    target = mirror(address)
+
+    bans = list(range(1, config.MIRROR_FAILURES))
+    for number in bans:
+        send(ls, address, "add-banlist", number)
+
+    if ls.mirrors.get(address)["state"] != "closed":
+        failures.append("retry: breaker opened after %i failure(s)" % len(bans))
+
+    target.up()
+    send(ls, address, "server", 100)
+    received = target.receive()
+    target.down()
+
+    ids = [message["id"] for message in received]
+    expected = ["1.100"] + ["1.%i" % number for number in bans]
+    if ids != expected:
+        failures.append("retry: mirror received %s, expected %s" % (ids, expected))
+    if ls.mirrors.get(address)["queued"]:
+        failures.append("retry: %i message(s) still queued" % ls.mirrors.get(address)["queued"])
+
+    return failures
+
+
+def check_partial(address):
+    """
+    Check that kept messages are kept if the mirror goes down again while they are being sent
+
+    :param address: Address for the simulated mirror
+    :return: List of failure descriptions
+    """
+    failures = []
+    ls = listserver(address)
+    target = mirror(address)
+
+    # open the breaker, keeping some banlist changes, then let it try again right away
+    for number in range(1, config.MIRROR_FAILURES + 4):
+        send(ls, address, "add-banlist", number)
+    breaker = ls.mirrors.mirrors[address]["breaker"]
+    kept = len(breaker.queue)
+    if breaker.state != "open":
+        failures.append("partial: breaker not opened after %i failures" % config.MIRROR_FAILURES)
+    breaker.opened = 0
+
+    # the mirror accepts one connection and then goes down again, halfway through sending the kept messages
+    target.up()
+    sender = flaky(ip=address, ls=ls, data=json.dumps({"action": "server", "data": [], "origin": ls.address,
+                                                         "id": "1.100"}), payload={"action": "server"})
+    sender.start()
+    sender.join()
+    target.down()
+
+    if len(breaker.queue) != kept:
+        failures.append("partial: %i of %i kept message(s) still queued" % (len(breaker.queue), kept))
+    if breaker.queue and json.loads(breaker.queue[0])["id"] != "1.1":
+        failures.append("partial: kept messages out of order, first is %s" % json.loads(breaker.queue[0])["id"])
+
+    return failures
+
+
+def check_relay(address):
+    """
+    Check that received messages are only relayed to known mirrors
+
+    :param address: Address of the mirror that sends the message
+    :return: List of failure descriptions
+    """
+    failures = []
+    ls = listserver(address, "127.0.0.21", "127.0.0.22")
+    client = socket.socket()
+    handler = servernet_handler(client=client, address=(address, 10056), ls=ls, port=10056)
+
+    payload = {"action": "add-banlist", "data": [], "origin": "other.example", "id": "1.1",
+               "relay": ["127.0.0.21", "192.0.2.1", address, ls.ip, "127.0.0.22", "example.com"]}
+    handler.relay(payload)
+    client.close()
+
+    recipients = [broadcast["recipients"] for broadcast in ls.broadcasts]
+    if recipients != [["127.0.0.21", "127.0.0.22"]]:
+        failures.append("relay: message relayed to %s, expected only the other mirrors" % recipients)
+    elif ls.broadcasts[0]["relay"] != ("other.example", "1.1"):
+        failures.append("relay: relayed message has origin and ID %s" % repr(ls.broadcasts[0]["relay"]))
+
+    return failures
+
+
+parser = argparse.ArgumentParser(prog="python3 -m bench.mirrors", description="Check delivery to ServerNet mirrors")
+parser.add_argument("--address", default="127.0.0.20", help="Loopback address for the simulated mirror")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.CRITICAL)
+failures = []
+
+with tempfile.TemporaryDirectory() as directory:
+    for number, check in enumerate([check_retry, check_partial, check_relay]):
+        config.DATABASE = str(pathlib.Path(directory).joinpath("mirrors-%i.db" % number))
+        failures += check(args.address)
+
+for failure in failures:
+    print("FAIL %s" % failure)
+print("%i failure(s)" % len(failures))
+
+sys.exit(1 if failures else 0)
@@ -0,0 +1,309 @@
+"""
+Round-trip checks, fuzzing and micro-benchmarks for helpers.protocol
+
+Run with `python3 -m bench.protocol` from the repository root. Exits with a non-zero status if any check fails, so it
+can be used to verify changes to the wire format code before benchmarking them.
+
+Round-trip checks encode random values and verify decoding them gives the same values back. Fuzzing feeds the decoders
+a corpus of known packets, mutated at random, and verifies they either decode or raise ValueError - anything else would
+kill a handler thread. Inputs that fail are written to the folder given with --save, so they can be replayed with --replay.
+"""
+import argparse
+import pathlib
+import zlib
+import random
+import string
+import timeit
+import time
+import sys
+
+from helpers import protocol
+from helpers.jj2 import jj2server
+
+# seeds for fuzzing: packets as sent by actual clients, and some edge cases
+CORPUS = {
+    "listing": [
+        bytes.fromhex("5c27") + b"Jazz server".ljust(30, b"\x00") + b"\x00\x00\x00" + bytes([3, 16, 7]) + b"24+ ",
+        bytes.fromhex("5c27") + b"|||Colour||Name".ljust(30, b"\x00") + b"\x00\x00\x00" + bytes([0, 32, 0x80]) + b"21  ",
+        b"\x00" * 42,
+        b"\xff" * 42,
+        b"\x00" * 41,
+        b"\x00" * 43,
+        b""
+    ],
+    "update": [
+        bytes([0x00, 5]),
+        bytes([0x01, 3]),
+        bytes([0x02]) + b"New server name".ljust(32, b"\x00"),
+        bytes([0x03, 16]),
+        bytes([0x04, 1]),
+        bytes([0x05, 1]),
+        bytes([0x06, 1]),
+        bytes([0x00]),
+        bytes([0x02, 0x41]),
+        b""
+    ],
+    "binary_list": [
+        protocol.BINARY_HEADER,
+        protocol.encode_binary_list([{"ip": "192.0.2.1", "port": 10052, "name": "Server"}]),
+        protocol.BINARY_HEADER + bytes([6, 1, 2, 3, 4, 5, 6]),
+        protocol.BINARY_HEADER + bytes([255]),
+        b"LIST"
+    ],
+    "ascii_line": [
+        b"192.0.2.1:10052 local public ctf 1.24   60 [3/16] Jazz server\r\n",
+        b"192.0.2.1:10052 mirror private battle 1.24+  0 [0/32] \r\n",
+        b"192.0.2.1 local",
+        b""
+    ],
+    "list_query": [
+        b"VERSION\n",
+        b"VERSION 1792391999.9\r\n",
+        b"VERSION 1792391999.9 ZLIB\n",
+        b"GET / HTTP/1.0\r\n\r\n",
+        b""
+    ],
+    "ping_reply": [
+        bytes([0, 0, 0x04, 1, 0, 0, 0, 0, 0x20]),
+        bytes([0, 0, 0x04]),
+        b""
+    ]
+}
+
+DECODERS = {
+    "listing": lambda data: protocol.decode_listing(data),
+    "update": lambda data: protocol.decode_update(data),
+    "binary_list": lambda data: protocol.decode_binary_list(data),
+    "ascii_line": lambda data: protocol.decode_ascii_line(data.decode("ascii", "ignore"), 0),
+    "list_query": lambda data: protocol.decode_list_query(data),
+    "ping_reply": lambda data: protocol.decode_ping_reply(data)
+}
+
+
+def random_name(rng, length=None):
+    """
+    Get a random server name, as it would look after sanitising
+
+    :param rng: random.Random instance
+    :param length: Length, random if not given
+    :return: Name
+    """
+    allowed = "".join([c for c in string.printable[:95] if c not in "#%&[]^{}~ "])
+    length = length if length is not None else rng.randint(1, 30)
+    return "".join([rng.choice(allowed) for i in range(0, length)])
+
+
+def random_server(rng):
+    """
+    Get a random server record
+
+    :param rng: random.Random instance
+    :return: Dictionary
+    """
+    return {
+        "ip": ".".join([str(rng.randint(0, 255)) for i in range(0, 4)]),
+        "port": rng.randint(0, 65535),
+        "name": random_name(rng),
+        "players": rng.randint(0, 255),
+        "max": rng.randint(0, 255),
+        "private": rng.randint(0, 1),
+        "plusonly": rng.randint(0, 1),
+        "remote": rng.randint(0, 1),
+        "mode": rng.choice(list(protocol.MODES.values())),
+        "version": rng.choice(["1.23", "1.24", "1.24+", "1.23+"]),
+        "created": rng.randint(0, 10000)
+    }
+
+
+def check_roundtrips(iterations, rng):
+    """
+    Verify that decoding encoded values gives the original values
+
+    :param iterations: Amount of random values to check per format
+    :param rng: random.Random instance
+    :return: List of failure descriptions
+    """
+    failures = []
+
+    for number, name in protocol.MODES.items():
+        if protocol.decode_mode(protocol.encode_mode(name)) != name:
+            failures.append("mode %s" % name)
+
+    for i in range(0, iterations):
+        server = random_server(rng)
+
+        listing = {key: server[key] for key in ("port", "name", "players", "max", "private", "plusonly", "mode",
+                                                "version")}
+        listing["plusonly"] = 128 if listing["plusonly"] else 0  # listings carry the flag bit, updates 0 or 1
+        decoded = protocol.decode_listing(protocol.encode_listing(listing))
+        decoded["version"] = decoded["version"].rstrip(" ")  # version is padded to four bytes
+        decoded["name"] = jj2server.strip(decoded["name"])  # name is the raw, padded name field
+        if decoded != listing:
+            failures.append("listing %s != %s" % (repr(listing), repr(decoded)))
+
+        for field in protocol.UPDATE_OPCODES:
+            value = server[field] if field != "name" else random_name(rng, rng.randint(1, 32))
+            decoded = protocol.decode_update(protocol.encode_update(field, value))
+            if field == "name":
+                decoded = (decoded[0], jj2server.strip(decoded[1]))
+            if decoded != (field, value):
+                failures.append("update %s != %s" % (repr((field, value)), repr(decoded)))
+
+        servers = [random_server(rng) for j in range(0, rng.randint(0, 5))]
+        expected = [{"ip": s["ip"], "port": s["port"], "name": s["name"]} for s in servers]
+        decoded = protocol.decode_binary_list(protocol.encode_binary_list(servers))
+        if decoded != expected:
+            failures.append("binary list %s != %s" % (repr(expected), repr(decoded)))
+
+        decoded = protocol.decode_ascii_line(protocol.encode_ascii_line(server, 20000), 20000)
+        expected = {key: server[key] for key in decoded}
+        expected["version"] = expected["version"][:6]
+        if decoded != expected:
+            failures.append("ascii line %s != %s" % (repr(expected), repr(decoded)))
+
+        version = ("%i.%i" % (rng.randint(0, 2 ** 32), rng.randint(0, 10000))).encode("ascii")
+        asciilist = protocol.encode_ascii_line(server, 20000).encode("ascii")
+        if protocol.conditional_list(asciilist, version, b"VERSION " + version + b"\n") != \
+                protocol.LIST_UNCHANGED + b" " + version + b"\r\n" or \
+                protocol.conditional_list(asciilist, version, b"VERSION 0\n") != b"VERSION " + version + b"\r\n" + asciilist or \
+                protocol.conditional_list(asciilist, version) != asciilist:
+            failures.append("conditional list %s" % version)
+
+        response = protocol.conditional_list(asciilist, version, b"VERSION 0 ZLIB\n", zlib.compress(asciilist))
+        header, body = response.split(b"\r\n", 1)
+        if header != b"VERSION " + version + b" ZLIB" or zlib.decompress(body) != asciilist:
+            failures.append("compressed conditional list %s" % version)
+
+        index = rng.randint(1, 255)
+        datagram = protocol.encode_ping(index)
+        if datagram[3] != index or protocol.udpchecksum(bytearray(datagram)) != datagram:
+            failures.append("ping %i" % index)
+
+    return failures
+
+
+def mutate(data, rng):
+    """
+    Randomly mutate bytes: flip, insert, delete or truncate
+
+    :param data: Bytes to mutate
+    :param rng: random.Random instance
+    :return: Mutated bytes
+    """
+    data = bytearray(data)
+    for i in range(0, rng.randint(1, 4)):
+        operation = rng.randint(0, 3)
+        if operation == 0 and data:
+            data[rng.randrange(len(data))] = rng.randint(0, 255)
+        elif operation == 1:
+            data.insert(rng.randint(0, len(data)), rng.randint(0, 255))
+        elif operation == 2 and data:
+            del data[rng.randrange(len(data))]
+        elif operation == 3:
+            data = data[:rng.randint(0, len(data))]
+
+    return bytes(data)
+
+
+def fuzz(iterations, rng, save=None):
+    """
+    Feed mutated corpus entries to the decoders
+
+    :param iterations: Amount of mutations per corpus entry
+    :param rng: random.Random instance
+    :param save: Folder to save failing inputs to
+    :return: List of failure descriptions
+    """
+    failures = []
+
+    for format, seeds in CORPUS.items():
+        for seed in seeds:
+            for i in range(0, iterations):
+                data = mutate(seed, rng) if i > 0 else seed
+                try:
+                    DECODERS[format](data)
+                except ValueError:
+                    pass
+                except Exception as e:
+                    failures.append("%s: %s on %s" % (format, repr(e), data.hex()))
+                    if save:
+                        folder = pathlib.Path(save)
+                        folder.mkdir(parents=True, exist_ok=True)
+                        folder.joinpath("%s-%i-%i.bin" % (format, len(failures), int(time.time()))).write_bytes(data)
+
+    return failures
+
+
+def replay(folder):
+    """
+    Feed saved inputs to the decoders
+
+    :param folder: Folder with files named [format]-*.bin
+    :return: List of failure descriptions
+    """
+    failures = []
+    for file in sorted(pathlib.Path(folder).glob("*.bin")):
+        format = file.name.split("-")[0]
+        try:
+            DECODERS[format](file.read_bytes())
+        except ValueError:
+            pass
+        except Exception as e:
+            failures.append("%s: %s" % (file.name, repr(e)))
+
+    return failures
+
+
+def benchmark(rng, repeat):
+    """
+    Time the encoders and decoders on the hot paths
+
+    :param rng: random.Random instance
+    :param repeat: Amount of calls per measurement
+    :return: Dictionary of name: microseconds per call
+    """
+    servers = [random_server(rng) for i in range(0, 100)]
+    listing = protocol.encode_listing(servers[0])
+    update = protocol.encode_update("players", 5)
+    binary = protocol.encode_binary_list(servers)
+    now = int(time.time())
+
+    cases = {
+        "decode_listing": lambda: protocol.decode_listing(listing),
+        "decode_update": lambda: protocol.decode_update(update),
+        "encode_binary_list (100 servers)": lambda: protocol.encode_binary_list(servers),
+        "decode_binary_list (100 servers)": lambda: protocol.decode_binary_list(binary),
+        "encode_ascii_line x100": lambda: "".join([protocol.encode_ascii_line(server, now) for server in servers]),
+        "encode_ping": lambda: protocol.encode_ping(3)
+    }
+
+    return {name: round(min(timeit.repeat(case, number=repeat, repeat=3)) / repeat * 1000000, 3)
+            for name, case in cases.items()}
+
+
+parser = argparse.ArgumentParser(prog="python3 -m bench.protocol", description="Check and benchmark wire formats")
+parser.add_argument("--iterations", type=int, default=500, help="Random values per round-trip check and mutations "
+                                                                 "per corpus entry")
+parser.add_argument("--seed", type=int, default=10054, help="Random seed")
+parser.add_argument("--repeat", type=int, default=2000, help="Calls per benchmark measurement")
+parser.add_argument("--save", help="Folder to save failing fuzz inputs to")
+parser.add_argument("--replay", help="Folder with saved fuzz inputs to replay instead of fuzzing")
+parser.add_argument("--no-benchmark", action="store_true", help="Only run checks")
+args = parser.parse_args()
+
+rng = random.Random(args.seed)
+
+if args.replay:
+    failures = replay(args.replay)
+else:
+    failures = check_roundtrips(args.iterations, rng) + fuzz(args.iterations, rng, args.save)
+
+for failure in failures[:20]:
+    print("FAIL %s" % failure)
+print("%i failure(s)" % len(failures))
+
+if not args.no_benchmark and not args.replay:
+    for name, duration in benchmark(rng, args.repeat).items():
+        print("%-36s %10.3f us" % (name, duration))
+
+sys.exit(1 if failures else 0)
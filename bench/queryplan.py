@@ -0,0 +1,116 @@
+"""
+Check that the queries on the hot paths use the database indexes
+
+Run with `python3 -m bench.queryplan` from the repository root. Creates a database with the schema as it was before
+migrations existed (including duplicate banlist entries), migrates it with helpers.schema, and then checks the query
+plan of each hot query. Exits with a non-zero status if migrating fails or a query would scan a whole table, so it can
+be used to verify schema changes and changes to the queries themselves.
+"""
+import argparse
+import tempfile
+import logging
+import pathlib
+import sqlite3
+import types
+import sys
+
+from helpers import schema
+
+# query: index the plan should mention
+QUERIES = {
+    "SELECT * FROM servers WHERE id = ?": "PRIMARY KEY",
+    "SELECT COUNT(*) FROM servers WHERE ip = ?": "servers_address",
+    "SELECT COUNT(*) FROM servers WHERE ip = ? AND port = ?": "servers_address",
+    "SELECT id FROM servers WHERE origin = ? AND last_ping < ? ORDER BY last_ping ASC": "servers_ping",
+    "DELETE FROM servers WHERE remote = 1 AND lifesign < ?": "servers_timeout",
+    "UPDATE servers SET players = ?, lifesign = ? WHERE id = ?": "PRIMARY KEY",
+    "SELECT address FROM banlist WHERE type = 'ban'": "banlist_type",
+    "SELECT * FROM banlist WHERE updated >= ?": "banlist_updated",
+    "DELETE FROM banlist WHERE address = ? AND type = ? AND note = ? AND origin = ? AND reserved = ?": "banlist_entry",
+    "SELECT * FROM mirrors WHERE name = ? AND address = ?": "mirrors_address",
+    "UPDATE mirrors SET lifesign = ? WHERE address = ?": "mirrors_address",
+    "SELECT * FROM settings WHERE item = ?": "PRIMARY KEY"
+}
+
+
+def legacy_database(path):
+    """
+    Create a database as created by list servers from before migrations existed
+
+    :param path: Database file
+    :return: Nothing
+    """
+    dbconn = sqlite3.connect(path)
+    dbconn.execute("CREATE TABLE settings (item TEXT UNIQUE, value TEXT)")
+    dbconn.execute("INSERT INTO settings (item, value) VALUES ('motd', ''), ('motd-updated', '0')")
+    dbconn.execute("CREATE TABLE banlist (address TEXT, type TEXT, note TEXT, origin TEXT)")
+    dbconn.executemany("INSERT INTO banlist (address, type, note, origin) VALUES (?, ?, ?, ?)",
+                       [("192.0.2.%i" % (i % 10), "ban", "", "127.0.0.1") for i in range(0, 20)])
+    dbconn.execute("CREATE TABLE mirrors (name TEXT, address TEXT, lifesign INTEGER DEFAULT 0)")
+    dbconn.commit()
+    dbconn.close()
+
+
+def check(path, rows):
+    """
+    Migrate a legacy database and check the query plans
+
+    :param path: Database file
+    :param rows: Amount of rows to add to the servers table, so the planner has something to work with
+    :return: List of failure descriptions
+    """
+    failures = []
+    legacy_database(path)
+
+    dbconn = sqlite3.connect(path, isolation_level=None)
+    ls = types.SimpleNamespace(log=logging.getLogger("queryplan"), address="127.0.0.1")
+
+    try:
+        version = schema.migrate(dbconn, ls)
+        schema.create_servers(dbconn)
+    except sqlite3.Error as e:
+        return ["migrating: %s" % e]
+
+    if version != len(schema.MIGRATIONS):
+        failures.append("schema version %i after migrating, expected %i" % (version, len(schema.MIGRATIONS)))
+
+    if schema.migrate(dbconn, ls) != version:
+        failures.append("migrating twice changed the schema version")
+
+    bans = dbconn.execute("SELECT COUNT(*) FROM banlist").fetchone()[0]
+    if bans != 10:
+        failures.append("%i banlist entries after removing duplicates, expected 10" % bans)
+
+    dbconn.execute("INSERT OR IGNORE INTO banlist (address, type, note, origin, reserved) VALUES (?, ?, ?, ?, ?)",
+                   ("192.0.2.1", "ban", "", "127.0.0.1", ""))
+    if dbconn.execute("SELECT COUNT(*) FROM banlist").fetchone()[0] != bans:
+        failures.append("duplicate banlist entry was inserted")
+
+    dbconn.executemany("INSERT INTO servers (id, ip, port, origin, remote, lifesign) VALUES (?, ?, ?, ?, ?, ?)",
+                       [("192.0.2.%i:%i" % (i % 250, 10052 + i), "192.0.2.%i" % (i % 250), 10052 + i, "127.0.0.1",
+                         i % 2, i) for i in range(0, rows)])
+    dbconn.execute("ANALYZE")
+
+    for query, index in QUERIES.items():
+        plan = " / ".join([row[3] for row in dbconn.execute("EXPLAIN QUERY PLAN " + query,
+                                                             (0,) * query.count("?")).fetchall()])
+        print("%-100s %s" % (query[:100], plan))
+        if index not in plan:
+            failures.append("%s: expected %s, got plan %s" % (query, index, plan))
+
+    dbconn.close()
+    return failures
+
+
+parser = argparse.ArgumentParser(prog="python3 -m bench.queryplan", description="Check database query plans")
+parser.add_argument("--rows", type=int, default=1000, help="Servers to add before checking query plans")
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as directory:
+    failures = check(str(pathlib.Path(directory).joinpath("servers.db")), args.rows)
+
+for failure in failures:
+    print("FAIL %s" % failure)
+print("%i failure(s)" % len(failures))
+
+sys.exit(1 if failures else 0)
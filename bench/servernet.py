@@ -0,0 +1,191 @@
+"""
+Round-trip checks, fuzzing and micro-benchmarks for ServerNet message encoding
+
+Run with `python3 -m bench.servernet` from the repository root. For the actions that can be sent in binary form
+(server, delist and add-banlist), generates messages of several sizes as they are sent in practice: full server
+records as sent in a sync, small server updates as sent when players join or leave, delistings and banlist entries.
+Each message is encoded as JSON and in binary form, both with and without compression, and the time to encode and
+decode it and its size are reported.
+
+Exits with a non-zero status if any check fails: binary messages should decode to the same message as JSON ones,
+messages that can not be sent in binary form should be sent as JSON, every incomplete binary message should be
+recognised as such, and mutated binary messages should either decode or raise ValueError.
+"""
+import argparse
+import timeit
+import random
+import json
+import sys
+
+from helpers import servernet
+
+FORMS = (("json", False, False), ("json+zlib", False, True), ("binary", True, False), ("binary+zlib", True, True))
+
+
+def server(i, rng, full=True):
+    """
+    Generate a server record or update
+
+    :param i: Server number
+    :param rng: random.Random instance
+    :param full: Generate a full record, as sent in a sync, rather than an update
+    :return: Dictionary
+    """
+    ip = "%i.%i.%i.%i" % (rng.randint(11, 223), rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+    players = rng.randint(0, 32)
+    if not full:
+        return {"id": "%s:10052" % ip, "players": players, "lifesign": 1792390000 + i}
+
+    return {"id": "%s:10052" % ip, "ip": ip, "port": 10052, "created": 1792390000 - i, "lifesign": 1792390000 + i,
+            "last_ping": 0, "private": rng.randint(0, 1), "remote": 1, "origin": rng.choice([None, "list.example"]),
+            "version": rng.choice(["1.24  ", "1.24+ ", "1.23  "]), "plusonly": 0,
+            "mode": rng.choice(["ctf", "battle", "treasure", "coop"]), "players": players, "max": 32,
+            "name": "Server %i %s" % (i, rng.choice(["", "| |CTF| |", "Ünïcode"])), "prefer": 1}
+
+
+def banlist_entry(i, rng):
+    """
+    Generate a banlist entry
+
+    :param i: Entry number
+    :param rng: random.Random instance
+    :return: Dictionary
+    """
+    return {"address": "%i.%i.%i.%i" % (rng.randint(11, 223), rng.randint(0, 255), rng.randint(0, 255), i % 256),
+            "type": rng.choice(["ban", "ban", "whitelist"]), "note": rng.choice(["", "abuse report"]),
+            "origin": "list.example", "reserved": ""}
+
+
+def messages(sizes, rng):
+    """
+    Generate messages to test with
+
+    :param sizes: Amounts of items per message
+    :param rng: random.Random instance
+    :return: List of (description, message) tuples
+    """
+    generated = []
+    for size in sizes:
+        generated.append(("server sync x%i" % size, [server(i, rng) for i in range(0, size)], "server"))
+        generated.append(("server update x%i" % size, [server(i, rng, full=False) for i in range(0, size)], "server"))
+        generated.append(("delist x%i" % size, [server(i, rng) for i in range(0, size)], "delist"))
+        generated.append(("add-banlist x%i" % size, [banlist_entry(i, rng) for i in range(0, size)], "add-banlist"))
+
+    return [(description, {"action": action, "data": data, "origin": "list.example", "id": "1792390000.%i" % i})
+            for i, (description, data, action) in enumerate(generated)]
+
+
+def check(payload, rng, mutations):
+    """
+    Check encoding and decoding of a message
+
+    :param payload: Message
+    :param rng: random.Random instance
+    :param mutations: Amount of mutated messages to try decoding
+    :return: List of failure descriptions
+    """
+    failures = []
+    expected = json.loads(json.dumps(payload))
+
+    for form, binary, compress in FORMS:
+        encoded = servernet.encode_payload(payload, binary=binary, compress=compress)
+        if binary and encoded[:len(servernet.BINARY_MAGIC)] != servernet.BINARY_MAGIC:
+            failures.append("%s: not sent in binary form" % form)
+        if servernet.decode_message(bytearray(encoded)) != expected:
+            failures.append("%s: decoded message differs" % form)
+
+    encoded = servernet.encode_payload(payload, binary=True)
+    for length in range(0, len(encoded), max(1, len(encoded) // 50)):
+        if length > 0 and not servernet.incomplete(encoded[:length]):
+            failures.append("binary: %i of %i bytes not recognised as incomplete" % (length, len(encoded)))
+            break
+    if servernet.incomplete(encoded):
+        failures.append("binary: complete message recognised as incomplete")
+
+    for i in range(0, mutations):
+        mutated = bytearray(encoded)
+        for j in range(0, rng.randint(1, 4)):
+            mutated[rng.randrange(0, len(mutated))] = rng.randint(0, 255)
+        try:
+            servernet.decode_message(mutated)
+        except ValueError:
+            pass
+        except Exception as e:
+            failures.append("binary: mutated message raised %s (%s): %s" % (type(e).__name__, e, bytes(mutated)[:64]))
+            break
+
+    return failures
+
+
+def fallback():
+    """
+    Check that messages that can not be sent in binary form are sent as JSON
+
+    :return: List of failure descriptions
+    """
+    failures = []
+    unsendable = {
+        "unknown property": [{"id": "1.2.3.4:10052", "colour": "blue"}],
+        "string as number": [{"id": "1.2.3.4:10052", "port": "10052"}],
+        "number as string": [{"id": 1}],
+        "separator in string": [{"id": "1.2.3.4:10052", "name": "a\x00b"}],
+        "number too large": [{"id": "1.2.3.4:10052", "created": 2 ** 70}],
+        "not a dictionary": ["1.2.3.4:10052"]
+    }
+
+    for description, data in unsendable.items():
+        payload = {"action": "server", "data": data, "origin": "list.example", "id": "1.1"}
+        encoded = servernet.encode_payload(payload, binary=True)
+        if encoded[:1] != b"{":
+            failures.append("%s: not sent as JSON" % description)
+
+    payload = {"action": "hello", "data": [servernet.introduction("list.example")], "origin": "list.example",
+               "id": "1.2"}
+    if servernet.encode_payload(payload, binary=True)[:1] != b"{":
+        failures.append("hello: not sent as JSON")
+
+    return failures
+
+
+def benchmark(description, payload, repeat):
+    """
+    Time encoding and decoding a message in each form
+
+    :param description: Description of message
+    :param payload: Message
+    :param repeat: Amount of times to encode and decode it
+    :return: Nothing
+    """
+    sizes = []
+    for form, binary, compress in FORMS:
+        encoded = bytearray(servernet.encode_payload(payload, binary=binary, compress=compress))
+        encoding = min(timeit.repeat(lambda: servernet.encode_payload(payload, binary=binary, compress=compress),
+                                     number=repeat, repeat=3)) / repeat
+        decoding = min(timeit.repeat(lambda: servernet.decode_message(encoded), number=repeat, repeat=3)) / repeat
+        sizes.append("%s %8i B  enc %8.1f us  dec %8.1f us" % (form.rjust(11), len(encoded), encoding * 1000000,
+                                                              decoding * 1000000))
+
+    print(description)
+    for line in sizes:
+        print("  " + line)
+
+
+parser = argparse.ArgumentParser(prog="python3 -m bench.servernet", description="Benchmark ServerNet message encoding")
+parser.add_argument("--sizes", type=int, nargs="+", default=[1, 100, 1000], help="Items per message")
+parser.add_argument("--repeat", type=int, default=20, help="Times to encode and decode each message per measurement")
+parser.add_argument("--mutations", type=int, default=2000, help="Mutated messages to decode per message")
+parser.add_argument("--seed", type=int, default=10056, help="Random seed")
+args = parser.parse_args()
+
+rng = random.Random(args.seed)
+failures = fallback()
+
+for description, payload in messages(args.sizes, rng):
+    failures += ["%s, %s" % (description, failure) for failure in check(payload, rng, args.mutations)]
+    benchmark(description, payload, args.repeat)
+
+for failure in failures:
+    print("FAIL %s" % failure)
+print("%i failure(s)" % len(failures))
+
+sys.exit(1 if failures else 0)
@@ -0,0 +1,308 @@
+import threading
+import selectors
+import random
+import socket
+import json
+import time
+
+
+def source_address(base, index):
+    """
+    Get a loopback address to connect from
+
+    The list server limits the amount of servers per IP, so each simulated server connects from its own address.
+
+    :param base: Second octet of the address range to use, e.g. 1 for 127.1.x.x
+    :param index: Index of the simulated entity
+    :return: IP address
+    """
+    return "127.%i.%i.%i" % (base, (index // 250) % 256, (index % 250) + 1)
+
+
+def listing(port, name, players, max_players, mode=3, private=False, plusonly=False, version=b"24  "):
+    """
+    Build the 42-byte packet a JJ2 server sends to get listed
+
+    :param port: Game port
+    :param name: Server name
+    :param players: Player count
+    :param max_players: Max players
+    :param mode: Game mode number
+    :param private: Whether the server is private
+    :param plusonly: Whether the server is JJ2+ only
+    :param version: Four version bytes
+    :return: Packet, bytes
+    """
+    flags = (1 if private else 0) | ((mode & 31) << 1) | (128 if plusonly else 0)
+    packet = port.to_bytes(2, byteorder="little") + name.encode("ascii").ljust(30, b"\x00")[:30] + b"\x00\x00\x00"
+    packet += bytes([players, max_players, flags]) + version
+
+    return packet
+
+
+def read_all(connection):
+    """
+    Read from socket until the other end closes the connection
+
+    :param connection: Socket
+    :return: Everything that was received
+    """
+    buffer = bytearray()
+    while True:
+        chunk = connection.recv(65536)
+        if not chunk:
+            break
+        buffer.extend(chunk)
+
+    return bytes(buffer)
+
+
+class simulator(threading.Thread):
+    """
+    Base class for simulated entities: threaded, loops until halted
+    """
+    looping = True
+
+    def __init__(self, host, recorder, index=0, interval=1.0):
+        """
+        Set up simulator
+
+        :param host: List server host
+        :param recorder: metrics.recorder to record results with
+        :param index: Index of this entity, used to make names and addresses unique
+        :param interval: Seconds between actions
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.host = host
+        self.recorder = recorder
+        self.index = index
+        self.interval = interval
+
+    def halt(self):
+        """
+        Stop simulating
+
+        :return: Nothing
+        """
+        self.looping = False
+
+    def pause(self, seconds):
+        """
+        Sleep, but stop sleeping early when halted
+
+        :param seconds: Seconds to sleep
+        :return: Nothing
+        """
+        end = time.time() + seconds
+        while self.looping and time.time() < end:
+            time.sleep(min(0.1, max(0, end - time.time())))
+
+
+class game_server(simulator):
+    """
+    Simulated JJ2 game server
+
+    Registers itself on port 10054, then sends player count updates and pings, and after a while says goodbye and
+    lists itself again.
+    """
+
+    def __init__(self, host, recorder, index=0, interval=1.0, lifetime=60.0, source_base=1):
+        """
+        Set up game server
+
+        :param lifetime: Seconds after which the server delists and relists itself
+        :param source_base: Address range to connect from, see source_address()
+        """
+        super().__init__(host, recorder, index, interval)
+        self.lifetime = lifetime
+        self.source = source_address(source_base, index)
+
+    def run(self):
+        """
+        List, update, delist, repeat
+
+        :return: Nothing
+        """
+        while self.looping:
+            self.session()
+            self.pause(0.5)
+
+    def session(self):
+        """
+        One listing, from registration until goodbye
+
+        :return: Nothing
+        """
+        players = random.randint(0, 8)
+        start = time.perf_counter()
+        try:
+            connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            connection.bind((self.source, 0))
+            connection.settimeout(10)
+            connection.connect((self.host, 10054))
+            connection.sendall(listing(10052 + (self.index % 100), "Bench server %i" % self.index, players, 16))
+            self.recorder.add("10054-register", time.perf_counter() - start)
+        except OSError as e:
+            self.recorder.error("10054-register", type(e).__name__)
+            self.pause(self.interval)
+            return
+
+        watcher = selectors.DefaultSelector()
+        watcher.register(connection, selectors.EVENT_READ)
+        listed = time.time()
+
+        try:
+            while self.looping and time.time() < listed + self.lifetime:
+                self.pause(self.interval * random.uniform(0.5, 1.5))
+
+                # the list server only sends something if it wants to get rid of us, or to check if we're alive
+                if watcher.select(timeout=0):
+                    data = connection.recv(1024)
+                    if not data:
+                        self.recorder.error("10054-update", "disconnected")
+                        return
+                    if data != b"\x00":
+                        self.recorder.error("10054-update", "refused")
+                        return
+
+                if random.random() < 0.5:
+                    players = max(0, min(16, players + random.choice([-1, 1])))
+
+                start = time.perf_counter()
+                connection.sendall(bytes([0x00, players]))
+                self.recorder.add("10054-update", time.perf_counter() - start)
+
+            # goodbye packet, as sent by JJ2 when the server is closed
+            connection.sendall(b"\x00" * 20)
+        except OSError as e:
+            self.recorder.error("10054-update", type(e).__name__)
+        finally:
+            watcher.close()
+            connection.close()
+
+
+class list_client(simulator):
+    """
+    Simulated client, fetching lists, statistics and the MOTD as fast as it can
+    """
+    ports = {10053: 2, 10057: 6, 10055: 1, 10058: 1}
+
+    def __init__(self, host, recorder, index=0, interval=0.0, ports=None):
+        """
+        Set up client
+
+        :param ports: Dictionary of port: weight, determines how often each port is requested
+        """
+        super().__init__(host, recorder, index, interval)
+        if ports:
+            self.ports = ports
+
+    def run(self):
+        """
+        Fetch, repeat
+
+        :return: Nothing
+        """
+        population = list(self.ports)
+        weights = [self.ports[port] for port in population]
+
+        while self.looping:
+            port = random.choices(population, weights)[0]
+            start = time.perf_counter()
+            try:
+                connection = socket.create_connection((self.host, port), timeout=10)
+                response = read_all(connection)
+                connection.close()
+                self.recorder.add(port, time.perf_counter() - start, len(response))
+            except OSError as e:
+                self.recorder.error(port, type(e).__name__)
+
+            if self.interval:
+                self.pause(self.interval)
+
+
+class fake_mirror(simulator):
+    """
+    Simulated ServerNet mirror
+
+    Sends batches of server updates and pings to port 10056. The list server only accepts these if the address the
+    mirror connects from is in its mirrors table.
+    """
+
+    def __init__(self, host, recorder, index=0, interval=1.0, servers=20, source_base=2):
+        """
+        Set up mirror
+
+        :param servers: Amount of servers this mirror pretends to have listed
+        :param source_base: Address range to connect from, see source_address()
+        """
+        super().__init__(host, recorder, index, interval)
+        self.servers = servers
+        self.source = source_address(source_base, index)
+        self.name = "bench-mirror-%i" % index
+        self.sequence = 0
+        self.boot = int(time.time())
+
+    def message(self, action, data):
+        """
+        Serialise a ServerNet message
+
+        :param action: Action
+        :param data: List of items
+        :return: Message, bytes
+        """
+        self.sequence += 1
+        return json.dumps({"action": action, "data": data, "origin": self.name,
+                           "id": "%i.%i" % (self.boot, self.sequence)}).encode("ascii")
+
+    def run(self):
+        """
+        Send full server batches, then mostly small updates and an occasional ping
+
+        :return: Nothing
+        """
+        servers = []
+        now = int(time.time())
+        for i in range(0, self.servers):
+            ip = "10.%i.%i.%i" % (self.index % 256, i // 250, (i % 250) + 1)
+            servers.append({"id": "%s:10052" % ip, "ip": ip, "port": 10052, "created": now, "lifesign": now,
+                            "private": 0, "remote": 1, "origin": self.name, "version": "1.24+", "plusonly": 0,
+                            "mode": "ctf", "players": random.randint(0, 16), "max": 16,
+                            "name": "Mirrored server %i/%i" % (self.index, i)})
+
+        rounds = 0
+        while self.looping:
+            if rounds % 30 == 0:
+                self.send("server", servers, "10056-sync")
+            elif rounds % 10 == 0:
+                self.send("ping", [{"from": self.name}], "10056-ping")
+            else:
+                server = random.choice(servers)
+                server["players"] = random.randint(0, 16)
+                self.send("server", [{"id": server["id"], "players": server["players"]}], "10056-update")
+
+            rounds += 1
+            self.pause(self.interval)
+
+    def send(self, action, data, label):
+        """
+        Send a message and wait for the list server to close the connection
+
+        :param action: Action
+        :param data: List of items
+        :param label: Label to record the result under
+        :return: Nothing
+        """
+        start = time.perf_counter()
+        try:
+            connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            connection.bind((self.source, 0))
+            connection.settimeout(10)
+            connection.connect((self.host, 10056))
+            connection.sendall(self.message(action, data))
+            read_all(connection)
+            connection.close()
+            self.recorder.add(label, time.perf_counter() - start)
+        except OSError as e:
+            self.recorder.error(label, type(e).__name__)
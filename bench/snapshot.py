@@ -0,0 +1,174 @@
+"""
+Check that list snapshots never pair a list version with outdated data
+
+Run with `python3 -m bench.snapshot` from the repository root. Creates a database with a listed server, then changes
+that server while another list render happens at the worst possible moment: right before the change is written to the
+database, and right after it has been written but before the list is marked as changed. Clients fetching the list on
+port 10057 in between get a version along with it; asking for the list again with that version once the change has
+been made should give them the new list rather than "UNCHANGED". Exits with a non-zero status if it does not, so it can
+be used to verify changes to helpers.snapshot and the code that marks the list as changed.
+"""
+import contextlib
+import tempfile
+import logging
+import pathlib
+import sqlite3
+import types
+import time
+import sys
+
+import config
+import helpers.jj2
+
+from helpers import schema, snapshot
+from helpers.protocol import conditional_list, LIST_QUERY, LIST_UNCHANGED
+
+
+def fake_listserver():
+    """
+    Create an object with what list snapshots need from the list server
+
+    :return: Object
+    """
+    mirrors = types.SimpleNamespace(sorted=lambda: [], all=lambda: [])
+    settings = types.SimpleNamespace(motd_payload=b"")
+
+    return types.SimpleNamespace(log=logging.getLogger("snapshot"), start=int(time.time()), address="127.0.0.1",
+                                 ip="127.0.0.1", mirrors=mirrors, settings=settings)
+
+
+def fetch(lists, known=None):
+    """
+    Fetch the list like a port 10057 client that knows about list versions
+
+    :param lists: Rendered lists, see helpers.snapshot.list_snapshot.current()
+    :param known: Version the client has, if any
+    :return: Response, bytes
+    """
+    query = LIST_QUERY + (b" " + known if known else b"") + b"\r\n"
+    return conditional_list(lists["ascii"], lists["version"], query)
+
+
+def check_update(ls, name):
+    """
+    Rename a server while a render happens right before the change is written
+
+    :param ls: Fake list server object
+    :param name: New server name
+    :return: List of failure descriptions
+    """
+    seen = {}
+    query = helpers.jj2.query
+
+    def racing_query(sqlquery, *args, **kwargs):
+        if sqlquery.startswith("UPDATE servers") and "version" not in seen:
+            lists = ls.snapshot.current()
+            seen["version"] = bytes(lists["version"])
+            seen["stale"] = name.encode("ascii") not in lists["ascii"]
+        return query(sqlquery, *args, **kwargs)
+
+    server = helpers.jj2.jj2server("192.0.2.1:10052", create_if_unknown=False)
+    helpers.jj2.query = racing_query
+    try:
+        server.set("name", name)
+    finally:
+        helpers.jj2.query = query
+
+    return compare(ls, seen, name, "local update")
+
+
+def check_remote_update(ls, name):
+    """
+    Rename a server via ServerNet while a render happens after the change is written but before it is announced
+
+    :param ls: Fake list server object
+    :param name: New server name
+    :return: List of failure descriptions
+    """
+    seen = {}
+    transaction = helpers.jj2.transaction
+
+    @contextlib.contextmanager
+    def racing_transaction():
+        with transaction() as db:
+            yield db
+        lists = ls.snapshot.current()
+        seen["version"] = bytes(lists["version"])
+        seen["stale"] = name.encode("ascii") not in lists["ascii"]
+
+    helpers.jj2.transaction = racing_transaction
+    try:
+        helpers.jj2.update_remote_servers([{"id": "192.0.2.2:10052", "name": name}])
+    finally:
+        helpers.jj2.transaction = transaction
+
+    return compare(ls, seen, name, "remote update")
+
+
+def compare(ls, seen, name, label):
+    """
+    Check what clients see after a list change
+
+    :param ls: Fake list server object
+    :param seen: Version and whether the list was stale, as seen by a client during the change
+    :param name: New server name, which should be in the list now
+    :param label: Description of the change, for failure descriptions
+    :return: List of failure descriptions
+    """
+    failures = []
+    if "version" not in seen:
+        return ["%s: no list was rendered during the change" % label]
+
+    lists = ls.snapshot.current()
+    if name.encode("ascii") not in lists["ascii"]:
+        failures.append("%s: new name not in list after the change" % label)
+
+    if bytes(lists["version"]) == seen["version"] and seen["stale"]:
+        failures.append("%s: version %s was used for both the old and new list" % (label, seen["version"].decode()))
+
+    response = fetch(lists, seen["version"])
+    if response.startswith(LIST_UNCHANGED):
+        failures.append("%s: client with the list from during the change was told it is unchanged" % label)
+    elif name.encode("ascii") not in response:
+        failures.append("%s: client with the list from during the change did not get the new list" % label)
+
+    if not fetch(lists, bytes(lists["version"])).startswith(LIST_UNCHANGED):
+        failures.append("%s: client with the current list was sent it again" % label)
+
+    return failures
+
+
+def check(path):
+    """
+    Set up a database with two servers and check both ways a server can change
+
+    :param path: Database file
+    :return: List of failure descriptions
+    """
+    config.DATABASE = path
+    config.SNAPSHOT_TTL = 3600  # only re-render because the list changed, not because the snapshot expired
+
+    dbconn = sqlite3.connect(path, isolation_level=None)
+    schema.create_servers(dbconn)
+    now = int(time.time())
+    dbconn.executemany("INSERT INTO servers (id, ip, port, created, lifesign, remote, max, name) "
+                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       [("192.0.2.1:10052", "192.0.2.1", 10052, now, now, 0, 32, "Old local name"),
+                        ("192.0.2.2:10052", "192.0.2.2", 10052, now, now, 1, 32, "Old remote name")])
+    dbconn.close()
+
+    ls = fake_listserver()
+    ls.snapshot = snapshot.list_snapshot(ls=ls)
+    ls.snapshot.render(force=True)
+
+    return check_update(ls, "New local name") + check_remote_update(ls, "New remote name")
+
+
+with tempfile.TemporaryDirectory() as directory:
+    failures = check(str(pathlib.Path(directory).joinpath("servers.db")))
+
+for failure in failures:
+    print("FAIL %s" % failure)
+print("%i failure(s)" % len(failures))
+
+sys.exit(1 if failures else 0)
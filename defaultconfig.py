@@ -26,6 +26,90 @@ TICKSMAX = 10
 TICKSDECAY = 2
 TICKSMAXAGE = 86400
 
+# circuit breaking for unreachable mirrors: after MIRROR_FAILURES failed attempts in a row, nothing is sent to the
+# mirror for MIRROR_RETRY seconds, after which one message is tried again. Up to MIRROR_QUEUE messages that should not
+# be lost (e.g. ban changes) and could not be sent, whether sending them failed or was not tried, are kept and sent
+# once the mirror is reachable again
+MIRROR_FAILURES = 3
+MIRROR_RETRY = 60
+MIRROR_QUEUE = 100
+
+# admin sessions (see manage.py shell and batch) are closed after this many seconds without commands
+ADMIN_SESSION_TIMEOUT = 300
+
+# bulky ServerNet messages (e.g. imported banlists or full syncs) are split into messages of at most this many items
+SERVERNET_CHUNK = 1000
+
+# ServerNet messages of at least this many bytes are sent zlib-compressed to mirrors that support it (0 to never
+# compress). Small messages are not worth the effort
+SERVERNET_COMPRESS = 1024
+
+# server updates, banlist changes and the like are sent to at most this many mirrors directly; mirrors that support it
+# pass them on to the others, so the cost of sending them does not grow with the amount of mirrors. 0 to send them to
+# all mirrors directly. Relaying assumes all mirrors accept messages from each other, as they do when all mirrors are
+# in each other's mirror lists
+SERVERNET_FANOUT = 0
+
+# every STATE_INTERVAL seconds (and when quitting) the list server saves what it knows about mirrors and their servers
+# to STATE_FILE. If it is started again within STATE_MAX_AGE seconds, it continues from there and only asks mirrors for
+# what changed in the meantime, rather than for everything. Set STATE_INTERVAL to 0 to always start from scratch
+STATE_INTERVAL = 60
+STATE_FILE = "state.json"
+STATE_MAX_AGE = 3600
+
+# when the list server restarts itself, the new process reads the connections it takes over from this file
+HANDOVER_FILE = "handover.json"
+
+# this list server's own IP, as other list servers see it. If left empty it is looked up via an online API once the list
+# server has started (giving up after OWN_IP_TIMEOUT seconds), and the IP from last time is used until then
+OWN_IP = ""
+OWN_IP_TIMEOUT = 3
+
+# amount of recently received ServerNet message IDs to remember, to recognise duplicate messages
+SERVERNET_SEEN = 10000
+
+# rendered server lists are cached until the list changes, but no longer than SNAPSHOT_TTL seconds (uptimes, statistics
+# and timeouts change without the list changing). Lists published for worker processes and to PUBLISH_FOLDER are only
+# updated when the list changes, and for the sake of uptimes and the like every SNAPSHOT_REFRESH seconds
+SNAPSHOT_TTL = 1
+SNAPSHOT_REFRESH = 30
+
+# port 10057 clients may ask for the list only if it has changed since they last got it; this is how long to wait for
+# such a request before sending the full list as usual. 0 to not wait: requests that arrived along with the connection
+# are still answered, but clients that send nothing get the list without any delay
+LIST_QUERY_WAIT = 0
+
+# amount of worker processes serving the list ports (10053, 10055, 10057 and 10058); 0 to serve them from the list
+# server process itself. Workers need an OS that supports SO_REUSEPORT (e.g. Linux) and serve the list snapshot that
+# is published to SNAPSHOT_FILE
+WORKERS = 0
+SNAPSHOT_FILE = "snapshot.bin"
+
+# port to serve the server list, statistics and MOTD over HTTP at (/servers.json, /servers.txt, /stats.json and /motd),
+# for web sites; 0 to not serve them. HTTP caches may keep responses for HTTP_MAX_AGE seconds. Connections are kept open
+# for up to HTTP_MAX_REQUESTS requests, and closed after HTTP_KEEPALIVE seconds without one
+HTTP_PORT = 0
+HTTP_MAX_AGE = 5
+HTTP_MAX_REQUESTS = 100
+HTTP_KEEPALIVE = 15
+
+# port to stream server list changes at, as lines of JSON, for bots and web sites that want to follow the list as it
+# changes; 0 to not stream them. At most SUBSCRIBE_MAX subscribers are accepted. Subscribers that have more than
+# SUBSCRIBE_BUFFER events waiting to be sent, or take longer than SUBSCRIBE_SEND_TIMEOUT seconds to receive them, are
+# disconnected
+SUBSCRIBE_PORT = 0
+SUBSCRIBE_MAX = 100
+SUBSCRIBE_BUFFER = 1000
+SUBSCRIBE_SEND_TIMEOUT = 10
+
+# folder to publish the server list to as files (servers.txt, servers.bin and servers.json), for web sites and other
+# programs on the same machine that want to show the list without connecting to the list server. Files are replaced
+# whenever the list changes, and at least every SNAPSHOT_REFRESH seconds. Leave empty to not publish any files
+PUBLISH_FOLDER = ""
+
+# folder to write profiling results to, when profiling is started via the admin API (see manage.py profile-start)
+PROFILE_FOLDER = "profiles"
+
 # the next two values are for alerts
 # j2lsnek supports Slack and Discord webhooks
 # if a message of at least the log level WARNING is logged, it is additionally sent to any
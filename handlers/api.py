@@ -1,12 +1,21 @@
+import threading
 import datetime
 import pathlib
 import socket
+import csv
+import io
 import json
 import time
+import config
+import zlib
 
 from helpers.handler import port_handler
-from helpers.jj2 import jj2server
-from helpers.functions import all_mirrors, query, fetch_all, fetch_one
+from helpers.jj2 import jj2server, update_remote_servers
+from helpers.functions import query, fetch_all, fetch_one, transaction, lock_stats, get_banlist
+from helpers import profiler, banlist
+from helpers.snapshot import LIST_ORDER
+from helpers.servernet import introduction, decode_message, incomplete, chunks, SESSION_MAGIC, FRAME_HEADER, \
+    MAX_MESSAGE_SIZE, RELAY_ACTIONS
 from helpers.exceptions import ServerUnknownException
 
 
@@ -15,6 +24,16 @@ class servernet_handler(port_handler):
     Sync data between list servers
     """
     reload_mode = None
+    batch_actions = ("server", "add-banlist")
+
+    # filters for get-servers and get-banlist - parameter: (condition, type of value)
+    server_filters = {"origin": ("origin = ?", str), "mode": ("mode = ?", str),
+                      "version": ("substr(version, 1, length(?)) = ?", str), "players": ("players >= ?", int),
+                      "address": ("ip GLOB ?", str)}
+    banlist_filters = {"origin": ("origin = ?", str), "type": ("type = ?", str), "address": ("address GLOB ?", str)}
+    chunk_size = 100  # rows per chunk when sending long lists
+    framed = False  # True while handling an admin session, see session()
+    responded = False  # whether the response to the current session command has been ended
 
     def handle_data(self):
         """
@@ -34,23 +53,35 @@ class servernet_handler(port_handler):
                 self.end()
                 return
         elif self.port == 10056:
-            if self.ip not in all_mirrors() or self.ip == "127.0.0.1" or self.ip == self.ls.ip:
+            if self.ip not in self.ls.mirrors or self.ip == "127.0.0.1" or self.ip == self.ls.ip:
                 self.ls.log.warning("Unauthorized ServerNet connection from %s:%s" % (self.ip, self.port))
                 self.end()
                 return
-            query("UPDATE mirrors SET lifesign = ? WHERE address = ?", (int(time.time()), self.ip))
+            self.ls.mirrors.update_lifesign(self.ip)
 
         # receive API call
         while True:
             try:
-                self.buffer.extend(self.client.recv(2048))
+                data = self.client.recv(65536)
+                self.buffer.extend(data)
                 loops += 1
             except (socket.timeout, TimeoutError):
                 self.ls.log.error("ServerNet connection from %s timed out while receiving data" % self.key)
                 break
 
+            # admin interfaces may keep the connection open to send more commands
+            if self.port == 10059 and self.buffer[:len(SESSION_MAGIC)] == SESSION_MAGIC:
+                self.session()
+                return
+
+            # binary messages say how long they are, so there is no need to try decoding them before they are complete
+            if incomplete(self.buffer):
+                if not data or len(self.buffer) > MAX_MESSAGE_SIZE:
+                    break
+                continue
+
             try:
-                payload = json.loads(self.buffer.decode("ascii", "ignore"))
+                payload = decode_message(self.buffer)
                 break
             except ValueError:  # older python3s don't support json.JSONDecodeError
                 pass
@@ -66,8 +97,17 @@ class servernet_handler(port_handler):
             self.end()
             return
 
-        # same for incomplete call
-        if "action" not in payload or "data" not in payload or "origin" not in payload:
+        self.process_payload(payload)
+
+    def process_payload(self, payload):
+        """
+        Check and process a received API call
+
+        :param payload: API call, decoded
+        :return: Nothing
+        """
+        # incomplete call? then give up
+        if not isinstance(payload, dict) or "action" not in payload or "data" not in payload or "origin" not in payload:
             self.ls.log.error("ServerNet update received from %s, but JSON was incomplete" % self.ip)
             self.end()
             return
@@ -77,12 +117,28 @@ class servernet_handler(port_handler):
             self.end()
             return
 
+        # duplicate or replayed message? messages from older list servers have no ID, those are always processed
+        if "id" in payload and self.ls.message_log.seen(str(payload["origin"]), str(payload["id"])):
+            self.ls.log.info("Ignoring duplicate ServerNet message %s from %s" % (payload["id"], self.ip))
+            self.end()
+            return
+
+        # the list server that sent this may want us to pass it on, see SERVERNET_FANOUT; this is done first so the
+        # mirrors further down the line do not have to wait for it to be processed here
+        if self.port == 10056 and payload.get("relay") and "id" in payload and \
+                payload["action"] in RELAY_ACTIONS:
+            self.relay(payload)
+
         # payload data should be a list, though usually with 0 or 1 items
+        # bulky actions are applied in one go, others item by item
         try:
-            pass_on = []
-            for item in payload["data"]:
-                if self.process_data(payload["action"], item):
-                    pass_on.append(item)
+            if payload["action"] in self.batch_actions:
+                pass_on = self.process_batch(payload["action"], payload["data"])
+            else:
+                pass_on = []
+                for item in payload["data"]:
+                    if self.process_data(payload["action"], item):
+                        pass_on.append(item)
         except TypeError:
             self.ls.log.error("ServerNet update received from %s, but data was not iterable" % self.ip)
             self.end()
@@ -92,74 +148,201 @@ class servernet_handler(port_handler):
         self.ls.log.info("Received ServerNet update from %s: %s" % (self.ip, payload["action"]))
 
         # switch on the engine, pass it on
-        no_broadcast = ["hello", "request", "delist", "request-log", "send-log", "request-log-from"]
+        no_broadcast = ["hello", "request", "delist", "request-log", "send-log", "request-log-from", "profile-start",
+                        "profile-dump", "import-banlist", "export-banlist"]
         if self.port == 10059 and len(pass_on) > 0 and payload["action"] not in no_broadcast and \
                         payload["action"][0:4] != "get-" and payload["origin"] == "web":
-            self.ls.broadcast(action=payload["action"], data=pass_on, ignore=[self.ip])
+            for chunk in chunks(pass_on):
+                self.ls.broadcast(action=payload["action"], data=chunk, ignore=[self.ip])
 
         self.end()
 
         # was a reload command given?
         if self.reload_mode is not None:
             self.ls.reload(mode=self.reload_mode)
+            self.reload_mode = None  # admin sessions may send more commands afterwards
 
         return
 
-    def process_data(self, action, data):
+    def relay(self, payload):
         """
-        Process API calls
+        Pass a received message on to the mirrors the sending list server asked us to
 
-        :param action: Action/API call
-        :param data: List of items to process for this action
-        :return: True if call was succesful and can be passed on, False on failure or error
+        Only known mirrors are sent the message, so mirrors can not use this list server to connect to other hosts.
+
+        :param payload: API call, decoded, with a "relay" item listing the mirrors to pass it on to
+        :return: Nothing
         """
-        # server listings
-        if action == "server":
+        recipients = []
+        for address in payload["relay"]:
+            if address not in self.ls.mirrors or address in (self.ip, self.ls.ip, "localhost", "127.0.0.1"):
+                self.ls.log.warning("Not relaying message from mirror %s to %s: not another mirror" % (
+                    self.ip, address))
+                continue
+            recipients.append(address)
+
+        if recipients:
+            self.ls.broadcast(action=payload["action"], data=payload["data"], recipients=recipients,
+                              relay=(str(payload["origin"]), str(payload["id"])))
+
+    def session(self):
+        """
+        Handle an admin session: many API calls over one connection
+
+        Admin interfaces (see manage.py) that want to send more than one command start the connection with
+        SESSION_MAGIC. After that, each command is sent as a frame: its length as a 4-byte unsigned big-endian integer,
+        followed by the JSON API call. The response to each command is sent as one or more frames in the same format,
+        ended by an empty frame, so responses of any length can be read completely, and clients may send the next
+        commands without waiting for the response to the previous one. The session ends when the client closes the
+        connection or has been idle for ADMIN_SESSION_TIMEOUT seconds.
+
+        :return: Nothing
+        """
+        self.framed = True
+        self.buffer = self.buffer[len(SESSION_MAGIC):]
+        self.client.settimeout(1)  # so halting the list server does not have to wait for the client
+        self.ls.log.info("Admin session started from %s" % self.key)
+
+        commands = 0
+        while self.framed and self.looping:
+            frame = self.receive_frame()
+            if frame is None:
+                break
+
+            commands += 1
+            self.responded = False
             try:
-                server = jj2server(data["id"])
-            except KeyError:
-                self.ls.log.error("Received incomplete server data from ServerNet connection %s" % self.ip)
-                return False
+                payload = json.loads(frame.decode("ascii", "ignore"))
+            except ValueError:
+                self.error_msg("Could not parse command as JSON")
+                payload = None
+
+            if payload is not None:
+                self.process_payload(payload)
+
+            self.end()
+
+        self.ls.log.info("Admin session from %s ended after %i command(s)" % (self.key, commands))
+        self.framed = False
+        self.end()
+
+    def receive_frame(self):
+        """
+        Receive one frame from an admin session
+
+        :return: Frame contents, bytes, or None if the connection was closed, timed out or sent an invalid frame
+        """
+        idle = 0
+        while self.looping:
+            if len(self.buffer) >= FRAME_HEADER.size:
+                length = FRAME_HEADER.unpack(self.buffer[:FRAME_HEADER.size])[0]
+                if length > MAX_MESSAGE_SIZE:
+                    self.ls.log.error("Admin session from %s sent oversized frame" % self.key)
+                    return None
+
+                if len(self.buffer) >= FRAME_HEADER.size + length:
+                    frame = bytes(self.buffer[FRAME_HEADER.size:FRAME_HEADER.size + length])
+                    del self.buffer[:FRAME_HEADER.size + length]
+                    return frame
 
             try:
-                [server.set(key, data[key]) for key in data]
-            except IndexError:
-                self.ls.log.error(
-                    "Received incomplete server data from ServerNet connection %s (unknown field in %s)" % (
-                        self.ip, repr(data)))
-                server.forget()
-                return False
-            server.set("remote", 1)
+                data = self.client.recv(65536)
+            except (socket.timeout, TimeoutError):
+                idle += 1
+                if idle >= config.ADMIN_SESSION_TIMEOUT:
+                    return None
+                continue
+            except OSError:
+                return None
+
+            if not data:
+                return None
+
+            idle = 0
+            self.buffer.extend(data)
+
+        return None
 
-            # we can't do anything with partial data
-            if server.new and (server.get("ip") is None or server.get("port") is None):
-                # this means we got a server update before the server has been first 'registered'
-                # that could happen if an earlier all-server update is missed somehow
-                server.forget()
+    def process_batch(self, action, items):
+        """
+        Process API calls that may contain a lot of items at once
+
+        Full syncs can contain hundreds of servers or banlist entries; rather than processing them one by one, all
+        items are validated first and then applied in a single transaction.
+
+        :param action: Action/API call
+        :param items: List of items to process for this action
+        :return: List of items that were processed and can be passed on
+        """
+        items = list(items)
+
+        # server listings
+        if action == "server":
+            processed = update_remote_servers(items)
+            if len(processed) < len(items):
+                self.ls.log.error("Received %i incomplete server updates from ServerNet connection %s" % (
+                    len(items) - len(processed), self.ip))
 
         # ban list (and whitelist) entries
         elif action == "add-banlist":
-            if "origin" not in data:
-                data["origin"] = self.ls.address
-            try:
-                if not fetch_one(
-                        "SELECT * FROM banlist WHERE address = ? AND type = ? AND note = ? AND origin = ? AND reserved = ?",
-                        (data["address"], data["type"], data["note"], data["origin"], data["reserved"])):
-                    query("INSERT INTO banlist (address, type, note, origin, reserved) VALUES (?, ?, ?, ?, ?)",
-                               (data["address"], data["type"], data["note"], data["origin"], data["reserved"]))
-            except KeyError:
-                self.ls.log.error("Received incomplete banlist entry from ServerNet connection %s" % self.ip)
-                return False
+            processed = []
+            entries = {}
+            for item in items:
+                try:
+                    if "origin" not in item:
+                        item["origin"] = self.ls.address
+                    entries[(item["address"], item["type"], item["note"], item["origin"], item["reserved"])] = True
+                    processed.append(item)
+                except (KeyError, TypeError):
+                    self.ls.log.error("Received incomplete banlist entry from ServerNet connection %s" % self.ip)
+
+            if entries:
+                added = self.store_banlist(list(entries))
+                self.ls.log.info("Added %i banlist entries via ServerNet connection %s" % (len(added), self.ip))
+
+        # anything else has no batch processing, so process it item by item after all
+        else:
+            processed = [item for item in items if self.process_data(action, item)]
+
+        return processed
+
+    def store_banlist(self, entries):
+        """
+        Add banlist entries, in one transaction
+
+        :param entries: List of entries, tuples of banlist.FIELDS values, without duplicates
+        :return: List of entries that were not in the banlist yet, and have been added
+        """
+        now = int(time.time())
+        insert = "INSERT OR IGNORE INTO banlist (%s, updated) VALUES (?, ?, ?, ?, ?, ?)" % ", ".join(banlist.FIELDS)
+        added = []
+        with transaction() as db:
+            # entries that are already in the banlist are ignored by the unique index, leaving the row count at 0
+            for entry in entries:
+                if db.execute(insert, entry + (now,)).rowcount > 0:
+                    added.append(entry)
+
+        if added:
+            banlist.changed()
 
-            self.ls.log.info("Added banlist entry via ServerNet connection %s" % self.ip)
+        return added
 
+    def process_data(self, action, data):
+        """
+        Process API calls
+
+        :param action: Action/API call
+        :param data: List of items to process for this action
+        :return: True if call was succesful and can be passed on, False on failure or error
+        """
         # removal of ban/whitelist entries
-        elif action == "delete-banlist":
+        if action == "delete-banlist":
             if "origin" not in data:
                 data["origin"] = self.ls.address
             try:
                 fetch_one("DELETE FROM banlist WHERE address = ? AND type = ? AND note = ? AND origin = ? AND reserved = ?",
                                (data["address"], data["type"], data["note"], data["origin"], data["reserved"]))
+                banlist.changed()
             except KeyError:
                 self.ls.log.error("Received incomplete banlist deletion request from ServerNet connection %s" % self.ip)
                 return False
@@ -201,8 +384,11 @@ class servernet_handler(port_handler):
                 self.ls.log.error("'web' is a reserved name for mirrors, %s tried using it" % self.ip)
                 return False
 
-            query("INSERT INTO mirrors (name, address) VALUES (?, ?)", (data["name"], data["address"]))
-            self.ls.broadcast(action="hello", data=[{"from": self.ls.address}], recipients=[data["address"]])
+            query("INSERT INTO mirrors (name, address, updated) VALUES (?, ?, ?)",
+                  (data["name"], data["address"], int(time.time())))
+            self.ls.mirrors.load()
+            banlist.changed()
+            self.ls.broadcast(action="hello", data=[introduction(self.ls.address)], recipients=[data["address"]])
 
             self.ls.log.info("Added mirror %s via ServerNet connection %s" % (data["address"], self.ip))
 
@@ -218,6 +404,8 @@ class servernet_handler(port_handler):
                 return False
 
             query("DELETE FROM mirrors WHERE name = ? AND address = ?", (data["name"], data["address"]))
+            self.ls.mirrors.load()
+            banlist.changed()
 
             self.ls.log.info("Deleted mirror %s via ServerNet connection %s" % (data["address"], self.ip))
 
@@ -227,8 +415,8 @@ class servernet_handler(port_handler):
                 t = datetime.datetime.utcfromtimestamp(time.time() + 86400 * 3)
                 data["expires"] = t.strftime("%d-%m-%Y %H:%M")
             try:
-                timestamp = fetch_one("SELECT value FROM settings WHERE item = ?", ("motd-updated",))
-                if timestamp and int(timestamp["value"]) > int(data["motd-updated"]):
+                timestamp = self.ls.settings.get("motd-updated")
+                if timestamp and int(timestamp) > int(data["motd-updated"]):
                     self.ls.log.info("Received MOTD update from %s, but own MOTD was more recent" % self.ip)
                     return False
             except KeyError:
@@ -244,17 +432,31 @@ class servernet_handler(port_handler):
             query("UPDATE settings SET value = ? WHERE item = ?", (data["motd"], "motd"))
             query("UPDATE settings SET value = ? WHERE item = ?", (int(time.time()), "motd-updated"))
             query("UPDATE settings SET value = ? WHERE item = ?", (int(expires), "motd-expires"))
+            self.ls.settings.load()
 
             self.ls.log.info("Updated MOTD via ServerNet connection %s" % self.ip)
 
         # sync requests: send all data
         elif action == "request" or action == "hello":
+            # remember what the other server supports, e.g. compression, so we can use it from now on; every request
+            # announces all of them, so older list servers that announce nothing get plain JSON only, even if
+            # something at the same address supported more before
+            capabilities = data.get("capabilities")
+            self.ls.mirrors.set_capabilities(self.ip, capabilities if isinstance(capabilities, list) else [])
+
             # in case of "hello", also send a request for data to the other server
             if action == "hello":
-                self.ls.broadcast(action="request", data=[{"from": self.ls.address}], recipients=[self.ip])
+                self.ls.broadcast(action="request", data=[introduction(self.ls.address)], recipients=[self.ip])
 
             self.cleanup()  # removes stale servers, etc
 
+            # a list server that restarted with its data from before (see helpers.warmstart) only needs what changed
+            # since then; servers are always sent, since they change all the time anyway
+            try:
+                since = int(data.get("since", 0))
+            except (ValueError, TypeError):
+                since = 0
+
             # servers
             if "fragment" not in data or "servers" in data["fragment"]:
                 servers = fetch_all("SELECT * FROM servers WHERE players > 0 AND origin = ?", (self.ls.address,))
@@ -263,22 +465,25 @@ class servernet_handler(port_handler):
 
             # banlist
             if "fragment" not in data or "banlist" in data["fragment"]:
-                banlist = fetch_all("SELECT * FROM banlist")
-                self.ls.broadcast(action="add-banlist", data=[{key: ban[key] for key in ban.keys()} for ban in banlist],
-                              recipients=[self.ip])
+                bans = fetch_all("SELECT address, type, note, origin, reserved FROM banlist WHERE updated >= ?",
+                                 (since,))
+                if bans or not since:
+                    for chunk in chunks([{key: ban[key] for key in ban.keys()} for ban in bans]):
+                        self.ls.broadcast(action="add-banlist", data=chunk, recipients=[self.ip])
 
             # mirrors
             if "fragment" not in data or "mirrors" not in data["fragment"]:
-                mirrors = fetch_all("SELECT name, address FROM mirrors")
-                self.ls.broadcast(action="add-mirror",
-                              data=[{key: mirror[key] for key in mirror.keys()} for mirror in mirrors],
-                              recipients=[self.ip])
+                mirrors = fetch_all("SELECT name, address FROM mirrors WHERE updated >= ?", (since,))
+                if mirrors or not since:
+                    self.ls.broadcast(action="add-mirror",
+                                      data=[{key: mirror[key] for key in mirror.keys()} for mirror in mirrors],
+                                      recipients=[self.ip])
 
             # motd
-            if "fragment" not in data or "motd" in data["fragment"]:
-                settings = fetch_all("SELECT * FROM settings WHERE item IN (?, ?)", ("motd", "motd-updated"))
-                self.ls.broadcast(action="set-motd", data=[{item["item"]: item["value"] for item in settings}],
-                              recipients=[self.ip])
+            if ("fragment" not in data or "motd" in data["fragment"]) and \
+                    int(self.ls.settings.get("motd-updated") or 0) >= since:
+                settings = {item: self.ls.settings.get(item) for item in ("motd", "motd-updated")}
+                self.ls.broadcast(action="set-motd", data=[settings], recipients=[self.ip])
 
             self.ls.log.info("Sent sync data to ServerNet connection %s" % self.ip)
 
@@ -338,39 +543,55 @@ class servernet_handler(port_handler):
         # retrieve server list
         elif action == "get-servers":
             self.cleanup()
-            servers = fetch_all("SELECT * FROM servers ORDER BY prefer DESC, private ASC, (players = max) ASC, players DESC, created ASC")
-
-            self.msg(json.dumps([dict(servers[i]) for i, value in enumerate(servers)]))
+            if isinstance(data, dict) and not set(data.keys()) - {"compress"}:
+                # the full list is already rendered (and compressed) in the snapshot, no need to query it again
+                lists = self.ls.snapshot.current()
+                self.send_bytes(lists["serversz"] if data.get("compress") == "zlib" else lists["servers"])
+            else:
+                self.send_rows("servers", data, self.server_filters, LIST_ORDER)
 
         # retrieve banlist
         elif action == "get-banlist":
-            banlist = fetch_all("SELECT * FROM banlist")
+            self.send_rows("banlist", data, self.banlist_filters, "ORDER BY rowid")
 
-            self.msg(json.dumps([dict(banlist[i]) for i, value in enumerate(banlist)]))
+        # bulk banlist changes, for admin interfaces only: not passed on as is, but in manageable chunks
+        elif action == "import-banlist":
+            if self.port != 10059:
+                return False
 
-        # retrieve motd
-        elif action == "get-motd":
-            expires = fetch_one("SELECT * FROM settings WHERE item = ?", ("motd-expires",))
-            if not expires:
-                expires = time.time() + 10  # idk
-            else:
-                expires = expires["value"]
+            try:
+                entries, invalid = banlist.parse(data["entries"], data.get("format", "csv"), self.ls.address)
+            except (KeyError, TypeError, ValueError) as e:
+                self.msg(json.dumps({"error": "Could not read banlist entries (%s)" % e}))
+                return False
 
-            if time.time() > int(expires):
-                motd = {"value": ""}
-            else:
-                motd = fetch_one("SELECT * FROM settings WHERE item = ?", ("motd",))
+            added = self.store_banlist(entries)
+            get_banlist()  # rebuild index now rather than while checking the next connection
 
-            self.msg(json.dumps(motd["value"]))
+            for chunk in chunks([dict(zip(banlist.FIELDS, entry)) for entry in added]):
+                self.ls.broadcast(action="add-banlist", data=chunk)
+
+            self.ls.log.info("Imported %i banlist entries via ServerNet connection %s" % (len(added), self.ip))
+            self.msg(json.dumps({"added": len(added), "known": len(entries) - len(added), "invalid": invalid}))
+
+        elif action == "export-banlist":
+            if not isinstance(data, dict):
+                data = {}
+            data = {**data, "format": "lines" if data.get("format") == "jsonl" else "csv"}
+            self.send_rows("banlist", data, self.banlist_filters, "ORDER BY rowid")
+
+        # retrieve motd
+        elif action == "get-motd":
+            self.msg(json.dumps(self.ls.settings.motd))
 
         # retrieve motd
         elif action == "get-motd-expires":
-            motd = fetch_one("SELECT * FROM settings WHERE item = ?", ("motd-expires",))
+            expires = self.ls.settings.get("motd-expires", "")
 
-            if not motd or motd["value"] == "":
+            if expires == "":
                 self.msg(json.dumps(int(time.time())))
             else:
-                self.msg(json.dumps(motd["value"]))
+                self.msg(json.dumps(expires))
 
         # retrieve mirrors
         elif action == "get-mirrors":
@@ -378,8 +599,181 @@ class servernet_handler(port_handler):
 
             self.msg(json.dumps([dict(mirrors[i]) for i, value in enumerate(mirrors)]))
 
+        # retrieve runtime statistics, e.g. for benchmarking
+        elif action == "get-stats":
+            self.msg(json.dumps({"uptime": int(time.time()) - self.ls.start, "threads": threading.active_count(),
+                                 "database-lock": lock_stats(), "mirrors": self.ls.mirrors.sorted()}))
+
+        # start profiling this list server; only for local admins, profiling is not something to do network-wide
+        elif action == "profile-start":
+            if self.port != 10059:
+                return False
+
+            try:
+                profiler.start(mode=data.get("mode", "timing"), seconds=max(1, min(3600, int(data.get("seconds", 60)))),
+                               sample=float(data.get("sample", 1.0)))
+            except (ValueError, TypeError, AttributeError) as e:
+                self.msg(json.dumps({"error": str(e)}))
+                return False
+
+            self.ls.log.warning("Profiling started (%s) via admin API" % data.get("mode", "timing"))
+            self.msg(json.dumps({"profiling": True}))
+
+        # stop profiling and write results to disk
+        elif action == "profile-dump":
+            if self.port != 10059:
+                return False
+
+            result = profiler.dump({"database-lock": lock_stats(), "threads": threading.active_count()})
+            if result:
+                self.ls.log.info("Profiling results written to %s" % ", ".join(result["files"]))
+
+            self.msg(json.dumps(result))
+
         # ping, no response required, lifesign already updated above
         elif action == "ping":
             return False
 
         return True
+
+    def send_rows(self, table, data, filters, order):
+        """
+        Send rows from a table as JSON or CSV
+
+        Rows can be filtered with the parameters in `filters`, e.g. {"mode": "ctf", "address": "127.0.*"} (addresses
+        are matched with wildcards, like banlist entries). "limit" and "cursor" (amount of rows to skip) can be used to
+        page through the results. Rows are sent as a JSON array by default, as one JSON object per line if "format"
+        is "lines", in which case a final line with the cursor for the next page is added if there may be more rows,
+        or as CSV with a header if "format" is "csv".
+        Either way the response is sent in chunks rather than as one huge string; if "compress" is "zlib", as one
+        zlib stream.
+
+        :param table: Table to get rows from
+        :param data: Request parameters
+        :param filters: Filters that may be used, see servernet_handler.server_filters
+        :param order: ORDER BY clause
+        :return: Nothing
+        """
+        if not isinstance(data, dict):
+            data = {}
+
+        conditions = []
+        replacements = []
+        try:
+            for parameter, (condition, cast) in filters.items():
+                if parameter in data:
+                    conditions.append(condition)
+                    replacements += [cast(data[parameter])] * condition.count("?")
+
+            limit = int(data.get("limit", -1))
+            cursor = max(0, int(data.get("cursor", 0)))
+        except (ValueError, TypeError):
+            self.msg(json.dumps({"error": "Invalid filter value"}))
+            return
+
+        # not escaping the table name and conditions is okay since they never come from the request itself
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        rows = fetch_all("SELECT * FROM %s%s %s LIMIT ? OFFSET ?" % (table, where, order),
+                         tuple(replacements) + (limit, cursor))
+
+        lines = data.get("format") == "lines"
+        as_csv = data.get("format") == "csv"
+        compressor = zlib.compressobj() if data.get("compress") == "zlib" else None
+        if not lines and not as_csv and self.send_chunk("[", compressor) is False:
+            return
+
+        for offset in range(0, len(rows), self.chunk_size):
+            if as_csv:
+                output = io.StringIO()
+                writer = csv.writer(output, lineterminator="\n")
+                if offset == 0 and rows:
+                    writer.writerow(rows[0].keys())
+                writer.writerows([tuple(row) for row in rows[offset:offset + self.chunk_size]])
+                if self.send_chunk(output.getvalue(), compressor) is False:
+                    return
+                continue
+
+            chunk = [json.dumps(dict(row)) for row in rows[offset:offset + self.chunk_size]]
+            if lines:
+                chunk = "".join([row + "\n" for row in chunk])
+            else:
+                chunk = ("," if offset > 0 else "") + ",".join(chunk)
+
+            if self.send_chunk(chunk, compressor) is False:
+                return
+
+        if not lines and not as_csv:
+            self.send_chunk("]", compressor)
+        elif lines and limit >= 0 and len(rows) == limit:
+            self.send_chunk(json.dumps({"cursor": cursor + limit}) + "\n", compressor)
+
+        if compressor:
+            self.send_bytes(compressor.flush())
+
+    def send_chunk(self, string, compressor=None):
+        """
+        Send part of a response, compressing it first if needed
+
+        :param string: Text to send, will be encoded as ascii
+        :param compressor: zlib compression object, if the response is to be compressed
+        :return: Return result of self.msg() or self.send_bytes()
+        """
+        if not compressor:
+            return self.msg(string)
+
+        return self.send_bytes(compressor.compress(string.encode("ascii")))
+
+    def send_bytes(self, data):
+        """
+        Send bytes to connection
+
+        Like msg(), for responses that are already encoded
+
+        :param data: Bytes to send
+        :return: Return result of socket.sendall()
+        """
+        try:
+            if not self.framed:
+                return self.client.sendall(data)
+            elif data:
+                return self.client.sendall(FRAME_HEADER.pack(len(data)) + data)
+        except Exception:
+            self.framed = False
+            self.end()
+            return False
+
+    def msg(self, string):
+        """
+        Send text message to connection
+
+        See port_handler.msg(); in admin sessions, the message is sent as a frame.
+
+        :param string: Text message, will be encoded as ascii
+        :return: Return result of self.send_bytes()
+        """
+        if not self.framed:
+            return port_handler.msg(self, string)
+
+        return self.send_bytes(string.encode("ascii", "ignore"))
+
+    def end(self):
+        """
+        End the response
+
+        Closes the connection, except in admin sessions, where it ends the response to the current command with an
+        empty frame, and the connection stays open for the next command.
+
+        :return: Return result of socket.close() or socket.sendall()
+        """
+        if not self.framed:
+            return port_handler.end(self)
+
+        if self.responded:
+            return None
+
+        self.responded = True
+        try:
+            return self.client.sendall(FRAME_HEADER.pack(0))
+        except Exception:
+            self.framed = False
+            return port_handler.end(self)
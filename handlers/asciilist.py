@@ -1,7 +1,8 @@
-import time
+import socket
+import config
 
 from helpers.handler import port_handler
-from helpers.functions import fetch_all
+from helpers.protocol import conditional_list, LIST_QUERY_SIZE
 
 
 class ascii_handler(port_handler):
@@ -12,30 +13,24 @@ class ascii_handler(port_handler):
     def handle_data(self):
         """
         Show a nicely formatted server list and immediately close connection
+
+        Clients may ask for the list only if it has changed, see helpers.protocol.conditional_list(). Those that do
+        should do so right after connecting: unless LIST_QUERY_WAIT is set, we don't wait for a request at all, so
+        legacy clients get the list as fast as always, and only requests that have already arrived are seen.
         """
         self.ls.log.info("Sending ascii server list to %s" % self.ip)
 
-        self.cleanup()
-        servers = fetch_all(
-            "SELECT * FROM servers WHERE max > 0 ORDER BY prefer DESC, private ASC, (players = max) ASC, players DESC, created ASC")
-
-        asciilist = ""
-
-        server_count = 0
-        for server in servers:
-            try:
-                entry = server['ip'] + ':' + str(server['port']) + ' '  # ip:port
-                entry += 'local ' if server['remote'] == 0 else 'mirror '  # 'local' or 'mirror'
-                entry += 'public ' if server['private'] == 0 else 'private '  # 'public' or 'private'
-                entry += server['mode'] + ' '  # game mode
-                entry += server['version'][:6].ljust(6, ' ') + ' '  # version
-                entry += str(int(time.time()) - int(server['created'])) + ' '  # uptime in seconds
-                entry += '[' + str(server['players']) + '/' + str(server['max']) + '] '  # [players/max]
-                entry += server['name'] + "\r\n"  # server name
-                asciilist += entry
-                server_count += 1
-            except TypeError:
-                continue
-
-        self.msg(asciilist)
+        timeout = self.client.gettimeout()
+        self.client.settimeout(config.LIST_QUERY_WAIT if config.LIST_QUERY_WAIT > 0 else 0)
+        try:
+            query = self.client.recv(LIST_QUERY_SIZE)
+        except (socket.timeout, TimeoutError, BlockingIOError, ConnectionError):
+            query = None
+        self.client.settimeout(timeout)
+
+        try:
+            lists = self.ls.snapshot.current()
+            self.client.sendall(conditional_list(lists["ascii"], lists["version"], query, lists["asciiz"]))
+        except (socket.timeout, TimeoutError, ConnectionError):
+            pass
         self.end()
@@ -0,0 +1,207 @@
+import socket
+import config
+import zlib
+import time
+
+from helpers.handler import port_handler
+
+# path: (snapshot section, compressed section if any, content type); None as section means the MOTD
+RESOURCES = {
+    "/servers.json": ("json", "jsonz", "application/json"),
+    "/servers.txt": ("ascii", "asciiz", "text/plain; charset=us-ascii"),
+    "/stats.json": ("statjson", None, "application/json"),
+    "/motd": (None, None, "text/plain; charset=us-ascii")
+}
+
+STATUS = {200: "OK", 304: "Not Modified", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+          431: "Request Header Fields Too Large"}
+
+MAX_REQUEST_SIZE = 8192  # request line plus headers; this endpoint has no use for anything bigger
+
+
+class http_handler(port_handler):
+    """
+    Serve server lists, statistics and the MOTD over HTTP
+
+    For web sites and other programs that would rather speak HTTP than the list server's own protocols. Everything is
+    served from the list snapshot (see helpers.snapshot) and the settings cache, so requests never touch the database.
+    Responses carry an ETag and Cache-Control header, so HTTP caches in front of the list server can take most of the
+    load, and connections are kept open for more requests unless the client says otherwise.
+    """
+    etags = {}  # section: (body, etag) for the bodies last served, shared by all connections
+    versioned = ("json", "jsonz", "ascii", "asciiz")  # sections tagged by list version rather than by contents
+
+    def handle_data(self):
+        """
+        Answer requests until the client closes the connection, or is idle for too long
+
+        :return: Nothing
+        """
+        self.client.settimeout(1)  # so halting the list server does not have to wait for the client
+        self.buffer = bytearray()
+        served = 0
+
+        while self.looping and served < config.HTTP_MAX_REQUESTS:
+            request = self.receive_request()
+            if request is None:
+                break
+
+            served += 1
+            if not self.respond(request, last=served >= config.HTTP_MAX_REQUESTS):
+                break
+
+        self.ls.log.info("Served %i HTTP request(s) to %s" % (served, self.ip))
+        self.end()
+
+    def receive_request(self):
+        """
+        Receive the head of one request
+
+        Requests with a body are not supported, since nothing here needs one.
+
+        :return: Request line and headers as a string, or None if the connection closed, timed out or sent nonsense
+        """
+        idle = 0
+        while self.looping:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end >= 0:
+                request = bytes(self.buffer[:end]).decode("ascii", "ignore")
+                del self.buffer[:end + 4]
+                return request
+
+            if len(self.buffer) > MAX_REQUEST_SIZE:
+                self.send_response(431, "text/plain", b"Request too large\n", keep_alive=False)
+                return None
+
+            try:
+                data = self.client.recv(4096)
+            except (socket.timeout, TimeoutError):
+                idle += 1
+                if idle >= config.HTTP_KEEPALIVE:
+                    return None
+                continue
+            except OSError:
+                return None
+
+            if not data:
+                return None
+
+            idle = 0
+            self.buffer.extend(data)
+
+        return None
+
+    def respond(self, request, last=False):
+        """
+        Answer a request
+
+        :param request: Request line and headers
+        :param last: Whether this is the last request that will be answered on this connection
+        :return: Whether the connection may be used for another request
+        """
+        lines = request.split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ")
+        except ValueError:
+            self.send_response(400, "text/plain", b"Bad request\n", keep_alive=False)
+            return False
+
+        headers = {}
+        for line in lines[1:]:
+            name, separator, value = line.partition(":")
+            if separator:
+                headers[name.strip().lower()] = value.strip()
+
+        # HTTP/1.1 connections stay open unless closed explicitly, HTTP/1.0 ones only if asked to
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        keep_alive = keep_alive and not last
+
+        path = target.split("?")[0]
+        if path not in RESOURCES:
+            return self.send_response(404, "text/plain", b"Not found\n", keep_alive=keep_alive, head=method == "HEAD")
+
+        if method not in ("GET", "HEAD"):
+            # the request may have a body, which is not read, so the connection can not be used any further
+            return self.send_response(405, "text/plain", b"Method not allowed\n", keep_alive=False,
+                                      extra={"Allow": "GET, HEAD"})
+
+        section, compressed, content_type = RESOURCES[path]
+        encodings = [encoding.split(";")[0].strip() for encoding in headers.get("accept-encoding", "").split(",")]
+        deflate = compressed is not None and "deflate" in encodings
+
+        list_version = None
+        if section is None:
+            body = self.ls.settings.motd_payload
+        else:
+            lists = self.ls.snapshot.current()
+            body = lists[compressed] if deflate else lists[section]
+            list_version = lists["version"]
+
+        etag = self.etag(compressed if deflate else (section or "motd"), body, list_version)
+        extra = {"ETag": etag, "Cache-Control": "public, max-age=%i" % config.HTTP_MAX_AGE,
+                 "Access-Control-Allow-Origin": "*"}
+        if compressed:
+            extra["Vary"] = "Accept-Encoding"
+        if deflate:
+            extra["Content-Encoding"] = "deflate"
+
+        if etag in [tag.strip() for tag in headers.get("if-none-match", "").split(",")]:
+            return self.send_response(304, content_type, b"", keep_alive=keep_alive, extra=extra, head=True)
+
+        self.ls.log.info("Sending %s over HTTP to %s" % (path, self.ip))
+        return self.send_response(200, content_type, body, keep_alive=keep_alive, extra=extra, head=method == "HEAD")
+
+    def etag(self, section, body, list_version=None):
+        """
+        Get the entity tag for a response body
+
+        Server lists are re-rendered every SNAPSHOT_TTL seconds with a new timestamp and uptimes even if no server
+        changed, so they are tagged with the list version instead, like port 10057 does for conditional fetches.
+        Other bodies only change when the snapshot is rendered again, so their tag is computed once per body.
+
+        :param section: Snapshot section the body belongs to
+        :param body: Response body, bytes
+        :param list_version: Version of the list the body was rendered for, bytes
+        :return: Entity tag, quoted
+        """
+        if section in self.versioned and list_version is not None:
+            return '"%s-%s"' % (section, bytes(list_version).decode("ascii"))
+
+        cached = self.etags.get(section)
+        if cached and cached[0] is body:
+            return cached[1]
+
+        etag = '"%s-%x-%08x"' % (section, len(body), zlib.crc32(body))
+        self.etags[section] = (body, etag)
+        return etag
+
+    def send_response(self, status, content_type, body, keep_alive=True, extra=None, head=False):
+        """
+        Send a response
+
+        :param status: HTTP status code
+        :param content_type: Content type of the body
+        :param body: Response body, bytes
+        :param keep_alive: Whether the connection stays open afterwards
+        :param extra: Dictionary of extra headers
+        :param head: Send only the headers (for HEAD requests and 304 responses)
+        :return: Whether the connection stays open
+        """
+        headers = {"Date": time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime()), "Server": "j2lsnek",
+                   "Content-Type": content_type, "Content-Length": str(len(body)),
+                   "Connection": "keep-alive" if keep_alive else "close"}
+        if extra:
+            headers.update(extra)
+        if status == 304:
+            del headers["Content-Length"]
+
+        response = "HTTP/1.1 %i %s\r\n" % (status, STATUS[status])
+        response += "".join(["%s: %s\r\n" % (name, value) for name, value in headers.items()]) + "\r\n"
+
+        try:
+            self.client.sendall(response.encode("ascii", "ignore") + (b"" if head else body))
+        except (socket.timeout, TimeoutError, OSError):
+            return False
+
+        return keep_alive
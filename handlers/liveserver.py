@@ -2,17 +2,38 @@ import socket
 import config
 import time
 
-from helpers.functions import decode_mode, decode_version
+from helpers.protocol import decode_listing, decode_update, LISTING_SIZE
 
 from helpers.jj2 import jj2server
 from helpers.handler import port_handler
 from helpers.functions import banned, whitelisted, fetch_one
+from helpers import events
 
 
 class server_handler(port_handler):
     """
     Handle server status updates
     """
+    new = True  # server is always new when connection is opened...
+    resumed = False  # ...unless it was handed over by a handler from before reloading
+
+    def resume(self, session):
+        """
+        Continue a session handed over by a handler from before reloading
+
+        :param session: Session, see session()
+        :return: Nothing
+        """
+        self.new = session["new"]
+        self.resumed = True
+
+    def session(self):
+        """
+        Get what is needed to resume this connection after reloading
+
+        :return: Dictionary with client socket, address and whether the server has been listed yet
+        """
+        return {"client": self.client, "address": list(self.address), "new": self.new}
 
     def handle_data(self):
         """
@@ -20,17 +41,28 @@ class server_handler(port_handler):
         """
 
         server = jj2server(self.key)
-        new = True  # server is always new when connection is opened
-        self.client.settimeout(10)  # time out in 10 seconds unless further data is received
-        self.ls.log.info("Server connected from %s" % self.key)
+        new = self.new
+        timeout = 10 if new else 32  # time out in 10 seconds unless further data is received
+        last_data = time.time()
+        self.ls.log.info("Server %s from %s" % ("resumed" if self.resumed else "connected", self.key))
         broadcast = False
+        listed = False  # whether the server was listed since the last broadcast
+
+        # recv() is only allowed to block for a second at a time, so the handler notices when it is to hand over the
+        # connection for reloading
+        self.client.settimeout(1)
 
         # keep connection open until server disconnects (or times out)
         while self.looping:
             try:
                 data = self.client.recv(1024)
+                last_data = time.time()
             except (socket.timeout, TimeoutError):
+                if time.time() - last_data < timeout:
+                    continue
+
                 # if no lifesign for 30 seconds, ping to see if the server is still alive
+                last_data = time.time()
                 data = None
                 try:
                     ping = self.client.send(bytearray([0]))
@@ -52,7 +84,7 @@ class server_handler(port_handler):
                 break
 
             # new server wants to get listed
-            if new and data and len(data) == 42:
+            if new and data and len(data) == LISTING_SIZE:
                 # check for spamming
                 other = fetch_one("SELECT COUNT(*) FROM servers WHERE ip = ?", (self.ip,))[0]
                 if other >= config.MAXSERVERS and not whitelisted(self.ip):
@@ -61,67 +93,51 @@ class server_handler(port_handler):
                     break
 
                 self.ls.log.info("Server listed from %s" % self.key)
-                self.client.settimeout(32)  # should have some form of communication every 30 seconds, with some leeway
+                timeout = 32  # should have some form of communication every 30 seconds, with some leeway
 
                 new = False
+                self.new = False
 
-                port = int.from_bytes(data[0:2], byteorder="little")
-                exists = fetch_one("SELECT COUNT(*) FROM servers WHERE ip = ? AND port = ?", (self.ip, port))[0]
+                listing = decode_listing(data)
+                exists = fetch_one("SELECT COUNT(*) FROM servers WHERE ip = ? AND port = ?", (self.ip, listing["port"]))[0]
                 if exists > 0:
-                    self.ls.log.warning("Server %s tried to connect on port %s, but port already in use; refusing" % (self.ip, port))
+                    self.ls.log.warning("Server %s tried to connect on port %s, but port already in use; refusing" % (self.ip, listing["port"]))
                     self.error_msg("Reconnecting too fast: please wait a few seconds before relisting")
                     break
 
-                name = server.validate_name(data[2:32].decode("ascii", "ignore"), self.ip,
-                                            "Server on %s" % self.ip)
-
-                players = int(data[35])
-                max_players = int(data[36])
-                flags = int(data[37])
-                version = data[38:]
-
-                mode = (flags >> 1) & 31
+                name = server.validate_name(listing["name"], self.ip, "Server on %s" % self.ip)
 
                 server.set("name", name)
-                server.set("private", flags & 1)
-                server.set("plusonly", flags & 128)
+                server.set("private", listing["private"])
+                server.set("plusonly", listing["plusonly"])
                 server.set("ip", self.ip)
-                server.set("port", port)
-                server.set("players", players)
-                server.set("max", max_players)
-                server.set("mode", decode_mode(mode))
-                server.set("version", decode_version(version))
+                server.set("port", listing["port"])
+                server.set("players", listing["players"])
+                server.set("max", listing["max"])
+                server.set("mode", listing["mode"])
+                server.set("version", listing["version"])
                 server.set("origin", self.ls.address)
 
                 broadcast = True
+                listed = True
 
             # existing server sending an update
             elif not new and data and (len(data) == 2 or data[0] == 0x02):
                 broadcast = True
-                if data[0] == 0:
-                    if server.get("players") != data[1]:
-                        self.ls.log.info("Updating player count for server %s" % self.key)
-                        server.set("players", data[1])
-                    else:
-                        self.ls.log.info("Received ping from server %s" % self.key)
-                        server.update_lifesign()
-                elif data[0] == 0x01:
-                    self.ls.log.info("Updating game mode for server %s" % self.key)
-                    server.set("mode", decode_mode(int(data[1])))
-                elif data[0] == 0x02:
+                try:
+                    field, value = decode_update(data)
+                except ValueError:
+                    field, value = None, None  # unknown update, ignore
+
+                if field == "players" and server.get("players") == value:
+                    self.ls.log.info("Received ping from server %s" % self.key)
+                    server.update_lifesign()
+                elif field == "name":
                     self.ls.log.info("Updating server name for server %s" % self.key)
-                    name = server.validate_name(data[1:33].decode("ascii", "ignore"), self.ip,
-                                                "Server on %s" % self.ip)
-                    server.set("name", name)
-                elif data[0] == 0x03:
-                    self.ls.log.info("Updating max players for server %s" % self.key)
-                    server.set("max", data[1])
-                elif data[0] == 0x04:
-                    self.ls.log.info("Updating public/private for server %s" % self.key)
-                    server.set("private", data[1] & 1)
-                elif data[0] == 0x05:
-                    self.ls.log.info("Updating plusonly for server %s" % self.key)
-                    server.set("plusonly", data[1] & 1)
+                    server.set("name", server.validate_name(value, self.ip, "Server on %s" % self.ip))
+                elif field:
+                    self.ls.log.info("Updating %s for server %s" % (field, self.key))
+                    server.set(field, value)
 
             # server wants to be delisted, goes offline or sends strange data
             else:
@@ -141,10 +157,20 @@ class server_handler(port_handler):
 
             # broadcast updates to connected mirrors
             if broadcast:
-                self.ls.broadcast(action="server", data=[server.flush_updates()])
+                updates = server.flush_updates()
+                self.ls.broadcast(action="server", data=[updates])
+                events.server(updates, listed=listed)
+                listed = False
 
             time.sleep(config.MICROSLEEP)
 
+        else:
+            # list server is reloading rather than the server disconnecting: leave the connection open and the server
+            # listed, so it can be resumed
+            if self.handover:
+                self.ls.sessions.append(self.session())
+                return
+
         # server presumed dead, remove from database
         server.forget()
 
@@ -1,7 +1,6 @@
-import time
+import socket
 
 from helpers.handler import port_handler
-from helpers.functions import fetch_one
 
 
 class motd_handler(port_handler):
@@ -12,18 +11,14 @@ class motd_handler(port_handler):
     def handle_data(self):
         """
         Return MOTD and immediately close connection
+
+        The MOTD is served from the settings cache, which is already encoded and cleared when the MOTD expires
         """
         self.ls.log.info("Sending MOTD to %s" % self.ip)
 
-        motd = fetch_one("SELECT value FROM settings WHERE item = ?", ('motd',))
-        expires = fetch_one("SELECT value FROM settings WHERE item = ?", ('motd-expires',))
-
-        if not expires:
-            expires = {"value": time.time() + 10}
-
-        if motd and motd != "" and int(time.time()) < int(expires["value"]):
-            self.msg(motd["value"] + "\n")
-        else:
-            self.msg("")
+        try:
+            self.client.sendall(self.ls.settings.motd_payload)
+        except (socket.timeout, TimeoutError, ConnectionError):
+            pass
 
         self.end()
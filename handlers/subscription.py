@@ -0,0 +1,90 @@
+import socket
+import config
+import json
+import time
+
+from helpers.handler import port_handler
+from helpers import events
+
+HEARTBEAT = 30  # seconds without events after which a heartbeat is sent, so dead connections are noticed
+
+
+class subscription_handler(port_handler):
+    """
+    Stream server list changes to subscribers
+
+    For bots and web sites that want to show the server list as it changes, without polling for it. On connecting, the
+    subscriber receives one line of JSON with the current server list and MOTD, and after that a line of JSON per
+    change: {"event": "listed", "id": ..., "server": {...}} when a server is listed, "updated" with only the changed
+    properties when it changes, {"event": "delisted", "id": ...} when it is delisted and {"event": "motd", "motd": ...}
+    when the MOTD changes. Subscribers that can not keep up are disconnected: those that fall too many events behind
+    after an "overflow" event, those that take too long to receive a line without one, since part of the line may
+    already have been sent. They can connect again to get a fresh snapshot.
+    """
+
+    def handle_data(self):
+        """
+        Send snapshot and events until the subscriber disconnects or falls behind
+
+        :return: Nothing
+        """
+        # subscribe before taking the snapshot, so no change can fall between the two; changes that are already part
+        # of the snapshot may be sent again as events, which does no harm
+        subscriber = events.subscribe()
+        if not subscriber:
+            self.ls.log.warning("Refusing subscription from %s: too many subscribers" % self.ip)
+            self.send_lines([b'{"event": "error", "error": "Too many subscribers"}\n'])
+            self.end()
+            return
+
+        self.ls.log.info("Subscription from %s" % self.ip)
+
+        # a subscriber that takes this long to receive a line is too slow to keep up anyway
+        self.client.settimeout(config.SUBSCRIBE_SEND_TIMEOUT)
+
+        lists = self.ls.snapshot.current()
+        snapshot = b'{"event": "snapshot", "servers": ' + lists["servers"] + b', "motd": ' + json.dumps(
+            self.ls.settings.motd).encode("ascii") + b'}\n'
+
+        sent = 0
+        last_sent = time.time()
+        connected = self.send_lines([snapshot])
+
+        try:
+            while connected and self.looping:
+                lines = subscriber.pull(timeout=1)  # not longer, so halting does not have to wait for events
+
+                if subscriber.overflowed:
+                    self.ls.log.warning("Subscriber %s fell behind; disconnecting" % self.ip)
+                    self.send_lines(lines + [b'{"event": "overflow"}\n'])
+                    break
+
+                if not lines and time.time() - last_sent >= HEARTBEAT:
+                    lines = [b'{"event": "heartbeat"}\n']
+
+                if lines:
+                    connected = self.send_lines(lines)
+                    sent += len(lines)
+                    last_sent = time.time()
+        finally:
+            events.unsubscribe(subscriber)
+
+        self.ls.log.info("Subscription from %s ended after %i line(s)" % (self.ip, sent))
+        self.end()
+
+    def send_lines(self, lines):
+        """
+        Send lines to the subscriber
+
+        :param lines: List of lines, bytes
+        :return: Whether the subscriber is still connected
+        """
+        try:
+            self.client.sendall(b"".join(lines))
+        except (socket.timeout, TimeoutError):
+            self.ls.log.warning("Subscriber %s took too long to receive events; disconnecting" % self.ip)
+            return False
+        except OSError:
+            return False
+
+        return True
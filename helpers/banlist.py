@@ -0,0 +1,224 @@
+import threading
+import fnmatch
+import json
+import csv
+import io
+import re
+
+# columns that make up a banlist entry, in the order used for CSV files without a header
+FIELDS = ("address", "type", "note", "origin", "reserved")
+TYPES = ("ban", "whitelist", "prefer", "unprefer")
+
+# bumped whenever the banlist or the mirror list changes, so the index knows when it is outdated
+version = 0
+version_lock = threading.Lock()
+
+
+def changed():
+    """
+    Mark the banlist as changed
+
+    To be called whenever banlist entries or mirrors are added or deleted.
+
+    :return: Nothing
+    """
+    global version
+
+    with version_lock:
+        version += 1
+
+
+def parse(text, format, origin):
+    """
+    Parse banlist entries from a CSV or JSONL file
+
+    CSV files may start with a header naming the columns (see FIELDS); without one, columns are taken to be in the
+    order of FIELDS. JSONL files have one JSON object per line. Only the address is required: type defaults to "ban",
+    origin to the given origin, and note and reserved to nothing. Duplicate entries are only returned once.
+
+    :param text: File contents
+    :param format: "csv" or "jsonl"
+    :param origin: Origin for entries that do not have one
+    :return: Tuple: list of entries (tuples of FIELDS values), amount of lines that were not valid entries
+    """
+    if format == "jsonl":
+        items = []
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+    elif format == "csv":
+        rows = [row for row in csv.reader(io.StringIO(text)) if row]
+        header = FIELDS
+        if rows and "address" in [column.strip().lower() for column in rows[0]]:
+            header = [column.strip().lower() for column in rows.pop(0)]
+        items = [dict(zip(header, row)) for row in rows]
+    else:
+        raise ValueError("Unknown format %s" % format)
+
+    entries = {}
+    invalid = 0
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("address"), str) or not item["address"].strip():
+            invalid += 1
+            continue
+
+        entry = (item["address"].strip(), item.get("type") or "ban", item.get("note") or "", item.get("origin") or origin,
+                 item.get("reserved") or "")
+        if entry[1] not in TYPES or not all([isinstance(value, str) for value in entry]):
+            invalid += 1
+            continue
+
+        entries[entry] = True
+
+    return list(entries), invalid
+
+
+def is_literal(mask):
+    """
+    Check if a mask is a plain value rather than a wildcard pattern
+
+    :param mask: Mask, e.g. "127.0.0.1" or "127.0.*"
+    :return: True if the mask has no wildcards in it
+    """
+    return not any(character in mask for character in "*?[")
+
+
+def compile_masks(masks):
+    """
+    Compile wildcard masks into one matcher
+
+    Masks work like fnmatch patterns, but are translated into a regular expression only once, and all of them are
+    checked in one go.
+
+    :param masks: List of masks
+    :return: Function that returns a match object if a value matches any of the masks, or None if there are no masks
+    """
+    if not masks:
+        return None
+
+    return re.compile("|".join([fnmatch.translate(mask) for mask in masks])).match
+
+
+class ban_index:
+    """
+    Banlist, prepared for fast lookups
+
+    Checking a banlist entry used to mean querying the whole banlist and having fnmatch turn each mask into a regular
+    expression again, for every connection and every server name. The index does that once per banlist change: plain
+    addresses and names go into sets and dictionaries, and masks with wildcards are compiled into one regular expression
+    per type, so a check takes about the same time no matter how many entries there are.
+    """
+
+    def __init__(self, mirrors, entries, version=-1):
+        """
+        Build index
+
+        :param mirrors: List of mirror addresses
+        :param entries: List of banlist entries, dictionaries with at least address, type and reserved keys
+        :param version: Banlist version the index was built for
+        """
+        self.version = version
+        self.mirrors = frozenset(mirrors)
+        self.addresses = {}  # type: set of plain addresses
+        self.masks = {}  # type: matcher for addresses with wildcards
+        self.ordered = {}  # prefer/unprefer: list of (address matcher, name matcher) in banlist order
+        self.reserved_names = {}  # plain reserved name: list of address matchers allowed to use it
+        self.reserved_masks = []  # (name matcher, address matcher) for reserved names with wildcards
+        self.reserved_any = None  # matcher for all reserved names with wildcards
+
+        masks = {}
+        reserved_masks = []
+        for entry in entries:
+            type = entry["type"]
+            address = entry["address"]
+            names = (entry["reserved"] or "").lower()
+            reserved = names.replace(" ", "")
+
+            if is_literal(address):
+                self.addresses.setdefault(type, set()).add(address)
+            else:
+                masks.setdefault(type, []).append(address)
+
+            # compiling a matcher per entry is slow for big banlists, so only do so for entries that need one
+            if type == "prefer" or type == "unprefer":
+                self.ordered.setdefault(type, []).append((compile_masks([address]),
+                                                          compile_masks([names]) if names else None))
+
+            if type == "whitelist" and reserved:
+                address_matcher = compile_masks([address])
+                if is_literal(reserved):
+                    self.reserved_names.setdefault(reserved, []).append(address_matcher)
+                else:
+                    self.reserved_masks.append((compile_masks([reserved]), address_matcher))
+                    reserved_masks.append(reserved)
+
+        self.masks = {type: compile_masks(type_masks) for type, type_masks in masks.items()}
+        self.reserved_any = compile_masks(reserved_masks)
+
+    def matches(self, address, type):
+        """
+        Check if an address matches any banlist entry of a type
+
+        :param address: IP address
+        :param type: Entry type, e.g. "ban" or "whitelist"
+        :return: True if it matches
+        """
+        if address in self.addresses.get(type, ()):
+            return True
+
+        matcher = self.masks.get(type)
+        return bool(matcher and matcher(address))
+
+    def banned(self, address, type="ban", name=False):
+        """
+        Check if address is banned
+
+        See helpers.functions.banned()
+
+        :param address: Complete IP address to check
+        :param type: Entry type to check for
+        :param name: Server name, for prefer/unprefer entries that only apply to some names
+        :return: True if banned/whitelisted, False if not
+        """
+        if type == "prefer" or type == "unprefer":
+            for address_matcher, name_matcher in self.ordered.get(type, []):
+                if address_matcher(address):
+                    if name and name_matcher:
+                        return bool(name_matcher(name.lower()))
+                    else:
+                        return True
+            return False
+
+        if address in self.mirrors:
+            return True if type == "whitelist" else False
+
+        if type == "ban" and (address == "127.0.0.1" or address == "localhost"):
+            return False
+
+        return self.matches(address, type)
+
+    def reserved(self, name, address):
+        """
+        Check if a server name is reserved for someone else
+
+        :param name: Server name, without spaces and colour codes
+        :param address: IP address of the server that wants to use the name
+        :return: True if a whitelist entry reserves the name and the address does not match that entry
+        """
+        name = name.lower()
+
+        for address_matcher in self.reserved_names.get(name, ()):
+            if not address_matcher(address):
+                return True
+
+        # most names are not reserved, so only look at individual entries if any of them matches
+        if self.reserved_any and self.reserved_any(name):
+            for name_matcher, address_matcher in self.reserved_masks:
+                if name_matcher(name) and not address_matcher(address):
+                    return True
+
+        return False
@@ -0,0 +1,157 @@
+"""
+Server list events, for subscribers that want to be told about changes rather than poll for them
+
+Whenever a server is listed, updated or delisted, or the MOTD changes, an event is published here, and passed on to
+all subscribers (see handlers.subscription). Each event is serialised once, as a line of JSON, no matter how many
+subscribers there are. Subscribers that do not keep up are not waited for: once their buffer is full they stop
+receiving events, and are disconnected.
+"""
+import collections
+import threading
+import config
+import json
+
+subscribers = set()
+lock = threading.Lock()
+
+# server properties that change all the time without the listing itself changing, not worth an event
+IGNORED = ("id", "remote", "lifesign", "last_ping")
+
+
+class subscription:
+    """
+    Events waiting to be sent to one subscriber
+    """
+
+    def __init__(self, size):
+        """
+        Set up subscription
+
+        :param size: Maximum amount of events to keep; if more are published before they are sent, the subscription
+        overflows
+        """
+        self.queue = collections.deque()
+        self.size = size
+        self.overflowed = False
+        self.waiting = threading.Event()
+
+    def push(self, line):
+        """
+        Add event to the queue
+
+        :param line: Serialised event
+        :return: False if the queue was full, in which case the subscription has overflowed
+        """
+        if len(self.queue) >= self.size:
+            self.overflowed = True
+            self.waiting.set()
+            return False
+
+        self.queue.append(line)
+        self.waiting.set()
+        return True
+
+    def pull(self, timeout=None):
+        """
+        Get all queued events, waiting for some if there are none yet
+
+        :param timeout: Seconds to wait at most
+        :return: List of serialised events, possibly empty
+        """
+        self.waiting.wait(timeout)
+        self.waiting.clear()
+
+        lines = []
+        while self.queue:
+            lines.append(self.queue.popleft())
+
+        return lines
+
+
+def subscribe():
+    """
+    Start receiving events
+
+    :return: subscription, or None if there are SUBSCRIBE_MAX subscribers already
+    """
+    with lock:
+        if len(subscribers) >= config.SUBSCRIBE_MAX:
+            return None
+
+        subscriber = subscription(config.SUBSCRIBE_BUFFER)
+        subscribers.add(subscriber)
+        return subscriber
+
+
+def unsubscribe(subscriber):
+    """
+    Stop receiving events
+
+    :param subscriber: subscription, see subscribe()
+    :return: Nothing
+    """
+    with lock:
+        subscribers.discard(subscriber)
+
+
+def subscribed():
+    """
+    Check if anyone is listening
+
+    Lets callers skip work that is only needed to publish events.
+
+    :return: True if there are subscribers
+    """
+    return bool(subscribers)
+
+
+def publish(event, data):
+    """
+    Pass an event on to all subscribers
+
+    :param event: Event type, e.g. "listed"
+    :param data: Dictionary with event data
+    :return: Nothing
+    """
+    if not subscribers:
+        return
+
+    line = (json.dumps({"event": event, **data}) + "\n").encode("ascii", "ignore")
+
+    with lock:
+        for subscriber in list(subscribers):
+            if not subscriber.push(line):
+                subscribers.discard(subscriber)  # too slow, will be disconnected
+
+
+def server(update, listed=False):
+    """
+    Publish a server update
+
+    :param update: Dictionary of updated server properties, with at least "id"
+    :param listed: Whether the server has just been listed, rather than updated
+    :return: Nothing
+    """
+    fields = {key: value for key, value in update.items() if key not in IGNORED}
+    if fields or listed:
+        publish("listed" if listed else "updated", {"id": update["id"], "server": fields})
+
+
+def delisted(id):
+    """
+    Publish a server delisting
+
+    :param id: Server ID
+    :return: Nothing
+    """
+    publish("delisted", {"id": id})
+
+
+def motd(text):
+    """
+    Publish a new MOTD
+
+    :param text: MOTD
+    :return: Nothing
+    """
+    publish("motd", {"motd": text})
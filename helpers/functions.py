@@ -1,141 +1,19 @@
+import contextlib
 import threading
-import fnmatch
 import sqlite3
 import socket
 import config
 import math
+import time
 
-lock = threading.Lock();
-
-
-def decode_mode(mode):
-    """
-    JJ2 uses numbers instead of strings, but strings are easier for humans to work with
-    
-    CANNOT use spaces here, as list server scripts may not expect spaces in modes in port 10057 response
-
-    :param mode: Mode number as sent by the client
-    :return: Mode string
-    """
-    if mode == 16:
-        return "headhunters"
-    if mode == 15:
-        return "domination"
-    if mode == 14:
-        return "tlrs"
-    if mode == 13:
-        return "flagrun"
-    if mode == 12:
-        return "deathctf"
-    if mode == 11:
-        return "jailbreak"
-    if mode == 10:
-        return "teambattle"
-    if mode == 9:
-        return "pestilence"
-    if mode == 8:
-        return "xlrs"
-    if mode == 7:
-        return "lrs"
-    if mode == 6:
-        return "roasttag"
-    if mode == 5:
-        return "coop"
-    if mode == 4:
-        return "race"
-    if mode == 3:
-        return "ctf"
-    if mode == 2:
-        return "treasure"
-    if mode == 1:
-        return "battle"
-
-    return "unknown"
-
-
-def encode_mode(mode):
-    """
-    JJ2 uses numbers instead of strings, but strings are easier for humans to work with
-    
-    CANNOT use spaces here, as list server scripts may not expect spaces in modes in port 10057 response
-
-    :param mode: Mode number as sent by the client
-    :return: Mode string
-    """
-    if mode == 16:
-        return "headhunters"
-    if mode == 15:
-        return "domination"
-    if mode == 14:
-        return "tlrs"
-    if mode == 13:
-        return "flagrun"
-    if mode == 12:
-        return "deathctf"
-    if mode == 11:
-        return "jailbreak"
-    if mode == 10:
-        return "teambattle"
-    if mode == 9:
-        return "pestilence"
-    if mode == 8:
-        return "xlrs"
-    if mode == 7:
-        return "lrs"
-    if mode == 6:
-        return "roasttag"
-    if mode == 5:
-        return "coop"
-    if mode == 4:
-        return "race"
-    if mode == 3:
-        return "ctf"
-    if mode == 2:
-        return "treasure"
-    if mode == 1:
-        return "battle"
-
-    return "unknown"
-
-
-def decode_version(version):
-    """
-    Not a lot to decode for the version string, but people aren't actually playing 1.21
-
-    :param version: Version as sent by the client
-    :return: Version string as used by list server
-    """
-    version = version.decode("ascii", "ignore")
-
-    if version[0:2] == "21":
-        version_string = "1.23"
-    else:
-        version_string = "1.24"
-
-    return version_string + version[2:]
-
-
-def udpchecksum(bytes):
-    """"
-    Prepend UDP checksum
-    
-    JJ2 expects UDP datagrams to be perceded by a two-byte checksum - this method adds that checksum
-    Thanks to DJazz for the PHP reference implementation!
-    
-    :param bytes: Bytearray to checksum
-    :return: Bytearray with checksum
-    """
-    x = 1
-    y = 1
-    byte_count = len(bytes)
-    for i in range(2, byte_count):
-        x += bytes[i]
-        y += x
+# wire format helpers used to live here
+from helpers.protocol import decode_mode, encode_mode, decode_version, udpchecksum
+from helpers import profiler, banlist
 
-    bytes[0] = x % 251
-    bytes[1] = y % 251
-
-    return bytes
+lock = threading.Lock();
+index = None  # banlist index, see get_banlist()
+index_lock = threading.Lock()
+lock_wait = {"acquired": 0, "waited": 0.0, "max": 0.0}  # time spent waiting for the database lock
 
 
 def fancy_time(time):
@@ -192,54 +70,39 @@ def get_own_ip():
     return ip
 
 
-def banned(address, type="ban", name=False):
+def get_banlist():
     """
-    Check if address is banned
+    Get banlist index
 
-    Checks the database and sees whether the address matches a banlist entry. Mirrors are never banned and always
-    whitelisted
+    The index is rebuilt from the database if the banlist or mirror list has changed since it was last built, see
+    helpers.banlist.changed().
 
-    :param address: Complete IP address to check
-    :param whitelisted: Check for whitelist instead of ban
-    :return: True if banned/whitelisted, False if not
+    :return: helpers.banlist.ban_index
     """
-    lock.acquire()
+    global index
 
-    dbconn = sqlite3.connect(config.DATABASE)
-    dbconn.row_factory = sqlite3.Row
-    cursor = dbconn.cursor()
-
-    mirrors = cursor.execute("SELECT * FROM mirrors").fetchall()
-    banlist = cursor.execute("SELECT * FROM banlist").fetchall()
-
-    mirrors = [mirrors[i]["address"] for i, value in enumerate(mirrors)]
-    banlist = [dict(banlist[i]) for i, value in enumerate(banlist)]
-
-    cursor.close()
-    dbconn.close()
-
-    lock.release()
+    with index_lock:
+        if index is None or index.version != banlist.version:
+            building = banlist.version  # changes made while building will trigger another rebuild later
+            index = banlist.ban_index([mirror["address"] for mirror in fetch_all("SELECT address FROM mirrors")],
+                                      fetch_all("SELECT * FROM banlist"), building)
 
-    if type == "prefer" or type == "unprefer":
-        for ban in banlist:
-            if fnmatch.filter([address], ban["address"]) and ban["type"] == type:
-                if name and ban["reserved"] != "":
-                    return (fnmatch.filter([name.lower()], ban["reserved"].lower()) != [])
-                else:
-                    return True
-        return False
+        return index
 
-    if address in mirrors:
-        return True if type == "whitelist" else False
 
-    if type == "ban" and (address == "127.0.0.1" or address == "localhost"):
-        return False
+def banned(address, type="ban", name=False):
+    """
+    Check if address is banned
 
-    for ban in banlist:
-        if fnmatch.filter([address], ban["address"]) and ban["type"] == type:
-            return True
+    Checks the banlist and sees whether the address matches a banlist entry. Mirrors are never banned and always
+    whitelisted
 
-    return False
+    :param address: Complete IP address to check
+    :param type: Type of entry to check for, e.g. "whitelist" instead of "ban"
+    :param name: Server name, for prefer/unprefer entries that only apply to some names
+    :return: True if banned/whitelisted, False if not
+    """
+    return get_banlist().banned(address, type, name)
 
 
 def whitelisted(address):
@@ -282,36 +145,32 @@ def all_mirrors():
     """
     Get list of mirrors
 
-    Checks the database and returns all mirror IP addresses
+    Checks the database and returns all mirror IP addresses. Note that the list server keeps an in-memory copy of
+    this (listserver.mirrors) which should be preferred over calling this
 
     :return: List of addresses
     """
-    lock = threading.Lock()
-    lock.acquire()
-
-    dbconn = sqlite3.connect(config.DATABASE)
-    dbconn.row_factory = sqlite3.Row
-    cursor = dbconn.cursor()
-
-    mirrors = cursor.execute("SELECT * FROM mirrors").fetchall()
-    mirrors = [mirrors[i]["address"] for i, value in enumerate(mirrors)]
+    mirrors = fetch_all("SELECT address FROM mirrors")
 
-    cursor.close()
-    dbconn.close()
-
-    lock.release()
-
-    return mirrors
+    return [mirror["address"] for mirror in mirrors]
 
 
 def acquire_lock():
     """
     Acquire lock
 
-    To be used before the database is manipulated.
+    To be used before the database is manipulated. Keeps track of how long it took to acquire the lock, see
+    lock_stats().
     """
+    start = time.perf_counter()
     lock.acquire()
 
+    waited = time.perf_counter() - start
+    lock_wait["acquired"] += 1
+    lock_wait["waited"] += waited
+    if waited > lock_wait["max"]:
+        lock_wait["max"] = waited
+
 
 def release_lock():
     """
@@ -322,6 +181,16 @@ def release_lock():
     lock.release()
 
 
+def lock_stats():
+    """
+    Get database lock statistics
+
+    :return: Dictionary: amount of times the lock was acquired, and total and maximum time spent waiting for it, in
+    seconds
+    """
+    return dict(lock_wait)
+
+
 def query(sqlquery, replacements=tuple(), autolock=True, mode="execute"):
     """
     Execute sqlite query
@@ -340,6 +209,8 @@ def query(sqlquery, replacements=tuple(), autolock=True, mode="execute"):
     :param mode: Return mode: "fetchone" (one row), "fetchall" (list of rows), "execute" (raw query result)
     :return: Query result
     """
+    start = time.perf_counter() if profiler.enabled else None
+
     if autolock:
         acquire_lock()
 
@@ -363,6 +234,9 @@ def query(sqlquery, replacements=tuple(), autolock=True, mode="execute"):
     if autolock:
         release_lock()
 
+    if start is not None:
+        profiler.record("query:%s" % sqlquery.split(None, 1)[0].lower(), time.perf_counter() - start)
+
     return result
 
 
@@ -388,3 +262,32 @@ def fetch_all(sqlquery, replacements=tuple(), autolock=True):
     :return: Query result, list of dictionaries
     """
     return query(sqlquery, replacements, autolock, "fetchall")
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Run a batch of queries in one transaction
+
+    To be used as a context manager that yields a cursor; the lock is held and one connection is used until the block
+    ends, after which everything is committed at once (or rolled back, if an exception occurred). Much cheaper than
+    calling query() repeatedly when a lot of rows need to be changed.
+
+    :return: Database cursor
+    """
+    acquire_lock()
+
+    dbconn = sqlite3.connect(config.DATABASE)
+    dbconn.row_factory = sqlite3.Row
+    db = dbconn.cursor()
+
+    try:
+        yield db
+        dbconn.commit()
+    except Exception:
+        dbconn.rollback()
+        raise
+    finally:
+        db.close()
+        dbconn.close()
+        release_lock()
@@ -1,9 +1,7 @@
 import threading
 import socket
-import config
-import time
 
-from helpers.functions import query
+from helpers import profiler, snapshot
 
 
 class port_handler(threading.Thread):
@@ -14,6 +12,7 @@ class port_handler(threading.Thread):
     buffer = bytearray()
     locked = False
     looping = True
+    handover = False  # whether the connection is to be kept open for the next listener, see halt()
 
     def __init__(self, client=None, address=None, ls=None, port=None):
         """
@@ -43,18 +42,24 @@ class port_handler(threading.Thread):
 
         :return: Nothing
         """
-        self.handle_data()
+        if profiler.enabled:
+            profiler.run_handler(self)
+        else:
+            self.handle_data()
         return
 
-    def halt(self):
+    def halt(self, handover=False):
         """
         Halt handler
 
         Most handlers don't need to do anything for halting, but some may be looping or maintaining connections, in
         which case this method can be used to properly end that.
 
+        :param handover: Keep the connection open so it can be resumed after reloading, rather than ending it. Only
+        handlers for connections that stay open (i.e. those of game servers) do anything with this.
         :return:
         """
+        self.handover = handover
         self.looping = False
 
     def msg(self, string):
@@ -108,4 +113,4 @@ class port_handler(threading.Thread):
         Not critical, but should be called before some user-facing actions (e.g. retrieving server lists)
         :return:
         """
-        query("DELETE FROM servers WHERE remote = 1 AND lifesign < ?", (int(time.time()) - config.TIMEOUT,))
\ No newline at end of file
+        snapshot.cleanup()
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""
+Hand over open connections when the list server restarts itself
+
+Game servers are delisted as soon as their connection to the list server is closed, so restarting the list server
+used to delist every server (and have every mirror delist them too), only for them to be listed again once they
+noticed. Instead, when the list server restarts itself (see listserver.reload()), it keeps its listening sockets and
+the connections of listed servers open and passes them on: within the same process if only modules are reloaded, or
+by having the new process inherit them when the list server is restarted completely. In the latter case, the file
+descriptors, what is needed to resume each connection and the records of the servers involved are written to
+HANDOVER_FILE, which the new process reads when it starts.
+"""
+import socket
+import json
+import os
+
+
+def save(path, sockets, sessions, servers):
+    """
+    Prepare sockets to be inherited by a new process, and write what it needs to take them over
+
+    :param path: File to write to
+    :param sockets: Dictionary of port: listening socket
+    :param sessions: List of game server sessions, see server_handler.session()
+    :param servers: List of server records, for the servers of those sessions
+    :return: Nothing
+    """
+    for server in sockets.values():
+        server.set_inheritable(True)
+
+    for session in sessions:
+        session["client"].set_inheritable(True)
+
+    # the PID stays the same when the process is replaced, which makes sure file descriptors are never taken over by
+    # a process that did not inherit them
+    state = {
+        "pid": os.getpid(),
+        "sockets": {str(port): server.fileno() for port, server in sockets.items()},
+        "sessions": [{"fd": session["client"].fileno(), "address": session["address"], "new": session["new"]} for
+                     session in sessions],
+        "servers": servers
+    }
+
+    with open(path, "w") as output:
+        json.dump(state, output)
+
+
+def load(path):
+    """
+    Take over sockets from the process this one replaced, if any
+
+    The file is deleted after reading, so it is only used once.
+
+    :param path: File written by save()
+    :return: Tuple: dictionary of port: listening socket, list of sessions, list of server records
+    """
+    try:
+        with open(path) as input:
+            state = json.load(input)
+        os.remove(path)
+    except (OSError, ValueError):
+        return {}, [], []
+
+    if not isinstance(state, dict) or state.get("pid") != os.getpid():
+        return {}, [], []
+
+    sockets = {}
+    for port, fileno in state.get("sockets", {}).items():
+        try:
+            sockets[int(port)] = socket.socket(fileno=fileno)
+        except (OSError, ValueError):
+            pass  # port will be opened again instead
+
+    sessions = []
+    for session in state.get("sessions", []):
+        try:
+            sessions.append({"client": socket.socket(fileno=session["fd"]), "address": session["address"],
+                             "new": session["new"]})
+        except (OSError, KeyError, TypeError):
+            pass  # server will have to connect again
+
+    return sockets, sessions, state.get("servers", [])
@@ -1,12 +1,18 @@
 import threading
-import fnmatch
 import sqlite3
 import config
 import time
-import re
 
-from helpers.functions import query, fetch_all, fetch_one
+from helpers.functions import query, fetch_all, fetch_one, transaction, get_banlist
 from helpers.exceptions import ServerUnknownException
+from helpers import snapshot, events
+
+# server names: bytes outside 0x20-0x7d become spaces, non-ascii bytes are dropped (as decoding the name would)
+NAME_TABLE = bytes([byte if 0x20 <= byte <= 0x7d else 0x20 for byte in range(0, 256)])
+NAME_NON_ASCII = bytes(range(0x80, 0x100))
+NAME_MEMO_SIZE = 1024  # amount of recently stripped names to remember
+
+stripped_names = {}  # name as received: stripped name
 
 
 class jj2server:
@@ -17,6 +23,7 @@ class jj2server:
     """
     new = False
     forbidden_characters = "#%&[]^{}~"  # not displayed by jj2 and should therefore never be part of server names
+    unlisted = ("lifesign", "last_ping")  # properties that don't show up in server lists
 
     def __init__(self, key, create_if_unknown=True):
         """
@@ -40,6 +47,7 @@ class jj2server:
                   (self.id, int(time.time()), int(time.time())))
             self.data = fetch_one("SELECT * FROM servers WHERE id = ?", (self.id,))
             self.new = True
+            snapshot.changed()
 
         if not self.data:
             raise NotImplementedError  # there's something very wrong if this happens
@@ -58,16 +66,10 @@ class jj2server:
         if item not in self.data:
             raise IndexError("%s is not a server property" % item)
 
-        if item == "name":
-            value = self.strip(value)
+        value = self.sanitise(item, value)
 
-        if item == "max" or item == "players":
-            if value > config.MAXPLAYERS:
-                value = config.MAXPLAYERS
-            if value < 0:
-                value = 0
-
-        if self.data[item] != value:
+        changed = self.data[item] != value
+        if changed:
             self.updated[item] = value
 
         self.data[item] = value
@@ -75,8 +77,35 @@ class jj2server:
         # not escaping column names above is okay because the column name is always a key in self.data which is also
         # a valid column name
 
+        # only once the change is in the database, else a list rendered in between would get the new version but the
+        # old data
+        if changed and item not in self.unlisted:
+            snapshot.changed()
+
         return
 
+    @classmethod
+    def sanitise(cls, item, value):
+        """
+        Make sure a property value is acceptable
+
+        Strips names and caps player counts.
+
+        :param item: Property
+        :param value: Value as received
+        :return: Value as it should be stored
+        """
+        if item == "name":
+            value = cls.strip(value)
+
+        if item == "max" or item == "players":
+            if value > config.MAXPLAYERS:
+                value = config.MAXPLAYERS
+            if value < 0:
+                value = 0
+
+        return value
+
     def validate_name(self, name, ip, alternative):
         """
         Checks if a name is not reserved
@@ -89,20 +118,12 @@ class jj2server:
         :param alternative: Alternative name to use if name is reserved by someone else
         :return: Either the original or alternative name
         """
-        reserved = fetch_all("SELECT * FROM banlist WHERE type = ? AND reserved != ''", ('whitelist',))
         name = self.strip(name)
         check = name.replace(" ", "").replace("|", "")
 
-        if check == "":
+        if check == "" or get_banlist().reserved(check, ip):
             return alternative
 
-        for mask in reserved:
-            check_against = mask["reserved"].replace(" ", "")
-            ip_matches = fnmatch.filter([ip], mask["address"]) != []
-            name_matches = fnmatch.filter([check.lower()], check_against.lower()) != []
-            if name_matches and not ip_matches:
-                return alternative
-
         return name
 
     def get(self, item):
@@ -141,25 +162,139 @@ class jj2server:
         """
         Delete server from database
 
+        Subscribers are only told the server was delisted if it was ever listed, i.e. if it got as far as sending a
+        valid listing; connections that were refused or never sent one are forgotten quietly.
+
         :return: Nothing
         """
         query("DELETE FROM servers WHERE id = ?", (self.id,))
+        snapshot.changed()
+        if self.data.get("ip"):
+            events.delisted(self.id)
 
         return
 
-    def strip(self, string):
+    @classmethod
+    def strip(cls, string):
         """
         Remove unwanted characters from string (e.g. server name)
         
-        Removes anything not between ascii values 32 (space) and 126, and collapses repeated spaces
+        Removes anything not between ascii values 32 (space) and 126, and collapses repeated spaces. Names received
+        from game servers are passed as the raw name field, which is stripped before it is decoded. Servers send the
+        same name over and over, so recently stripped names are remembered rather than stripped each time.
         
-        :param string: String to strip
+        :param string: The name field as received (bytes), or a string, for names received via ServerNet or the API
         :return: Stripped string
         """
-        string = re.sub(r'[^\x20-\x7d]', r' ', string)
-        string = re.sub(r"[ ]+", r" ", string).strip(" \t\r\n\0")
+        if not isinstance(string, (str, bytes)):
+            string = bytes(string)  # e.g. a memoryview of a received packet
+
+        if string in stripped_names:
+            return stripped_names[string]
+
+        if isinstance(string, str):
+            # names received via ServerNet may contain any character; those that are not ascii become spaces too
+            raw = string.encode("ascii") if string.isascii() else "".join(
+                [character if character < "\x80" else " " for character in string]).encode("ascii")
+        else:
+            raw = string
+
+        # one pass to replace unwanted characters, one to collapse spaces and one to remove forbidden characters
+        stripped = b" ".join(raw.translate(NAME_TABLE, NAME_NON_ASCII).split()).translate(
+            None, cls.forbidden_characters.encode("ascii")).decode("ascii")
 
-        invisible = str.maketrans(dict.fromkeys(self.forbidden_characters))
-        string = string.translate(invisible)
+        if len(stripped_names) >= NAME_MEMO_SIZE:
+            stripped_names.clear()
+        stripped_names[string] = stripped
 
-        return string
+        return stripped
+
+
+columns = None  # cached by server_columns()
+
+
+def server_columns():
+    """
+    Get the names of all server properties
+
+    :return: Set of column names of the servers table
+    """
+    global columns
+
+    if not columns:
+        columns = frozenset([column["name"] for column in fetch_all("PRAGMA table_info(servers)")])
+
+    return columns
+
+
+def update_remote_servers(updates):
+    """
+    Apply a batch of server updates received via ServerNet
+
+    Equivalent to calling jj2server.set() for each property of each server and marking them as remote, but all updates
+    are validated first and then applied in one transaction, with one query per combination of updated properties
+    rather than one per property.
+
+    :param updates: List of dictionaries with server properties, each should at least contain an "id"
+    :return: List of updates that were applied; updates with missing IDs or unknown properties are discarded
+    """
+    known = server_columns()
+    valid = []
+    for update in updates:
+        if not isinstance(update, dict) or "id" not in update or any([key not in known for key in update]):
+            continue
+        try:
+            valid.append({key: jj2server.sanitise(key, update[key]) for key in update})
+        except TypeError:
+            continue
+
+    if not valid:
+        return valid
+
+    # later updates to the same server take precedence over earlier ones
+    merged = {}
+    for update in valid:
+        merged.setdefault(update["id"], {}).update(update)
+
+    now = int(time.time())
+    batches = {}
+    for update in merged.values():
+        properties = tuple(sorted([key for key in update if key not in ("id", "remote", "lifesign")]))
+        batches.setdefault(properties, []).append(update)
+
+    with transaction() as db:
+        # servers not known yet are announced as listed rather than updated to subscribers
+        existing = None
+        if events.subscribed():
+            existing = set()
+            for offset in range(0, len(merged), 500):
+                ids = list(merged)[offset:offset + 500]
+                existing.update([row[0] for row in db.execute(
+                    "SELECT id FROM servers WHERE id IN (%s)" % ", ".join(["?"] * len(ids)), ids)])
+
+        db.executemany("INSERT INTO servers (id, created, lifesign) VALUES (?, ?, ?) ON CONFLICT(id) DO NOTHING",
+                       [(server, now, now) for server in merged])
+
+        for properties, batch in batches.items():
+            # not escaping column names is okay because they have been checked against the actual columns above
+            assignments = "".join(["%s = ?, " % key for key in properties])
+            db.executemany("UPDATE servers SET %sremote = 1, lifesign = ? WHERE id = ?" % assignments,
+                           [[update[key] for key in properties] + [now, update["id"]] for update in batch])
+
+        # we can't do anything with partial data - this means we got a server update before the server has been first
+        # 'registered', which could happen if an earlier all-server update is missed somehow
+        db.executemany("DELETE FROM servers WHERE id = ? AND remote = 1 AND (ip IS NULL OR port IS NULL)",
+                       [(server,) for server in merged])
+
+    # updates that only keep servers alive don't change the list
+    if any([set(properties) - set(jj2server.unlisted) for properties in batches]):
+        snapshot.changed()
+
+    if existing is not None:
+        for update in merged.values():
+            if update["id"] in existing:
+                events.server(update)
+            elif "ip" in update and "port" in update:
+                events.server(update, listed=True)
+
+    return valid
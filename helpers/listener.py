@@ -9,10 +9,36 @@ from handlers.asciilist import ascii_handler
 from handlers.binarylist import binary_handler
 from handlers.liveserver import server_handler
 from handlers.motd import motd_handler
+from handlers.httplist import http_handler
+from handlers.subscription import subscription_handler
 from handlers.statistics import stats_handler
 from helpers.functions import banned, whitelisted
 
 
+def open_socket(port):
+    """
+    Open a socket listening at a port
+
+    Port 10059 is only opened at localhost, since it is for the admin API; encryption is added by the listener.
+
+    :param port: Port to listen at
+    :return: Socket; raises OSError if the port cannot be opened
+    """
+    server = socket.socket()
+
+    # this makes sure sockets are available immediate after closing instead of waiting for late packets
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    try:
+        server.bind(("localhost" if port == 10059 else "", port))
+        server.listen(5)
+    except OSError:
+        server.close()
+        raise
+
+    return server
+
+
 class port_listener(threading.Thread):
     """
     Threaded port listener
@@ -21,13 +47,15 @@ class port_listener(threading.Thread):
     connections = {}
     ticker = {}
     looping = True
+    handover = False  # whether the socket and connections are to be kept open for the next listener, see halt()
 
-    def __init__(self, port=None, ls=None):
+    def __init__(self, port=None, ls=None, server=None):
         """
         Check if all data is available and assign object vars
 
         :param port: Port at which to listen
         :param ls: List server object, for logging etc
+        :param server: Socket already listening at the port, see open_socket(); opened by the listener if not given
         """
         threading.Thread.__init__(self)
 
@@ -36,6 +64,7 @@ class port_listener(threading.Thread):
 
         self.port = port
         self.ls = ls
+        self.server = server
 
     def run(self):
         """
@@ -46,46 +75,36 @@ class port_listener(threading.Thread):
         if not self.looping:
             return False  # shutting down, don't accept new connections
 
-        # in case of port 10059, we authenticate via SSL certificates, since else anyone running on localhost
-        # may interact with the list server API
-        if self.port == 10059:
-            unwrapped_server = socket.socket()
-            server = ssl.wrap_socket(unwrapped_server, server_side=True, certfile=config.CERTFILE,
-                                     ca_certs=config.CERTCHAIN, keyfile=config.CERTKEY)
-            address = "localhost"
-        else:
-            server = socket.socket()
-            address = ""
-
-        # this makes sure sockets are available immediate after closing instead of waiting for late packets
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
         # because we may still run into TIME_WAIT, try opening the socket every 5 seconds until we have a connection
         # or 5 minutes have passed, in the latter case we assume there's something wrong and give up
+        server = self.server
         has_time = True
         start_trying = int(time.time())
-        while has_time:
+        while not server and has_time:
             has_time = start_trying > time.time() - 300  # stop trying after 5 minutes
             try:
-                server.bind((address, self.port))
+                server = open_socket(self.port)
                 break
+            except ConnectionRefusedError:
+                self.ls.log.error(
+                    "WARNING! OS refused listening at port %s! List server is NOT listening at this port!" % self.port)
+                return
             except OSError as e:
                 if has_time and self.looping:
                     self.ls.log.info("Could not open port %s yet (%s), retrying in 5 seconds" % (self.port, e.strerror))
                     time.sleep(5.0)  # wait a few seconds before retrying
                     continue
                 self.ls.log.error(
-                    "WARNING! Port %s:%s is already in use and could not be released! List server is NOT listening at this port!" % (
-                        address, self.port))
-                return
-            except ConnectionRefusedError:
-                self.ls.log.error(
-                    "WARNING! OS refused listening at %s:%s! List server is NOT listening at this port!" % (
-                        address, self.port))
+                    "WARNING! Port %s is already in use and could not be released! List server is NOT listening at this port!" % self.port)
                 return
 
-        server.listen(5)
-        server.settimeout(5)
+        # in case of port 10059, we authenticate via SSL certificates, since else anyone running on localhost
+        # may interact with the list server API
+        if self.port == 10059:
+            server = ssl.wrap_socket(server, server_side=True, certfile=config.CERTFILE, ca_certs=config.CERTCHAIN,
+                                     keyfile=config.CERTKEY)
+
+        server.settimeout(1)
         self.ls.log.info("Opening socket listening at port %s" % self.port)
 
         while self.looping:
@@ -149,6 +168,11 @@ class port_listener(threading.Thread):
                 self.connections[key] = motd_handler(client=client, address=address, ls=self.ls, port=self.port)
             elif self.port == 10059:
                 self.connections[key] = servernet_handler(client=client, address=address, ls=self.ls, port=self.port)
+            elif self.port == config.HTTP_PORT:
+                self.connections[key] = http_handler(client=client, address=address, ls=self.ls, port=self.port)
+            elif self.port == config.SUBSCRIBE_PORT:
+                self.connections[key] = subscription_handler(client=client, address=address, ls=self.ls,
+                                                             port=self.port)
             else:
                 raise NotImplementedError("No handler class available for port %s" % self.port)
 
@@ -177,12 +201,16 @@ class port_listener(threading.Thread):
             time.sleep(config.MICROSLEEP)
 
         self.ls.log.info("Waiting for handlers on port %s to finish..." % self.port)
-        server.close()
+        if self.handover:
+            # keep the socket open, without encryption (that is added again by the next listener)
+            self.ls.bound[self.port] = socket.socket(fileno=server.detach())
+        else:
+            server.close()
 
         # give all handlers the signal to stop whatever they're doing
         for key in self.connections:
             if self.connections[key].looping:
-                self.connections[key].halt()
+                self.connections[key].halt(handover=self.handover)
 
         # now make sure they're all finished
         for key in self.connections:
@@ -190,12 +218,27 @@ class port_listener(threading.Thread):
 
         return
 
-    def halt(self):
+    def resume(self, session):
+        """
+        Resume a game server connection handed over by a previous listener
+
+        :param session: Session, see server_handler.session()
+        :return: Nothing
+        """
+        key = session["address"][0] + ":" + str(session["address"][1])
+        self.connections[key] = server_handler(client=session["client"], address=tuple(session["address"]), ls=self.ls,
+                                               port=self.port)
+        self.connections[key].resume(session)
+        self.connections[key].start()
+
+    def halt(self, handover=False):
         """
         Stop listening
 
         Stops the main loop and signals all active handlers to stop what they're doing and rejoin the listener thread.
 
+        :param handover: Keep the socket and game server connections open, so they can be taken over after reloading
         :return:
         """
+        self.handover = handover
         self.looping = False
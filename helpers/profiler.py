@@ -0,0 +1,195 @@
+import tracemalloc
+import threading
+import cProfile
+import pathlib
+import random
+import pstats
+import config
+import json
+import time
+
+# checked on hot paths, so everything else in here only costs something while profiling
+enabled = False
+
+lock = threading.Lock()
+session = {}
+timings = {}
+profiles = []
+timer = None
+last = None
+
+
+def start(mode="timing", seconds=60, sample=1.0):
+    """
+    Start profiling
+
+    Timing (how many times and for how long port handlers and database queries run) is always collected while
+    profiling. Additionally, handlers can be profiled with cProfile, or memory allocations can be traced with
+    tracemalloc. Profiling stops and results are written to disk automatically after the given amount of seconds.
+
+    :param mode: "timing", "cprofile" or "tracemalloc"
+    :param seconds: Seconds after which to stop profiling
+    :param sample: Fraction of handlers to profile with cProfile, e.g. 0.1 for one in ten
+    :return: Nothing
+    """
+    global enabled, session, timings, profiles, timer
+
+    if mode not in ("timing", "cprofile", "tracemalloc"):
+        raise ValueError("Unknown profiling mode %s" % mode)
+
+    stop()
+
+    with lock:
+        session = {"mode": mode, "started": time.time(), "seconds": seconds, "sample": sample}
+        timings = {}
+        profiles = []
+
+        if mode == "tracemalloc":
+            tracemalloc.start(10)
+
+        timer = threading.Timer(seconds, dump)
+        timer.daemon = True
+        timer.start()
+
+        enabled = True
+
+
+def stop():
+    """
+    Stop profiling, without writing results
+
+    :return: Nothing
+    """
+    global enabled, timer
+
+    with lock:
+        enabled = False
+
+        if timer:
+            timer.cancel()
+            timer = None
+
+        if tracemalloc.is_tracing() and session.get("mode") == "tracemalloc":
+            tracemalloc.stop()
+
+
+def record(name, duration):
+    """
+    Record how long something took
+
+    :param name: What was timed
+    :param duration: Duration, in seconds
+    :return: Nothing
+    """
+    with lock:
+        if name not in timings:
+            timings[name] = [0, 0.0, 0.0]
+
+        timing = timings[name]
+        timing[0] += 1
+        timing[1] += duration
+        if duration > timing[2]:
+            timing[2] = duration
+
+
+def run_handler(handler):
+    """
+    Run a port handler while profiling
+
+    :param handler: port_handler object
+    :return: Nothing
+    """
+    start = time.perf_counter()
+    profile = None
+
+    if session.get("mode") == "cprofile" and random.random() < session.get("sample", 1.0):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # newer Pythons only allow one active profiler at a time; this handler is then only timed
+            profile = None
+
+    try:
+        handler.handle_data()
+    finally:
+        if profile:
+            profile.disable()
+            with lock:
+                profiles.append(profile)
+
+    record("handler:%s" % handler.__class__.__name__, time.perf_counter() - start)
+
+
+def summary():
+    """
+    Summarise timings collected so far
+
+    :return: Dictionary of name: {calls, total, mean, max}, with times in milliseconds
+    """
+    with lock:
+        return {name: {"calls": timing[0], "total": round(timing[1] * 1000, 3),
+                       "mean": round(timing[1] / timing[0] * 1000, 3), "max": round(timing[2] * 1000, 3)}
+                for name, timing in sorted(timings.items())}
+
+
+def dump(extra=None):
+    """
+    Stop profiling and write results to disk
+
+    Timings are written as JSON; cProfile results as a pstats file that can be loaded with `python3 -m pstats`; traced
+    memory allocations as a tracemalloc snapshot plus a text file with the top allocation sites.
+
+    :param extra: Dictionary with additional data to include in the timings file
+    :return: Dictionary with session info, timing summary and paths of written files; results of the previous
+    session if not profiling (None if there was none)
+    """
+    global enabled, last
+
+    with lock:
+        if not enabled:
+            return last
+
+        enabled = False
+        snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        collected = list(profiles)
+
+    stop()
+
+    folder = pathlib.Path(config.PROFILE_FOLDER)
+    folder.mkdir(parents=True, exist_ok=True)
+    prefix = "j2lsnek-%s-%i" % (session["mode"], int(session["started"] * 1000))
+    result = dict(session)
+    result["duration"] = round(time.time() - session["started"], 3)
+    result["timings"] = summary()
+    result["files"] = []
+
+    if extra:
+        result.update(extra)
+
+    if collected:
+        stats = pstats.Stats(collected[0])
+        for profile in collected[1:]:
+            stats.add(profile)
+        path = folder.joinpath(prefix + ".prof")
+        stats.dump_stats(str(path))
+        result["files"].append(str(path))
+
+    if snapshot:
+        path = folder.joinpath(prefix + ".tracemalloc")
+        snapshot.dump(str(path))
+        result["files"].append(str(path))
+
+        path = folder.joinpath(prefix + "-top.txt")
+        with path.open("w") as output:
+            for stat in snapshot.statistics("lineno")[:50]:
+                output.write("%s\n" % stat)
+        result["files"].append(str(path))
+
+    path = folder.joinpath(prefix + ".json")
+    result["files"].append(str(path))
+    with path.open("w") as output:
+        json.dump(result, output, indent=2)
+
+    last = result
+    return result
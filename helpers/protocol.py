@@ -0,0 +1,397 @@
+"""
+Encoders and decoders for the JJ2 list server wire formats
+
+Everything that goes over the wire to or from JJ2 (as opposed to ServerNet, which is JSON) is defined here, so the
+handlers don't need to care about byte offsets. Decoders raise ValueError when given data they cannot make sense of.
+"""
+import socket
+import struct
+
+# game modes: JJ2 uses numbers instead of strings, but strings are easier for humans to work with
+# CANNOT use spaces here, as list server scripts may not expect spaces in modes in port 10057 response
+MODES = {
+    1: "battle",
+    2: "treasure",
+    3: "ctf",
+    4: "race",
+    5: "coop",
+    6: "roasttag",
+    7: "lrs",
+    8: "xlrs",
+    9: "pestilence",
+    10: "teambattle",
+    11: "jailbreak",
+    12: "deathctf",
+    13: "flagrun",
+    14: "tlrs",
+    15: "domination",
+    16: "headhunters"
+}
+MODE_NUMBERS = {name: number for number, name in MODES.items()}
+
+# port 10054: listing sent by a server when it connects
+# port (2 bytes, little endian), name (30 bytes), 3 unused bytes, players, max players, flags, version (4 bytes)
+LISTING = struct.Struct("<H30s3xBBB4s")
+LISTING_SIZE = LISTING.size  # 42
+
+# port 10054: updates sent by a listed server; opcode, followed by the new value
+# name updates are the exception, they are the opcode followed by 32 bytes of name
+UPDATES = {
+    0x00: "players",
+    0x01: "mode",
+    0x02: "name",
+    0x03: "max",
+    0x04: "private",
+    0x05: "plusonly"
+}
+UPDATE_OPCODES = {field: opcode for opcode, field in UPDATES.items()}
+NAME_UPDATE_SIZE = 33
+
+# port 10053: binary list header and per-server entry (length, reversed IP, port), followed by the name
+BINARY_HEADER = bytes([7]) + b"LIST" + bytes([1, 1])
+BINARY_ENTRY = struct.Struct("<B4sH")
+
+# port 10057: optional conditional request - clients may send "VERSION [last version they got]" after connecting, and
+# then get "UNCHANGED [version]" if the list has not changed since, or "VERSION [version]" followed by the list. Clients
+# that send nothing get just the list, as always. Clients that add " ZLIB" to the request get "VERSION [version] ZLIB"
+# followed by the zlib-compressed list instead
+LIST_QUERY = b"VERSION"
+LIST_UNCHANGED = b"UNCHANGED"
+LIST_COMPRESSED = b"ZLIB"
+LIST_QUERY_SIZE = 64
+
+# UDP status request sent to game servers
+PING_COMMAND = 0x03
+PING_VERSION = b"24  "
+
+
+def decode_mode(mode):
+    """
+    Get mode name for a mode number
+
+    :param mode: Mode number as sent by the client
+    :return: Mode string, "unknown" for unknown modes
+    """
+    return MODES.get(mode, "unknown")
+
+
+def encode_mode(mode):
+    """
+    Get mode number for a mode name
+
+    :param mode: Mode string
+    :return: Mode number as used by the client, 0 for unknown modes
+    """
+    return MODE_NUMBERS.get(mode, 0)
+
+
+def decode_version(version):
+    """
+    Not a lot to decode for the version string, but people aren't actually playing 1.21
+
+    :param version: Version as sent by the client
+    :return: Version string as used by list server
+    """
+    version = version.decode("ascii", "ignore")
+
+    if version[0:2] == "21":
+        version_string = "1.23"
+    else:
+        version_string = "1.24"
+
+    return version_string + version[2:]
+
+
+def encode_version(version):
+    """
+    Get version bytes for a version string
+
+    Reverse of decode_version()
+
+    :param version: Version string as used by list server, e.g. "1.24+"
+    :return: Four version bytes
+    """
+    prefix = b"21" if version[0:4] == "1.23" else b"24"
+    return (prefix + version[4:].encode("ascii", "ignore")).ljust(4, b" ")[:4]
+
+
+def decode_listing(data):
+    """
+    Decode the packet a server sends to get listed
+
+    :param data: 42 bytes
+    :return: Dictionary with port, name, players, max, private, plusonly, mode and version keys. The name is the raw
+    name field (bytes, including padding); jj2server.strip() sanitises and decodes it in one go. plusonly is the flag
+    bit as is, i.e. 0 or 128, since that is what has always been stored and sent to mirrors for listed servers.
+    """
+    if len(data) != LISTING_SIZE:
+        raise ValueError("Listing should be %i bytes, got %i" % (LISTING_SIZE, len(data)))
+
+    port, name, players, max_players, flags, version = LISTING.unpack(data)
+
+    return {
+        "port": port,
+        "name": name,
+        "players": players,
+        "max": max_players,
+        "private": flags & 1,
+        "plusonly": flags & 128,
+        "mode": decode_mode((flags >> 1) & 31),
+        "version": decode_version(version)
+    }
+
+
+def encode_listing(server):
+    """
+    Encode the packet a server sends to get listed
+
+    Reverse of decode_listing()
+
+    :param server: Dictionary, see decode_listing()
+    :return: 42 bytes
+    """
+    flags = (server["private"] & 1) | ((encode_mode(server["mode"]) & 31) << 1) | (128 if server["plusonly"] else 0)
+    return LISTING.pack(server["port"], server["name"].encode("ascii", "ignore"), server["players"], server["max"],
+                        flags, encode_version(server["version"]))
+
+
+def decode_update(data):
+    """
+    Decode an update sent by a listed server
+
+    :param data: Update packet: opcode and value (2 bytes), or opcode and name (33 bytes)
+    :return: Tuple (property, value); the name is the raw name field (bytes), see decode_listing()
+    """
+    if len(data) < 2 or data[0] not in UPDATES:
+        raise ValueError("Not a valid server update")
+
+    field = UPDATES[data[0]]
+
+    if field == "name":
+        return field, bytes(data[1:NAME_UPDATE_SIZE])
+    elif field == "mode":
+        return field, decode_mode(data[1])
+    elif field == "private" or field == "plusonly":
+        return field, data[1] & 1
+    else:
+        return field, data[1]
+
+
+def encode_update(field, value):
+    """
+    Encode an update sent by a listed server
+
+    Reverse of decode_update()
+
+    :param field: Property
+    :param value: New value
+    :return: Update packet
+    """
+    opcode = UPDATE_OPCODES[field]
+
+    if field == "name":
+        return bytes([opcode]) + value.encode("ascii", "ignore").ljust(NAME_UPDATE_SIZE - 1, b"\x00")[
+                                 :NAME_UPDATE_SIZE - 1]
+    elif field == "mode":
+        return bytes([opcode, encode_mode(value)])
+    else:
+        return bytes([opcode, value])
+
+
+def encode_binary_entry(server):
+    """
+    Encode one server for the binary server list
+
+    :param server: Server record, needs ip, port and name
+    :return: Bytes
+    """
+    name = server["name"].encode("ascii", "ignore")
+    return BINARY_ENTRY.pack(len(name) + BINARY_ENTRY.size, socket.inet_aton(server["ip"])[::-1], server["port"]) + name
+
+
+def encode_binary_list(servers):
+    """
+    Encode the binary server list, as served on port 10053
+
+    :param servers: List of server records
+    :return: Bytes
+    """
+    return BINARY_HEADER + b"".join([encode_binary_entry(server) for server in servers])
+
+
+def decode_binary_list(data):
+    """
+    Decode the binary server list
+
+    Reverse of encode_binary_list()
+
+    :param data: Bytes
+    :return: List of dictionaries with ip, port and name keys
+    """
+    if data[0:len(BINARY_HEADER)] != BINARY_HEADER:
+        raise ValueError("Not a binary server list")
+
+    servers = []
+    offset = len(BINARY_HEADER)
+    while offset < len(data):
+        if offset + BINARY_ENTRY.size > len(data):
+            raise ValueError("Truncated binary server list")
+
+        # length includes the length byte itself
+        length, ip, port = BINARY_ENTRY.unpack_from(data, offset)
+        if length < BINARY_ENTRY.size or offset + length > len(data):
+            raise ValueError("Invalid entry length in binary server list")
+
+        name = data[offset + BINARY_ENTRY.size:offset + length]
+        servers.append({"ip": socket.inet_ntoa(ip[::-1]), "port": port, "name": name.decode("ascii", "ignore")})
+        offset += length
+
+    return servers
+
+
+def encode_ascii_line(server, now):
+    """
+    Encode one server for the ASCII server list, as served on port 10057
+
+    :param server: Server record
+    :param now: Current timestamp, to calculate uptime with
+    :return: Line, including line break
+    """
+    return "%s:%s %s %s %s %s %i [%s/%s] %s\r\n" % (
+        server["ip"], server["port"],
+        "local" if server["remote"] == 0 else "mirror",
+        "public" if server["private"] == 0 else "private",
+        server["mode"],
+        server["version"][:6].ljust(6, " "),
+        int(now) - int(server["created"]),
+        server["players"], server["max"],
+        server["name"])
+
+
+def decode_ascii_line(line, now):
+    """
+    Decode one line of the ASCII server list
+
+    Reverse of encode_ascii_line()
+
+    :param line: Line, with or without line break
+    :param now: Timestamp to calculate creation time with
+    :return: Dictionary with ip, port, remote, private, mode, version, created, players, max and name keys
+    """
+    line = line.rstrip("\r\n")
+    try:
+        address, remote, private, mode, rest = line.split(" ", 4)
+        version, rest = rest[:6], rest[7:]
+        uptime, counts, name = (rest.split(" ", 2) + [""])[:3]
+        ip, port = address.rsplit(":", 1)
+        players, max_players = counts[1:-1].split("/")
+
+        return {"ip": ip, "port": int(port), "remote": 0 if remote == "local" else 1,
+                "private": 0 if private == "public" else 1, "mode": mode, "version": version.rstrip(" "),
+                "created": int(now) - int(uptime), "players": int(players), "max": int(max_players), "name": name}
+    except (ValueError, IndexError):
+        raise ValueError("Not a valid server list line: %s" % repr(line))
+
+
+def decode_list_query(data):
+    """
+    Decode a conditional list request
+
+    :param data: Data sent by the client
+    :return: Tuple: version the client has (bytes, empty if it has none yet), and whether it wants the list compressed
+    """
+    words = bytes(data[:LIST_QUERY_SIZE]).split(b"\n")[0].split()
+    if not words or words[0] != LIST_QUERY:
+        raise ValueError("Not a list request")
+
+    compressed = LIST_COMPRESSED in words[1:]
+    versions = [word for word in words[1:] if word != LIST_COMPRESSED]
+
+    return (versions[0] if versions else b""), compressed
+
+
+def encode_list_response(version, asciilist=None, compressed=False):
+    """
+    Encode the response to a conditional list request
+
+    :param version: Current list version, bytes
+    :param asciilist: ASCII server list (zlib-compressed if `compressed`), or None if the client's version is current
+    :param compressed: Whether the list is compressed
+    :return: Bytes
+    """
+    if asciilist is None:
+        return LIST_UNCHANGED + b" " + bytes(version) + b"\r\n"
+
+    return LIST_QUERY + b" " + bytes(version) + (b" " + LIST_COMPRESSED if compressed else b"") + b"\r\n" + bytes(
+        asciilist)
+
+
+def conditional_list(asciilist, version, query=None, compressed=None):
+    """
+    Get the response for a port 10057 request
+
+    :param asciilist: ASCII server list, bytes
+    :param version: Current list version, bytes
+    :param query: Data sent by the client, if any
+    :param compressed: zlib-compressed ASCII server list, for clients that ask for it
+    :return: Bytes; just the list for clients that did not send a (valid) request
+    """
+    if not query:
+        return asciilist
+
+    try:
+        known, compress = decode_list_query(query)
+    except ValueError:
+        return asciilist
+
+    if known == bytes(version):
+        return encode_list_response(version)
+    elif compress and compressed is not None:
+        return encode_list_response(version, compressed, compressed=True)
+    else:
+        return encode_list_response(version, asciilist)
+
+
+def udpchecksum(bytes):
+    """"
+    Prepend UDP checksum
+
+    JJ2 expects UDP datagrams to be perceded by a two-byte checksum - this method adds that checksum
+    Thanks to DJazz for the PHP reference implementation!
+
+    :param bytes: Bytearray to checksum
+    :return: Bytearray with checksum
+    """
+    x = 1
+    y = 1
+    for byte in bytes[2:]:
+        x += byte
+        y += x
+
+    bytes[0] = x % 251
+    bytes[1] = y % 251
+
+    return bytes
+
+
+def encode_ping(index):
+    """
+    Encode the UDP status request sent to game servers
+
+    :param index: Request number (1-255), echoed by the server
+    :return: Datagram, bytearray
+    """
+    return udpchecksum(bytearray([0x00, 0x00, PING_COMMAND, index, 0x00, 0x00, 0x00, 0x00]) + PING_VERSION)
+
+
+def decode_ping_reply(data):
+    """
+    Decode the reply to a UDP status request
+
+    :param data: Datagram as received
+    :return: Dictionary with private key
+    """
+    if len(data) < 9:
+        raise ValueError("Status reply too short")
+
+    return {"private": (data[8] >> 5) & 1}
@@ -0,0 +1,170 @@
+"""
+Database schema and migrations
+
+The servers table is emptied whenever the list server starts, so it is simply recreated with the current schema. The
+other tables are kept, so changes to them are made by migrations: functions that each bring the database from one
+schema version to the next. The schema_version table records which migrations have been applied; migrations that have
+not are run in order, each in its own transaction, when the list server starts.
+"""
+import time
+
+# servers are looked up by ID all the time, so the ID is the primary key and rows are stored in ID order
+SERVERS_TABLE = "CREATE TABLE servers (id TEXT PRIMARY KEY, ip TEXT, port INTEGER, created INTEGER DEFAULT 0, " \
+                "lifesign INTEGER DEFAULT 0, last_ping INTEGER DEFAULT 0, private INTEGER DEFAULT 0, " \
+                "remote INTEGER DEFAULT 0, origin TEXT, version TEXT DEFAULT '1.00', plusonly INTEGER DEFAULT 0, " \
+                "mode TEXT DEFAULT 'unknown', players INTEGER DEFAULT 0, max INTEGER DEFAULT 0, name TEXT, " \
+                "prefer INTEGER DEFAULT 0) WITHOUT ROWID"
+
+# one index per access path: servers per IP (and port) for listing limits, servers to ping per origin, and remote
+# servers that timed out
+SERVERS_INDEXES = [
+    "CREATE INDEX servers_address ON servers (ip, port)",
+    "CREATE INDEX servers_ping ON servers (origin, last_ping)",
+    "CREATE INDEX servers_timeout ON servers (remote, lifesign)"
+]
+
+
+def create_servers(db):
+    """
+    (Re)create the servers table
+
+    :param db: Database connection or cursor
+    :return: Nothing
+    """
+    db.execute("DROP TABLE IF EXISTS servers")
+    db.execute(SERVERS_TABLE)
+    for index in SERVERS_INDEXES:
+        db.execute(index)
+
+
+def columns(db, table):
+    """
+    Get the columns of a table
+
+    :param db: Database connection or cursor
+    :param table: Table name
+    :return: List of column names, empty if the table does not exist
+    """
+    return [column[1] for column in db.execute("PRAGMA table_info(%s)" % table).fetchall()]
+
+
+def initial_tables(db, ls):
+    """
+    Create the tables that were created before there were migrations, if they do not exist yet
+
+    Databases from before migrations may be in any state, so this checks for each table and column that was added over
+    time.
+
+    :param db: Database connection
+    :param ls: List server object
+    :return: Nothing
+    """
+    if not columns(db, "settings"):
+        ls.log.info("Table 'settings' does not exist yet, creating and populating.")
+        db.execute("CREATE TABLE settings (item TEXT UNIQUE, value TEXT)")
+        db.execute("INSERT INTO settings (item, value) VALUES (?, ?), (?, ?)", ("motd", "", "motd-updated", "0"))
+
+    # was not a setting initially, so may need to add entry
+    if not db.execute("SELECT * FROM settings WHERE item = ?", ("motd-expires",)).fetchone():
+        db.execute("INSERT INTO settings (item, value) VALUES (?, ?)", ("motd-expires", int(time.time()) + (3 * 86400)))
+
+    banlist = columns(db, "banlist")
+    if not banlist:
+        ls.log.info("Table 'banlist' does not exist yet, creating.")
+        db.execute("CREATE TABLE banlist (address TEXT, type TEXT, note TEXT, origin TEXT, reserved TEXT DEFAULT '')")
+    elif "reserved" not in banlist:
+        db.execute("ALTER TABLE banlist ADD COLUMN reserved TEXT DEFAULT ''")
+
+    # the master list server is added as a mirror by helpers.startup, as that needs a DNS lookup
+    if not columns(db, "mirrors"):
+        ls.log.info("Table 'mirrors' does not exist yet, creating.")
+        db.execute("CREATE TABLE mirrors (name TEXT, address TEXT, lifesign INTEGER DEFAULT 0)")
+
+
+def indexes(db, ls):
+    """
+    Add indexes and keys
+
+    Banlist entries are unique, so duplicates (which could be created by mirrors syncing at the same time) are removed
+    and a unique key makes sure there will be no new ones. Settings are a key-value table, so they are stored by key.
+
+    :param db: Database connection
+    :param ls: List server object
+    :return: Nothing
+    """
+    removed = db.execute("DELETE FROM banlist WHERE rowid NOT IN (SELECT MIN(rowid) FROM banlist "
+                         "GROUP BY address, type, note, origin, reserved)").rowcount
+    if removed > 0:
+        ls.log.info("Removed %i duplicate banlist entries" % removed)
+
+    db.execute("CREATE UNIQUE INDEX banlist_entry ON banlist (address, type, note, origin, reserved)")
+    db.execute("CREATE INDEX banlist_type ON banlist (type, address)")
+    db.execute("CREATE INDEX mirrors_address ON mirrors (address)")
+
+    db.execute("CREATE TABLE settings_keyed (item TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID")
+    db.execute("INSERT OR IGNORE INTO settings_keyed (item, value) SELECT item, value FROM settings WHERE item IS NOT NULL")
+    db.execute("DROP TABLE settings")
+    db.execute("ALTER TABLE settings_keyed RENAME TO settings")
+
+
+def change_times(db, ls):
+    """
+    Record when banlist entries and mirrors were added
+
+    Lets a list server that restarts ask mirrors for only what changed while it was down, see helpers.warmstart.
+    Existing rows get 0, i.e. "before anyone could have missed them".
+
+    :param db: Database connection
+    :param ls: List server object
+    :return: Nothing
+    """
+    db.execute("ALTER TABLE banlist ADD COLUMN updated INTEGER DEFAULT 0")
+    db.execute("ALTER TABLE mirrors ADD COLUMN updated INTEGER DEFAULT 0")
+    db.execute("CREATE INDEX banlist_updated ON banlist (updated)")
+
+
+# in order; the schema version is the amount of migrations that have been applied
+MIGRATIONS = [initial_tables, indexes, change_times]
+
+
+def version(db):
+    """
+    Get the current schema version
+
+    :param db: Database connection
+    :return: Version, 0 if no migrations have been applied yet
+    """
+    db.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied INTEGER)")
+    return db.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
+
+
+def migrate(db, ls):
+    """
+    Apply all migrations that have not been applied yet
+
+    Each migration is applied in its own transaction, so a migration that fails leaves the database as it was before
+    that migration.
+
+    :param db: Database connection, in autocommit mode (isolation_level None) so schema changes can be rolled back
+    :param ls: List server object
+    :return: Schema version after migrating
+    """
+    current = version(db)
+
+    for number, migration in enumerate(MIGRATIONS, start=1):
+        if number <= current:
+            continue
+
+        ls.log.info("Updating database schema to version %i (%s)" % (number, migration.__name__))
+        db.execute("BEGIN")
+        try:
+            migration(db, ls)
+            db.execute("INSERT INTO schema_version (version, applied) VALUES (?, ?)", (number, int(time.time())))
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+        current = number
+
+    return current
@@ -1,5 +1,816 @@
-import socket
+import collections
+import itertools
 import threading
+import operator
+import socket
+import config
+import struct
+import json
+import zlib
+import time
+
+from helpers.functions import fetch_all, query
+
+# optional features this list server supports, announced to mirrors in "request" and "hello" messages
+CAPABILITIES = ["zlib", "binary1", "relay1"]
+
+# messages to mirrors that support it may be zlib-compressed; compressed messages start with this instead of "{"
+COMPRESSED_MAGIC = b"J2Z1"
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # no legitimate message is this big, compressed or not
+
+# admin connections on port 10059 that start with this send length-prefixed commands until they close, see
+# servernet_handler.session()
+SESSION_MAGIC = b"J2A1"
+FRAME_HEADER = struct.Struct(">I")
+
+# bulky messages to mirrors with the "binary1" capability are sent in a compact binary format instead of JSON, see
+# encode_binary(); the header holds the magic, flags and the length of the rest of the message
+BINARY_MAGIC = b"J2B1"
+BINARY_HEADER = struct.Struct(">4sBI")
+BINARY_BODY = struct.Struct(">BIII")  # action, amount of items, amount of integers, length of string table
+BINARY_COMPRESSED = 0x01  # flag: rest of message is zlib-compressed
+BINARY_WIDE = 0x02  # flag: integers are 64 rather than 32 bits
+
+# properties per action that can be sent in binary form, and whether they are integers (else strings). The order is
+# part of the format: messages with other properties (e.g. a column added later) are sent as JSON, and adding them
+# here means bumping the magic and capability. Actions can have at most 16 properties
+BINARY_ACTIONS = {
+    "server": (("id", False), ("ip", False), ("port", True), ("created", True), ("lifesign", True),
+               ("last_ping", True), ("private", True), ("remote", True), ("origin", False), ("version", False),
+               ("plusonly", True), ("mode", False), ("players", True), ("max", True), ("name", False),
+               ("prefer", True)),
+    "add-banlist": (("address", False), ("type", False), ("note", False), ("origin", False), ("reserved", False))
+}
+BINARY_ACTIONS["delist"] = BINARY_ACTIONS["server"]  # delistings send the full server record
+BINARY_ACTION_IDS = ("server", "delist", "add-banlist")
+
+# mirrors with the "relay1" capability may be sent a message along with a list of other mirrors to pass it on to, so
+# the list server it comes from does not have to send it to every mirror itself (see SERVERNET_FANOUT). Such messages
+# are wrapped in an envelope: the magic, the length of the list, the list, and the message as it would be sent otherwise
+RELAY_MAGIC = b"J2R1"
+RELAY_HEADER = struct.Struct(">4sI")
+RELAY_ACTIONS = ("server", "delist", "add-banlist", "delete-banlist", "add-mirror", "delete-mirror", "set-motd")
+
+layouts = {action: {} for action in BINARY_ACTIONS}  # action: {property mask: layout}, see binary_layout()
+key_masks = {action: {} for action in BINARY_ACTIONS}  # action: {property names, in order: property mask}
+
+
+def introduction(address, **kwargs):
+    """
+    Get the data item for a "request" or "hello" message
+
+    :param address: Name of this list server
+    :param kwargs: Additional items, e.g. fragment
+    :return: Dictionary
+    """
+    return {"from": address, "capabilities": CAPABILITIES, **kwargs}
+
+
+def chunks(items, size=None):
+    """
+    Split the items of a message into chunks, so bulky messages are sent as several messages of manageable size
+
+    :param items: List of data items
+    :param size: Items per chunk, SERVERNET_CHUNK by default
+    :return: Generator yielding lists of items
+    """
+    size = size or config.SERVERNET_CHUNK
+    for offset in range(0, len(items), size):
+        yield items[offset:offset + size]
+
+
+def encode_message(message, compress=False):
+    """
+    Encode a ServerNet message for sending
+
+    :param message: JSON message, string
+    :param compress: Whether to compress it
+    :return: Bytes
+    """
+    message = message.encode("ascii", "ignore")
+    return COMPRESSED_MAGIC + zlib.compress(message) if compress else message
+
+
+def encode_payload(payload, binary=False, compress=False):
+    """
+    Encode a ServerNet message for sending, in the most compact form the recipient supports
+
+    :param payload: Message, dictionary with action, data, origin and id
+    :param binary: Whether the recipient supports the binary format
+    :param compress: Whether the recipient supports compressed messages
+    :return: Bytes
+    """
+    if binary and payload["action"] in BINARY_ACTIONS:
+        try:
+            return encode_binary(payload, compress)
+        except ValueError:
+            pass  # e.g. unexpected properties or values, which JSON can handle
+
+    message = json.dumps(payload)
+    return encode_message(message, compress=compress and 0 < config.SERVERNET_COMPRESS <= len(message))
+
+
+def binary_layout(action, mask):
+    """
+    Get which properties an item in a binary message has
+
+    Items in a message usually all have the same properties, so layouts are only worked out once per combination.
+
+    :param action: Action, one of BINARY_ACTIONS
+    :param mask: Bit mask of properties, bit 0 being the first property of the action
+    :return: Tuple: names of integer properties, names of string properties, functions that get the values of those
+    from an item, as tuples, and a dictionary with all those properties set to None
+    """
+    if mask not in layouts[action]:
+        properties = [property for bit, property in enumerate(BINARY_ACTIONS[action]) if mask & (1 << bit)]
+        integer_names = tuple([name for name, integer in properties if integer])
+        string_names = tuple([name for name, integer in properties if not integer])
+        layouts[action][mask] = (integer_names, string_names, getter(integer_names), getter(string_names),
+                                 dict.fromkeys(integer_names + string_names))
+
+    return layouts[action][mask]
+
+
+def getter(names):
+    """
+    Get a function that gets values from a dictionary
+
+    Like operator.itemgetter, but always returns a tuple.
+
+    :param names: Keys to get the values of
+    :return: Function
+    """
+    if len(names) > 1:
+        return operator.itemgetter(*names)
+    elif names:
+        return lambda item: (item[names[0]],)
+    else:
+        return lambda item: ()
+
+
+def encode_binary(payload, compress=False):
+    """
+    Encode a ServerNet message in binary form
+
+    Rather than repeating every property name for every item, each item is described by two bit masks: which of the
+    action's properties it has, and which of those are null (these are sent as 0 or an empty string, so items with the
+    same properties have the same layout whether they are null or not). All integers in the message are then packed
+    into one array, and all strings are joined into one table, so a message can be encoded and decoded with a handful
+    of calls per item, most of them not in Python. Like JSON messages, binary messages may be compressed; since the
+    header says how long the message is, the recipient knows when it has received all of it either way.
+
+    :param payload: Message, dictionary with action, data, origin and id; action should be one of BINARY_ACTIONS
+    :param compress: Whether the message may be compressed, if it is large enough
+    :return: Bytes; raises ValueError if the message can not be represented in binary form
+    """
+    action = payload["action"]
+    known = key_masks[action]
+    properties = {name: 1 << bit for bit, (name, integer) in enumerate(BINARY_ACTIONS[action])}
+    integer_properties = dict(BINARY_ACTIONS[action])
+    masks = []
+    integers = []
+    strings = [payload["origin"], payload["id"]]
+
+    try:
+        for item in payload["data"]:
+            keys = tuple(item)
+            if keys not in known:
+                mask = 0
+                for key in keys:
+                    mask |= properties[key]
+                if len(known) < 64:
+                    known[keys] = mask
+            else:
+                mask = known[keys]
+
+            null = 0
+            if None in item.values():
+                # null properties are sent as 0 or an empty string, and marked as null
+                for key, value in item.items():
+                    if value is None:
+                        null |= properties[key]
+                item = {key: (0 if integer_properties[key] else "") if value is None else value
+                        for key, value in item.items()}
+
+            integer_values, string_values = binary_layout(action, mask)[2:4]
+            masks += (mask, null)
+            integers += integer_values(item)
+            strings += string_values(item)
+
+        table = "\x00".join(strings)
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError("Message has items that can not be encoded")
+
+    if table.count("\x00") != len(strings) - 1:
+        raise ValueError("Message has strings that can not be encoded")  # strings containing the separator
+
+    table = table.encode("utf-8", "surrogatepass")
+    try:
+        wide = bool(integers) and (min(integers) < -0x80000000 or max(integers) > 0x7fffffff)
+        body = BINARY_BODY.pack(BINARY_ACTION_IDS.index(action), len(masks) // 2, len(integers), len(table)) + \
+               struct.pack(">%iH%i%s" % (len(masks), len(integers), "q" if wide else "i"), *masks, *integers) + table
+    except (struct.error, OverflowError, TypeError):
+        raise ValueError("Message has numbers that can not be encoded")  # including non-integers, e.g. "10052"
+
+    flags = BINARY_WIDE if wide else 0
+    if compress and 0 < config.SERVERNET_COMPRESS <= len(body):
+        body = zlib.compress(body)
+        flags |= BINARY_COMPRESSED
+
+    return BINARY_HEADER.pack(BINARY_MAGIC, flags, len(body)) + body
+
+
+def decode_binary(data):
+    """
+    Decode a ServerNet message in binary form
+
+    :param data: Message as received, see encode_binary()
+    :return: Message, dictionary with action, data, origin and id; raises ValueError if the message is incomplete or
+    invalid
+    """
+    if len(data) < BINARY_HEADER.size:
+        raise ValueError("Incomplete binary message")
+
+    magic, flags, length = BINARY_HEADER.unpack_from(data)
+    if length > MAX_MESSAGE_SIZE:
+        raise ValueError("Binary message too large")
+    elif len(data) < BINARY_HEADER.size + length:
+        raise ValueError("Incomplete binary message")
+
+    body = bytes(data[BINARY_HEADER.size:BINARY_HEADER.size + length])
+    if flags & BINARY_COMPRESSED:
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, MAX_MESSAGE_SIZE)
+        except zlib.error:
+            raise ValueError("Invalid compressed message")
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError("Invalid compressed message")
+
+    try:
+        action_id, items, amount, table_length = BINARY_BODY.unpack_from(body)
+        action = BINARY_ACTION_IDS[action_id]
+        numbers = struct.Struct(">%iH%i%s" % (items * 2, amount, "q" if flags & BINARY_WIDE else "i"))
+        unpacked = numbers.unpack_from(body, BINARY_BODY.size)
+    except (struct.error, IndexError):
+        raise ValueError("Invalid binary message")
+
+    offset = BINARY_BODY.size + numbers.size
+    if len(body) != offset + table_length:
+        raise ValueError("Invalid binary message")
+
+    try:
+        strings = body[offset:].decode("utf-8", "surrogatepass").split("\x00")
+    except UnicodeDecodeError:
+        raise ValueError("Invalid binary message")
+
+    masks = unpacked[:items * 2]
+    if len(strings) < 2 or any([mask >> len(BINARY_ACTIONS[action]) for mask in masks]):
+        raise ValueError("Invalid binary message")
+
+    origin, message_id, *strings = strings
+    integers = unpacked[items * 2:]
+    data = []
+
+    if items and len(set(masks[0::2])) == 1:
+        # usually all items have the same properties, so the values can simply be split into rows
+        integer_names, string_names = binary_layout(action, masks[0])[:2]
+        if len(integer_names) * items != len(integers) or len(string_names) * items != len(strings):
+            raise ValueError("Invalid binary message")
+
+        names = integer_names + string_names
+        integer_rows = zip(*[iter(integers)] * len(integer_names)) if integer_names else itertools.repeat(())
+        string_rows = zip(*[iter(strings)] * len(string_names)) if string_names else itertools.repeat(())
+        data = [dict(zip(names, integer_row + string_row)) for integer_row, string_row, index in
+                zip(integer_rows, string_rows, range(0, items))]
+    else:
+        # zip() stops at the end of the property names, so each item takes exactly as many values as it has properties
+        integer_values = iter(integers)
+        string_values = iter(strings)
+        integers_used = strings_used = 0
+        for index in range(0, items * 2, 2):
+            integer_names, string_names = binary_layout(action, masks[index])[:2]
+            item = dict(zip(integer_names, integer_values))
+            item.update(zip(string_names, string_values))
+            integers_used += len(integer_names)
+            strings_used += len(string_names)
+            data.append(item)
+
+        if integers_used != len(integers) or strings_used != len(strings):
+            raise ValueError("Invalid binary message")
+
+    for index in range(1, items * 2, 2):
+        if masks[index]:
+            data[index // 2].update(binary_layout(action, masks[index])[4])
+
+    return {"action": action, "data": data, "origin": origin, "id": message_id}
+
+
+def relay_plan(recipients, fanout, relays):
+    """
+    Decide which mirrors to send a message to directly, and which of them pass it on to which others
+
+    The recipients are split into at most `fanout` groups, each headed by a mirror that can relay messages. The head
+    is sent the message along with the rest of its group, and does the same with them, so everyone gets the message
+    exactly once, while no list server sends it more than `fanout` times. Mirrors that can not relay are only ever at
+    the end of the line.
+
+    :param recipients: Addresses of mirrors that should get the message
+    :param fanout: Amount of mirrors to send it to directly at most; 0 to send it to all recipients directly
+    :param relays: Addresses of recipients that can relay messages
+    :return: List of tuples: address to send to, and list of addresses it should pass the message on to
+    """
+    heads = [recipient for recipient in recipients if recipient in relays][:fanout]
+    if not fanout or len(recipients) <= fanout or not heads:
+        return [(recipient, []) for recipient in recipients]
+
+    groups = {head: [] for head in heads}
+    rest = [recipient for recipient in recipients if recipient not in groups]
+    for index, recipient in enumerate(rest):
+        groups[heads[index % len(heads)]].append(recipient)
+
+    return list(groups.items())
+
+
+def encode_relay(message, relay):
+    """
+    Wrap an encoded message in an envelope, for a mirror that is to pass it on
+
+    :param message: Message, encoded as it would be sent to the mirror otherwise
+    :param relay: List of addresses of mirrors to pass it on to
+    :return: Bytes
+    """
+    table = "\x00".join(relay).encode("ascii", "ignore")
+    return RELAY_HEADER.pack(RELAY_MAGIC, len(table)) + table + message
+
+
+def decode_message(data):
+    """
+    Decode a received ServerNet message
+
+    If the message is to be passed on to other mirrors, the decoded message has a "relay" item listing them.
+
+    :param data: Data received so far
+    :return: Message, decoded; raises ValueError if the message is incomplete or invalid
+    """
+    if data[:len(RELAY_MAGIC)] == RELAY_MAGIC:
+        if len(data) < RELAY_HEADER.size:
+            raise ValueError("Incomplete relayed message")
+
+        length = RELAY_HEADER.unpack_from(data)[1]
+        if length > MAX_MESSAGE_SIZE or len(data) < RELAY_HEADER.size + length:
+            raise ValueError("Incomplete relayed message")
+
+        relay = bytes(data[RELAY_HEADER.size:RELAY_HEADER.size + length]).decode("ascii", "ignore").split("\x00")
+        payload = decode_message(data[RELAY_HEADER.size + length:])
+        if not isinstance(payload, dict):
+            raise ValueError("Invalid relayed message")
+
+        payload["relay"] = [address for address in relay if address]
+        return payload
+
+    if data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+        return decode_binary(data)
+
+    if data[:len(COMPRESSED_MAGIC)] != COMPRESSED_MAGIC:
+        return unwrapped(json.loads(data.decode("ascii", "ignore")))
+
+    decompressor = zlib.decompressobj()
+    try:
+        message = decompressor.decompress(bytes(data[len(COMPRESSED_MAGIC):]), MAX_MESSAGE_SIZE)
+    except zlib.error:
+        raise ValueError("Invalid compressed message")
+
+    if decompressor.unconsumed_tail:
+        raise ValueError("Compressed message too large")
+    elif not decompressor.eof:
+        raise ValueError("Incomplete compressed message")
+
+    return unwrapped(json.loads(message.decode("ascii", "ignore")))
+
+
+def unwrapped(payload):
+    """
+    Make sure a message that did not come in an envelope is not passed on
+
+    Only list servers that relay it themselves decide who else gets a message, so a "relay" item in the message
+    itself is ignored.
+
+    :param payload: Decoded JSON message
+    :return: The message, without "relay" item
+    """
+    if isinstance(payload, dict):
+        payload.pop("relay", None)
+
+    return payload
+
+
+def incomplete(data):
+    """
+    Check whether a message is known to be incomplete
+
+    Only binary messages say how long they are; for others, there is no way to tell other than trying to decode them.
+
+    :param data: Data received so far
+    :return: True if data is the start of a binary or relayed message that has not been received completely
+    """
+    if data and data[:len(RELAY_MAGIC)] == RELAY_MAGIC[:len(data)]:
+        if len(data) < RELAY_HEADER.size:
+            return True
+
+        length = RELAY_HEADER.unpack_from(data)[1]
+        if length > MAX_MESSAGE_SIZE:
+            return False
+        elif len(data) < RELAY_HEADER.size + length:
+            return True
+
+        return incomplete(data[RELAY_HEADER.size + length:])
+
+    if not data or data[:len(BINARY_MAGIC)] != BINARY_MAGIC[:len(data)]:
+        return False
+    elif len(data) < BINARY_HEADER.size:
+        return True
+
+    length = BINARY_HEADER.unpack_from(data)[2]
+    return length <= MAX_MESSAGE_SIZE and len(data) < BINARY_HEADER.size + length
+
+
+class circuit_breaker:
+    """
+    Circuit breaker for messages to a single mirror
+
+    "closed" is the normal state, in which everything is sent. After MIRROR_FAILURES consecutive failed sends the
+    breaker goes "open" and nothing is sent to the mirror for MIRROR_RETRY seconds. After that it is "half-open": one
+    message is let through as a trial, and depending on whether that succeeds the breaker closes or opens again.
+
+    Messages that cannot be sent, because the breaker is not closed or because sending them failed, are either dropped
+    or kept to be sent once the mirror is reachable again, depending on the action: server updates are superseded by a
+    full sync once the mirror is back, but banlist changes and the like would otherwise be lost.
+    """
+    retry_actions = ("add-banlist", "delete-banlist", "add-mirror", "delete-mirror", "set-motd")
+
+    def __init__(self):
+        """
+        Set up breaker, closed
+        """
+        self.lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened = 0
+        self.trial = False
+        self.queue = collections.deque(maxlen=config.MIRROR_QUEUE)
+        self.dropped = 0
+        self.recovered = False
+
+    def allow(self):
+        """
+        Check whether a message may be sent
+
+        :return: True if message may be sent
+        """
+        with self.lock:
+            if self.state == "open" and self.opened < time.time() - config.MIRROR_RETRY:
+                self.state = "half-open"
+                self.trial = False
+
+            if self.state == "closed":
+                return True
+
+            if self.state == "half-open" and not self.trial:
+                self.trial = True
+                return True
+
+            return False
+
+    def defer(self, action, data):
+        """
+        Keep or drop a message that may not be sent right now
+
+        :param action: Message action
+        :param data: Message, serialised
+        :return: True if message was kept, False if dropped
+        """
+        with self.lock:
+            if action not in self.retry_actions:
+                self.dropped += 1
+                return False
+
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1  # oldest message is pushed out of the queue
+
+            self.queue.append(data)
+            return True
+
+    def requeue(self, messages):
+        """
+        Put back kept messages that could not be sent after all
+
+        They are put back in front of messages kept since, so they are still sent in the original order.
+
+        :param messages: List of messages, serialised, as returned by success()
+        :return: Nothing
+        """
+        with self.lock:
+            for data in reversed(messages):
+                if len(self.queue) == self.queue.maxlen:
+                    self.dropped += 1  # newest message is pushed out of the queue
+                self.queue.appendleft(data)
+
+    def success(self):
+        """
+        Register successful send
+
+        Closes the breaker.
+
+        :return: List of messages that were kept while the breaker was not closed, which can now be sent
+        """
+        with self.lock:
+            self.recovered = self.state != "closed"
+            self.state = "closed"
+            self.failures = 0
+            self.trial = False
+
+            queued = list(self.queue)
+            self.queue.clear()
+
+        return queued
+
+    def failure(self):
+        """
+        Register failed send
+
+        Opens the breaker if the trial message failed or too many messages failed in a row.
+
+        :return: Nothing
+        """
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+
+            if self.state == "half-open" or self.failures >= config.MIRROR_FAILURES:
+                self.state = "open"
+                self.opened = time.time()
+
+
+class mirror_directory:
+    """
+    In-memory directory of ServerNet mirrors
+
+    Keeps the addresses of all known mirrors, so checking whether a connection comes from a mirror does not need a
+    database query, and some metadata per mirror (name, lifesign, a circuit breaker that tracks whether it can be
+    reached, how long the last successful send took, and which optional features it supports). Reload it whenever the
+    mirrors table changes.
+    """
+    addresses = frozenset()
+    mirrors = {}
+
+    def __init__(self):
+        """
+        Set up directory
+
+        Mirrors are not loaded until load() is called, since the database may not have been prepared yet.
+        """
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        (Re-)load mirrors from the database
+
+        Health metadata is kept for mirrors that were already known.
+
+        :return: Nothing
+        """
+        rows = fetch_all("SELECT name, address, lifesign FROM mirrors")
+
+        with self.lock:
+            mirrors = {}
+            for row in rows:
+                mirror = self.mirrors.get(row["address"], {"breaker": circuit_breaker(), "rtt": None,
+                                                           "capabilities": frozenset()})
+                mirror.update({"name": row["name"], "address": row["address"], "lifesign": int(row["lifesign"] or 0)})
+                mirrors[row["address"]] = mirror
+
+            self.mirrors = mirrors
+            self.addresses = frozenset(mirrors)
+
+    def __contains__(self, address):
+        """
+        Check if address belongs to a known mirror
+
+        :param address: IP address
+        :return: True if mirror, False if not
+        """
+        return address in self.addresses
+
+    def all(self):
+        """
+        Get all mirror addresses
+
+        :return: List of addresses
+        """
+        return list(self.addresses)
+
+    def get(self, address):
+        """
+        Get mirror metadata
+
+        :param address: Mirror address
+        :return: Dictionary with name, address, lifesign, state, queued, dropped, rtt and capabilities keys, or None
+        if mirror is unknown
+        """
+        mirror = self.mirrors.get(address)
+        if not mirror:
+            return None
+
+        return {"name": mirror["name"], "address": mirror["address"], "lifesign": mirror["lifesign"],
+                "rtt": mirror["rtt"], "state": mirror["breaker"].state, "queued": len(mirror["breaker"].queue),
+                "dropped": mirror["breaker"].dropped, "capabilities": sorted(mirror["capabilities"])}
+
+    def sorted(self):
+        """
+        Get metadata for all mirrors, most recently seen first
+
+        :return: List of dictionaries, see get()
+        """
+        return sorted([self.get(address) for address in self.mirrors], key=lambda mirror: mirror["lifesign"],
+                      reverse=True)
+
+    def health(self):
+        """
+        Get what is known about how well each mirror can be reached, to be restored with restore()
+
+        Messages kept for mirrors are not included; they are sent as they are before the list server stops.
+
+        :return: List of dictionaries with address, rtt, state, opened and capabilities keys
+        """
+        return [{"address": address, "rtt": mirror["rtt"], "state": mirror["breaker"].state,
+                 "opened": mirror["breaker"].opened, "capabilities": sorted(mirror["capabilities"])} for
+                address, mirror in list(self.mirrors.items())]
+
+    def restore(self, health):
+        """
+        Restore mirror health as it was before restarting
+
+        Mirrors that could not be reached are not tried again before they would have been otherwise, and mirrors that
+        supported e.g. compression can be sent compressed messages right away.
+
+        :param health: List of dictionaries, see health()
+        :return: Nothing
+        """
+        for item in health:
+            mirror = self.mirrors.get(item.get("address"))
+            if not mirror:
+                continue  # deleted in the meantime
+
+            mirror["rtt"] = item.get("rtt")
+            mirror["capabilities"] = frozenset([str(capability) for capability in item.get("capabilities", [])])
+            if item.get("state") == "open":
+                mirror["breaker"].state = "open"
+                mirror["breaker"].opened = item.get("opened", 0)
+
+    def update_lifesign(self, address):
+        """
+        Note that a mirror is still alive
+
+        The database record is only updated once a minute at most; the in-memory value is always current.
+
+        :param address: Mirror address
+        :return: Nothing
+        """
+        now = int(time.time())
+        with self.lock:
+            if address not in self.mirrors:
+                return
+            mirror = self.mirrors[address]
+            previous = mirror["lifesign"]
+            mirror["lifesign"] = now
+
+        if previous < now - 60:
+            query("UPDATE mirrors SET lifesign = ? WHERE address = ?", (now, address))
+
+    def set_capabilities(self, address, capabilities):
+        """
+        Note which optional features a mirror supports
+
+        :param address: Mirror address
+        :param capabilities: List of capabilities, as announced by the mirror
+        :return: Nothing
+        """
+        mirror = self.mirrors.get(address)
+        if mirror:
+            mirror["capabilities"] = frozenset([str(capability) for capability in capabilities])
+
+    def supports(self, address, capability):
+        """
+        Check whether a mirror supports an optional feature
+
+        :param address: Mirror address
+        :param capability: Capability, e.g. "zlib"
+        :return: True if the mirror announced it supports it
+        """
+        mirror = self.mirrors.get(address)
+        return capability in mirror["capabilities"] if mirror else False
+
+    def allow(self, address):
+        """
+        Check whether a message may be sent to a mirror
+
+        :param address: Mirror address
+        :return: False if the mirror's circuit breaker does not allow it, True otherwise (also for unknown addresses)
+        """
+        mirror = self.mirrors.get(address)
+        return mirror["breaker"].allow() if mirror else True
+
+    def defer(self, address, action, data):
+        """
+        Keep or drop a message that may not be sent to a mirror right now
+
+        :param address: Mirror address
+        :param action: Message action
+        :param data: Message, serialised
+        :return: True if message was kept, False if dropped
+        """
+        mirror = self.mirrors.get(address)
+        return mirror["breaker"].defer(action, data) if mirror else False
+
+    def requeue(self, address, messages):
+        """
+        Put back messages that were kept for a mirror but could not be sent after all
+
+        :param address: Mirror address
+        :param messages: List of messages, serialised
+        :return: Nothing
+        """
+        mirror = self.mirrors.get(address)
+        if mirror:
+            mirror["breaker"].requeue(messages)
+
+    def report(self, address, success, rtt=None):
+        """
+        Record the result of sending something to a mirror
+
+        Successful sends also count as a lifesign.
+
+        :param address: Mirror address
+        :param success: Whether the mirror could be reached
+        :param rtt: Time it took to connect and send, in seconds
+        :return: Tuple: list of messages that were kept for the mirror and can be sent now that it is reachable
+        again, and whether the mirror just became reachable again after its breaker was opened
+        """
+        mirror = self.mirrors.get(address)
+        if not mirror:
+            return [], False
+
+        if not success:
+            mirror["breaker"].failure()
+            return [], False
+
+        mirror["rtt"] = rtt
+        self.update_lifesign(address)
+        queued = mirror["breaker"].success()
+
+        return queued, mirror["breaker"].recovered
+
+
+class message_log:
+    """
+    Bounded record of recently received ServerNet messages
+
+    Outgoing messages are stamped with an ID that is unique for the list server that sent them; keeping track of which
+    IDs have been seen recently allows dropping duplicates and replays before doing anything with them. Only the most
+    recent IDs are remembered, oldest are forgotten first.
+    """
+
+    def __init__(self, size=None):
+        """
+        Set up log
+
+        :param size: Amount of message IDs to remember
+        """
+        self.lock = threading.Lock()
+        self.size = size if size else config.SERVERNET_SEEN
+        self.ids = collections.OrderedDict()
+
+    def seen(self, origin, message_id):
+        """
+        Check if message was seen before, and remember it if not
+
+        :param origin: Name of list server the message originates from
+        :param message_id: Message ID
+        :return: True if message was seen before, False if not
+        """
+        key = (origin, message_id)
+
+        with self.lock:
+            if key in self.ids:
+                self.ids.move_to_end(key)
+                return True
+
+            self.ids[key] = True
+            if len(self.ids) > self.size:
+                self.ids.popitem(last=False)
+
+        return False
 
 
 class broadcaster(threading.Thread):
@@ -9,44 +820,106 @@ class broadcaster(threading.Thread):
     To be threaded, as multiple messages may need to be sent and messages may time out, etc
     """
 
-    def __init__(self, ip=None, data=None, ls=None):
+    def __init__(self, ip=None, data=None, ls=None, payload=None, relay=None):
         """
         Set up sender
 
         Note that this does no checking of whether the address is a valid mirror; this is done in the main thread
 
         :param ip: IP address of mirror to send to
-        :param data: Data to send
+        :param data: Data to send, without relay envelope
         :param ls: List server thread reference, for logging etc
+        :param payload: Message, decoded
+        :param relay: List of addresses of mirrors the mirror is to pass the message on to
         """
         threading.Thread.__init__(self)
 
         self.ip = ip
         self.data = data
         self.ls = ls
+        self.payload = payload
+        self.relay = relay
 
     def run(self):
         """
         Send message
 
         Connects to the mirror on port 10056, and sends the message; timeout is set at 5 seconds, which should be
-        plenty.
+        plenty. The result is reported to the mirror directory; if messages were kept for the mirror while it was
+        unreachable, they are sent afterwards, and the mirror is greeted so both sides sync the server updates that
+        were dropped in the meantime. Messages that can not be sent are kept for later or dropped, as if the mirror's
+        circuit breaker had been open. If the mirror was to pass the message on but can not be reached, the message is
+        sent to the mirrors it was to pass it on to instead.
 
         :return: Nothing
         """
+        queue = [self.data]
+        delivered = False
+        first = True
+
+        while queue:
+            data = queue.pop(0)
+            start = time.time()
+            success = self.send(encode_relay(data, self.relay) if first and self.relay else data)
+            queued, recovered = self.ls.mirrors.report(self.ip, success, time.time() - start)
+
+            if not success:
+                # keep what could not be sent for the next attempt, as if the breaker had been open
+                if first:
+                    self.ls.mirrors.defer(self.ip, self.payload["action"], data)
+                else:
+                    self.ls.mirrors.requeue(self.ip, [data] + queue)
+                break
+
+            delivered = True
+            first = False
+            queue.extend(queued)
+
+            if recovered:
+                self.ls.log.info("ServerNet mirror %s is reachable again" % self.ip)
+                self.ls.broadcast(action="hello", data=[introduction(self.ls.address)], recipients=[self.ip])
+
+        if not delivered and self.relay:
+            self.ls.log.info("Relaying message for %i mirror(s) without ServerNet mirror %s" % (
+                len(self.relay), self.ip))
+            self.ls.broadcast(action=self.payload["action"], data=self.payload["data"], recipients=self.relay,
+                              relay=(self.payload["origin"], self.payload["id"]))
+
+        return
+
+    def send(self, data):
+        """
+        Send one message to the mirror
+
+        :param data: Message to send, string or (encoded) bytes
+        :return: True if sent successfully, False if not
+        """
+        if isinstance(data, str):
+            data = encode_message(data)
+
         connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         connection.settimeout(5)
+        success = False
 
         try:
             connection.connect((self.ip, 10056))
 
             sent = 0
-            while sent < len(self.data):
-                length_sent = connection.send(self.data[sent:].encode("ascii"))
+            while sent < len(data):
+                length_sent = connection.send(data[sent:])
                 if length_sent == 0:
                     break
                 sent += length_sent
-            self.ls.log.info("Sent message to mirror %s (%s)" % (self.ip, self.data))
+            success = True
+            if self.relay:
+                self.ls.log.info("Sent message to mirror %s to pass on to %i mirror(s) (%i bytes)" % (
+                    self.ip, len(self.relay), len(data)))
+            elif data[0:1] == b"{":
+                self.ls.log.info("Sent message to mirror %s (%s)" % (self.ip, data.decode("ascii", "ignore")))
+            elif data[:len(BINARY_MAGIC)] == BINARY_MAGIC:
+                self.ls.log.info("Sent binary message to mirror %s (%i bytes)" % (self.ip, len(data)))
+            else:
+                self.ls.log.info("Sent compressed message to mirror %s (%i bytes)" % (self.ip, len(data)))
         except (socket.timeout, TimeoutError):
             self.ls.log.info("Timeout while sending to ServerNet mirror %s" % self.ip)
         except ConnectionRefusedError:
@@ -56,4 +929,4 @@ class broadcaster(threading.Thread):
 
         connection.close()
 
-        return
+        return success
@@ -3,8 +3,9 @@ import socket
 import random
 import time
 
-from helpers import jj2
-from helpers.functions import fetch_one, udpchecksum, preferred, unpreferred
+from helpers import jj2, events
+from helpers.functions import fetch_one, preferred, unpreferred
+from helpers.protocol import encode_ping, decode_ping_reply
 from helpers.exceptions import ServerUnknownException
 
 class pinger(threading.Thread):
@@ -32,6 +33,7 @@ class pinger(threading.Thread):
         self.ip = ip
         self.data = data
         self.ls = ls
+        self.halted = threading.Event()  # so halting does not have to wait for the pinger to wake up
 
     def run(self):
         """
@@ -48,7 +50,8 @@ class pinger(threading.Thread):
         self.ls.log.info("Starting server pinger")
 
         while self.looping:
-            time.sleep(10)
+            if self.halted.wait(10):
+                break
             current_time = int(time.time())
 
             server = fetch_one("SELECT id FROM servers WHERE origin = ? AND last_ping < ? ORDER BY last_ping ASC",
@@ -77,16 +80,13 @@ class pinger(threading.Thread):
                 querysocket.close()
                 continue
 
-            index = random.choice(range(1, 7))
-            dgram = udpchecksum(bytearray(
-                [0x79, 0x79, 0x03, index, 0x00, 0x00, 0x00, 0x00, 0x32, 0x34, 0x20, 0x20]))
-            #                 ^- ping command                     ^-----^- version
+            dgram = encode_ping(random.choice(range(1, 7)))
 
             old_prefer = jj2server.get("prefer")
             try:
                 querysocket.sendto(dgram, address)
                 data, srv = querysocket.recvfrom(1024)
-                private = (data[8] >> 5) & 1
+                private = decode_ping_reply(data)["private"]
 
                 if jj2server.get("private") != private:
                     jj2server.set("private", private)
@@ -97,7 +97,7 @@ class pinger(threading.Thread):
                 else:
                     jj2server.set("prefer", 1)
                 self.ls.log.info("Requested status packet from server %s" % jj2server.get("ip"))
-            except(socket.timeout, TimeoutError, ConnectionError) as e:
+            except(socket.timeout, TimeoutError, ConnectionError, ValueError) as e:
                 self.ls.log.warning("Server %s did not respond to status packet request (%s)" % (jj2server.get("ip"), e))
                 jj2server.set("prefer", 0)  # don't delist, but make sure it's sorted to the bottom
                 pass
@@ -110,8 +110,11 @@ class pinger(threading.Thread):
 
                 new_prefer = jj2server.get("prefer")
                 if new_prefer != old_prefer:
-                    self.ls.broadcast(action="server", data=[jj2server.flush_updates()])
+                    updates = jj2server.flush_updates()
+                    self.ls.broadcast(action="server", data=[updates])
+                    events.server(updates)
 
 
     def halt(self):
         self.looping = False
+        self.halted.set()
@@ -0,0 +1,106 @@
+import threading
+import time
+
+from helpers.functions import fetch_all
+from helpers import events, snapshot
+
+
+class settings_cache:
+    """
+    In-memory copy of the settings table
+
+    Settings (i.e. the MOTD) only change when a set-motd call comes in, so there is no need to query the database every
+    time a client asks for them. The cache is loaded once at startup and reloaded whenever the settings are updated.
+    """
+    settings = {}
+    motd = ""
+    motd_payload = b""
+    expires = 0
+    timer = None
+
+    def __init__(self):
+        """
+        Set up cache
+
+        Settings are not loaded until load() is called, since the database may not have been prepared yet.
+        """
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        (Re-)load settings from the database
+
+        Pre-encodes the MOTD as it is to be sent to clients on port 10058 and schedules a timer that clears it once it
+        expires. If the MOTD changed, the list snapshot (which includes it) is marked as outdated and subscribers are
+        told.
+
+        :return: Nothing
+        """
+        settings = {row["item"]: row["value"] for row in fetch_all("SELECT item, value FROM settings")}
+
+        try:
+            expires = int(settings["motd-expires"])
+        except (KeyError, ValueError, TypeError):
+            expires = int(time.time()) + 10  # idk
+
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+            previous = self.motd
+            self.settings = settings
+            self.expires = expires
+
+            if "motd" in settings and time.time() < expires:
+                self.motd = settings["motd"]
+                self.motd_payload = (self.motd + "\n").encode("ascii", "ignore")
+
+                self.timer = threading.Timer(expires - time.time(), self.expire)
+                self.timer.daemon = True
+                self.timer.start()
+            else:
+                self.motd = ""
+                self.motd_payload = b""
+
+        if self.motd != previous:
+            snapshot.changed()
+            events.motd(self.motd)
+
+    def expire(self):
+        """
+        Clear the MOTD
+
+        Called by the expiry timer; the setting itself remains in the database. The list snapshot includes the MOTD,
+        so it is marked as outdated.
+
+        :return: Nothing
+        """
+        with self.lock:
+            self.motd = ""
+            self.motd_payload = b""
+            self.timer = None
+
+        snapshot.changed()
+        events.motd("")
+
+    def get(self, item, default=None):
+        """
+        Get setting value
+
+        :param item: Setting to get
+        :param default: Value to return if setting does not exist
+        :return: Setting value, as stored in the database
+        """
+        return self.settings.get(item, default)
+
+    def halt(self):
+        """
+        Cancel expiry timer
+
+        :return: Nothing
+        """
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
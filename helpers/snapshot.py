@@ -0,0 +1,474 @@
+import threading
+import struct
+import config
+import json
+import zlib
+import time
+import os
+from datetime import datetime
+
+from helpers.functions import query, fetch_all, fancy_time
+from helpers.protocol import encode_ascii_line, encode_binary_list
+from helpers import events, banlist
+
+# bumped whenever server records change, so rendered lists know when they are outdated
+version = 0
+version_lock = threading.Lock()
+updated = threading.Event()
+
+# order in which servers are listed
+LIST_ORDER = "ORDER BY prefer DESC, private ASC, (players = max) ASC, players DESC, created ASC"
+
+# published snapshot file: header (magic, format version, list version, amount of sections), then a table with the
+# name, offset and length of each section, then the sections themselves
+FILE_MAGIC = b"J2LS"
+FILE_FORMAT = 1
+FILE_HEADER = struct.Struct("<4sHQH")
+FILE_SECTION = struct.Struct("<8sII")
+
+# files published to PUBLISH_FOLDER, per section
+PUBLISHED = {"ascii": "servers.txt", "binary": "servers.bin", "json": "servers.json"}
+
+# server properties that change all the time without the list changing, see jj2server.unlisted; like the time the list
+# was rendered, these are ignored when checking if a published list needs to be rewritten
+VOLATILE = ("lifesign", "last_ping")
+
+# this will only be seen by vanilla players, because JJ2+ fetches the ascii server list from port 10057 instead, so
+# we can use this to advertise JJ2+ to vanilla players! use fake IPs that will always remain pinging
+ADVERTISEMENT = [{"port": 80, "ip": "192.0.2.0", "name": "Get JJ2 Plus, a mod for Jazz 2!"},
+                 {"port": 80, "ip": "192.0.2.1", "name": "Download at |||www.jj2.plus"},
+                 {"port": 80, "ip": "192.0.2.2", "name": "-----------------------------"}]
+
+
+def changed():
+    """
+    Mark the server list as changed
+
+    To be called whenever server records are added, updated or deleted.
+
+    :return: Nothing
+    """
+    global version
+
+    with version_lock:
+        version += 1
+
+    updated.set()
+
+
+def cleanup():
+    """
+    Delete remote servers that have not been heard of in a while
+
+    :return: Nothing
+    """
+    cutoff = int(time.time()) - config.TIMEOUT
+    expired = [row["id"] for row in fetch_all("SELECT id FROM servers WHERE remote = 1 AND lifesign < ?", (cutoff,))] \
+        if events.subscribed() else []
+
+    if query("DELETE FROM servers WHERE remote = 1 AND lifesign < ?", (cutoff,)).rowcount > 0:
+        changed()
+        for id in expired:
+            events.delisted(id)
+
+
+class list_snapshot:
+    """
+    Rendered server lists
+
+    Rendering a list means querying and formatting all servers, which adds up when clients poll a lot while the list
+    itself rarely changes. Lists are therefore rendered once and served from memory until a server changes, or until
+    they are older than SNAPSHOT_TTL seconds, since uptimes, statistics and timeouts change without any server record
+    changing. If a path is given, snapshots are also published to that file, for worker processes; if a folder is given,
+    the lists are also published there as separate files, for anything else that wants to show them. Published lists
+    are only updated when the list changed, or every SNAPSHOT_REFRESH seconds for the sake of uptimes and the like, and
+    files are only rewritten if their contents changed.
+    """
+    compressed = ("ascii", "servers", "json")  # sections that are also kept zlib-compressed
+
+    def __init__(self, ls, path=None, folder=None):
+        """
+        Set up snapshot
+
+        :param ls: List server object
+        :param path: File to publish snapshots to, if any
+        :param folder: Folder to publish lists to, if any
+        """
+        self.ls = ls
+        self.path = path
+        self.folder = folder
+        self.lock = threading.Lock()
+        self.sections = {}
+        self.version = -1
+        self.expires = 0
+        self.published = -1  # list version last published
+        self.bans = -1  # banlist version last published
+        self.refreshed = 0  # when published lists were last updated
+        self.checksums = {}  # file: checksum of contents last written to it
+
+    def get(self, section):
+        """
+        Get a rendered list, rendering it first if it is outdated
+
+        :param section: "ascii", "binary", "servers" (JSON), "json" (JSON with metadata), "stats", "statjson"
+        (statistics as JSON), "motd" or "version"; "asciiz", "serversz" and "jsonz" for zlib-compressed variants
+        :return: Bytes, ready to send
+        """
+        return self.current()[section]
+
+    def current(self):
+        """
+        Get all rendered lists, rendering them first if they are outdated
+
+        Use this rather than get() when more than one section is needed, so they are guaranteed to belong together.
+
+        :return: Dictionary of section name: bytes
+        """
+        if self.version != version or time.time() >= self.expires:
+            self.render()
+
+        return self.sections
+
+    def render(self, force=False):
+        """
+        Render all lists, if outdated
+
+        :param force: Render even if not outdated
+        :return: True if rendered, False if the current snapshot was still valid
+        """
+        with self.lock:
+            now = time.time()
+            if not force and self.version == version and now < self.expires:
+                return False  # rendered by another thread while we waited for the lock
+
+            cleanup()
+            rendering = version  # changes made while rendering will trigger another render later
+            servers = [dict(server) for server in fetch_all("SELECT * FROM servers " + LIST_ORDER)]
+
+            serverlist = json.dumps(servers)
+            named = [server for server in servers if server["name"]]
+
+            # the version includes the start time, so it does not repeat itself after the list server restarts
+            list_version = "%i.%i" % (self.ls.start, rendering)
+            sections = {
+                "ascii": render_ascii([server for server in servers if server["max"] > 0], now).encode("ascii",
+                                                                                                      "ignore"),
+                "binary": encode_binary_list(ADVERTISEMENT + [server for server in servers if
+                                                              server["max"] > 0 and server["plusonly"] == 0]),
+                "stats": render_stats(self.ls, named, now).encode("ascii", "ignore"),
+                "statjson": json.dumps(statistics(self.ls, named, now)).encode("ascii", "ignore"),
+                "servers": serverlist.encode("ascii", "ignore"),
+                "json": ('{"version": "%s", "updated": %i, "servers": %s}' % (list_version, now, serverlist)).encode(
+                    "ascii", "ignore"),
+                "motd": self.ls.settings.motd_payload,
+                "version": list_version.encode("ascii")
+            }
+
+            # compressed variants, for clients that ask for them - compressing once here is much cheaper than
+            # compressing for every request
+            for section in self.compressed:
+                sections[section + "z"] = zlib.compress(sections[section])
+
+            bans = banlist.version
+            if self.path:
+                sections["bans"] = json.dumps(render_bans(self.ls)).encode("ascii", "ignore")
+
+            self.sections = sections
+            self.version = rendering
+            self.expires = now + config.SNAPSHOT_TTL
+
+            if self.publishes() and self.outdated(rendering, now):
+                self.published = rendering
+                self.bans = bans
+                self.refreshed = now
+
+                try:
+                    if self.path:
+                        self.write(self.path, pack(rendering, sections))
+                    if self.folder:
+                        # servers.json has the render time and lifesigns in it, so compare it without those
+                        stable = json.dumps([list_version, [{key: server[key] for key in server if key not in VOLATILE}
+                                                            for server in servers]]).encode("ascii", "ignore")
+                        for section, filename in PUBLISHED.items():
+                            self.write(os.path.join(self.folder, filename), sections[section],
+                                       stable if section == "json" else None)
+                except OSError as e:
+                    self.ls.log.error("Could not publish list snapshot: %s" % e)
+
+            return True
+
+    def outdated(self, list_version, now):
+        """
+        Check if the published lists are outdated
+
+        That is, if the list changed since they were published, the banlist changed and is published for worker
+        processes, or they were published more than SNAPSHOT_REFRESH seconds ago.
+
+        :param list_version: Current list version
+        :param now: Current timestamp
+        :return: True if the lists should be published again
+        """
+        return list_version != self.published or now >= self.refreshed + config.SNAPSHOT_REFRESH or bool(
+            self.path and banlist.version != self.bans)
+
+    def refresh(self):
+        """
+        Render and publish lists, if the published lists are outdated
+
+        :return: Nothing
+        """
+        if self.outdated(version, time.time()):
+            self.render(force=True)
+
+    def write(self, path, data, compare=None):
+        """
+        Publish data to a file, unless the file already has those contents
+
+        :param path: File to write to
+        :param data: Bytes to write
+        :param compare: Bytes to compare instead of the data itself, for data with parts that should not count as a
+        change, such as timestamps
+        :return: Nothing
+        """
+        compare = data if compare is None else compare
+        checksum = (len(compare), zlib.crc32(compare))
+        if self.checksums.get(path) == checksum and os.path.exists(path):
+            return
+
+        write_atomically(path, data)
+        self.checksums[path] = checksum
+
+    def publishes(self):
+        """
+        Check if snapshots are published anywhere
+
+        :return: True if snapshots are written to a file or folder
+        """
+        return bool(self.path or self.folder)
+
+
+class publisher(threading.Thread):
+    """
+    Keep published snapshots up to date
+
+    Lists are normally only rendered when someone asks for them, but published lists need to be re-rendered as soon as
+    the list changes (and every SNAPSHOT_REFRESH seconds regardless), even if nobody is asking.
+    """
+    looping = True
+
+    def __init__(self, ls=None):
+        """
+        Set up publisher
+
+        :param ls: List server object
+        """
+        threading.Thread.__init__(self)
+
+        self.ls = ls
+
+    def run(self):
+        """
+        Render the snapshot whenever the list has changed
+
+        :return: Nothing
+        """
+        if self.ls.snapshot.folder:
+            os.makedirs(self.ls.snapshot.folder, exist_ok=True)
+
+        self.ls.snapshot.render(force=True)
+
+        while self.looping:
+            # banlist changes do not wake the publisher, so check every SNAPSHOT_TTL seconds; this is cheap, since lists
+            # are only rendered if something changed
+            updated.wait(timeout=config.SNAPSHOT_TTL)
+            updated.clear()
+            if not self.looping:
+                break
+
+            self.ls.snapshot.refresh()
+
+    def halt(self):
+        """
+        Stop publishing
+
+        :return: Nothing
+        """
+        self.looping = False
+        updated.set()
+
+
+def render_ascii(servers, now):
+    """
+    Render ASCII server list, as served on port 10057
+
+    :param servers: Servers to list
+    :param now: Current timestamp
+    :return: List, string
+    """
+    asciilist = ""
+    for server in servers:
+        try:
+            asciilist += encode_ascii_line(server, now)
+        except TypeError:
+            continue
+
+    return asciilist
+
+
+def statistics(ls, servers, now):
+    """
+    Collect list server statistics
+
+    :param ls: List server object
+    :param servers: Servers to count
+    :param now: Current timestamp
+    :return: Dictionary
+    """
+    stats = {"address": ls.address, "started": ls.start, "uptime": int(now - ls.start), "local": 0, "mirrored": 0,
+             "players": 0, "max": 0, "mirrors": [], "version": config.VERSION}
+
+    for server in servers:
+        if server["remote"] == 1:
+            stats["mirrored"] += 1
+        else:
+            stats["local"] += 1
+
+        stats["players"] += server["players"]
+        stats["max"] += server["max"]
+
+    stats["total"] = stats["local"] + stats["mirrored"]
+
+    for mirror in ls.mirrors.sorted():
+        if mirror["address"] == ls.ip:  # don't count ourselves
+            continue
+        stats["mirrors"].append({"name": mirror["name"], "state": mirror["state"], "queued": mirror["queued"],
+                                 "active": int(mirror["lifesign"]) >= int(now) - 600})
+
+    return stats
+
+
+def render_stats(ls, servers, now):
+    """
+    Render list server statistics, as served on port 10055
+
+    :param ls: List server object
+    :param servers: Servers to count
+    :param now: Current timestamp
+    :return: Statistics, string
+    """
+    running_since = datetime.fromtimestamp(ls.start)
+    mirrors = ls.mirrors.sorted()
+    counts = statistics(ls, servers, now)
+    local = counts["local"]
+    mirrored = counts["mirrored"]
+    players = counts["players"]
+    max_players = counts["max"]
+
+    # don't count ourselves
+    mirror_count = len(mirrors) - 1
+    suffix = "" if mirror_count == 1 else "s"
+
+    stats = "+----------------------------------------------------------------------+\n\n"
+    stats += "                Jazz Jackrabbit 2 List Server statistics\n"
+    stats += "\n"
+    stats += "\n"
+    stats += "  This server                      : " + ls.address + "\n"
+    stats += "  Serving you since                : " + running_since.strftime("%d %b %Y %H:%M") + "\n"
+    stats += "  Uptime                           : " + fancy_time(int(now - ls.start)) + "\n"
+    stats += "\n"
+    stats += "  Servers listed locally           : " + str(local) + "\n"
+    stats += "  Mirrored servers                 : " + str(mirrored) + "\n"
+    stats += "  Total                            : " + str(mirrored + local) + "\n"
+    stats += "\n"
+    stats += "  Players in servers               : [" + str(players) + "/" + str(max_players) + "]\n"
+    stats += "\n"
+    stats += "  Connected list server mirrors    : " + str(mirror_count) + " other list server" + suffix + "\n"
+
+    for mirror in mirrors:
+        if mirror["address"] == ls.ip:  # don't count ourselves
+            continue
+        stats += "                                     -> " + mirror["name"]
+        if mirror["state"] != "closed":
+            stats += " (unreachable, circuit %s, %i queued)\n" % (mirror["state"], mirror["queued"])
+        elif int(mirror["lifesign"]) < int(now) - 600:
+            stats += " (inactive)\n"
+        else:
+            stats += "\n"
+
+    stats += "\n"
+    stats += "  Running j2lsnek v" + config.VERSION + " by stijn\n"
+    stats += "  Source available at https://github.com/stijnstijn/j2lsnek\n\n"
+    stats += "  Bye!\n\n"
+    stats += "+----------------------------------------------------------------------+\n"
+
+    return stats
+
+
+def render_bans(ls):
+    """
+    Collect what worker processes need to know to refuse banned clients
+
+    :param ls: List server object
+    :return: Dictionary with mirrors (never banned) and ban masks
+    """
+    bans = fetch_all("SELECT address FROM banlist WHERE type = 'ban'")
+    return {"mirrors": sorted(ls.mirrors.all()), "bans": [ban["address"] for ban in bans]}
+
+
+def pack(list_version, sections):
+    """
+    Pack snapshot into the format it is published in, for worker processes
+
+    :param list_version: List version the snapshot was rendered for
+    :param sections: Dictionary of section name: bytes
+    :return: Snapshot file contents, bytes
+    """
+    offset = FILE_HEADER.size + FILE_SECTION.size * len(sections)
+    table = b""
+    for name, data in sections.items():
+        table += FILE_SECTION.pack(name.encode("ascii"), offset, len(data))
+        offset += len(data)
+
+    return FILE_HEADER.pack(FILE_MAGIC, FILE_FORMAT, list_version, len(sections)) + table + b"".join(sections.values())
+
+
+def write_atomically(path, data):
+    """
+    Write data to a file under a temporary name, then rename it
+
+    Renaming replaces the file in one go, so readers always see either the old or the new contents, never a partially
+    written file.
+
+    :param path: File to write to
+    :param data: Bytes to write
+    :return: Nothing
+    """
+    temporary = "%s.%i.tmp" % (path, os.getpid())
+    with open(temporary, "wb") as output:
+        output.write(data)
+
+    os.replace(temporary, path)
+
+
+def read(data):
+    """
+    Parse a published snapshot
+
+    :param data: Snapshot file contents; a memoryview (e.g. of an mmap) avoids copying the sections
+    :return: Tuple (list version, dictionary of section name: data)
+    """
+    if len(data) < FILE_HEADER.size:
+        raise ValueError("Snapshot file too short")
+
+    magic, file_format, list_version, amount = FILE_HEADER.unpack_from(data, 0)
+    if magic != FILE_MAGIC or file_format != FILE_FORMAT:
+        raise ValueError("Not a snapshot file, or an unsupported format")
+
+    sections = {}
+    for index in range(0, amount):
+        name, offset, length = FILE_SECTION.unpack_from(data, FILE_HEADER.size + index * FILE_SECTION.size)
+        if offset + length > len(data):
+            raise ValueError("Truncated snapshot file")
+        sections[name.rstrip(b"\x00").decode("ascii")] = data[offset:offset + length]
+
+    return list_version, sections
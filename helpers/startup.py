@@ -0,0 +1,109 @@
+import urllib.request
+import urllib.error
+import threading
+import socket
+import config
+import json
+import time
+
+from helpers.functions import query
+from helpers.servernet import introduction
+from helpers import banlist
+
+
+class deferred_startup(threading.Thread):
+    """
+    Startup tasks that depend on other servers
+
+    Looking up our own IP, resolving the master list server and asking mirrors for their data can each take seconds,
+    and nothing else needs to wait for them: while the list server is down, all servers are delisted, so it should be
+    listening again as soon as possible. These tasks are therefore done in the background once the list server is up.
+    """
+
+    def __init__(self, ls=None, add_master=False, since=None):
+        """
+        Set up startup tasks
+
+        :param ls: List server object
+        :param add_master: Add the master list server as a mirror, for new databases
+        :param since: Only ask mirrors for data that changed since this time, if the list server continues with the
+        data it had before restarting (see helpers.warmstart)
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True  # nothing here is worth waiting for when quitting
+
+        self.ls = ls
+        self.add_master = add_master
+        self.since = since
+
+    def run(self):
+        """
+        Run startup tasks
+
+        :return: Nothing
+        """
+        timings = []
+        start = time.perf_counter()
+
+        if not config.OWN_IP:
+            self.discover_ip()
+            timings.append(("own IP", time.perf_counter() - start))
+
+        if self.add_master:
+            start = time.perf_counter()
+            self.add_master_mirror()
+            timings.append(("master list server", time.perf_counter() - start))
+
+        # let other list servers know we're live and ask them for the latest
+        if self.since is not None:
+            self.ls.broadcast(action="request", data=[introduction(self.ls.address, since=self.since)])
+        else:
+            self.ls.broadcast(action="request", data=[introduction(self.ls.address)])
+
+        self.ls.log.info("Background startup tasks finished (%s)" % ", ".join(
+            ["%s: %i ms" % (task, duration * 1000) for task, duration in timings]))
+
+    def discover_ip(self):
+        """
+        Look up own IP via an online API
+
+        Until this finishes, the list server uses the IP it had last time, or a guess. The IP found is remembered for
+        next time.
+
+        :return: Nothing
+        """
+        try:
+            ip = json.loads(urllib.request.urlopen("http://httpbin.org/ip", timeout=config.OWN_IP_TIMEOUT).read().decode(
+                "ascii", "ignore"))["origin"]
+        except (ValueError, KeyError, TypeError, urllib.error.URLError, socket.timeout) as e:
+            self.ls.log.info("Could not retrieve own IP via online API, keeping %s (%s)" % (self.ls.ip, e))
+            return
+
+        if ip != self.ls.ip:
+            self.ls.log.warning("Own IP is %s" % ip)
+            self.ls.ip = ip
+
+        if ip != self.ls.settings.get("own-ip"):
+            query("INSERT OR REPLACE INTO settings (item, value) VALUES (?, ?)", ("own-ip", ip))
+
+    def add_master_mirror(self):
+        """
+        Add the master list server as a mirror
+
+        :return: Nothing
+        """
+        master_fqdn = "list.jj2.plus"
+        try:
+            master = socket.gethostbyname(master_fqdn)
+        except socket.gaierror:
+            self.ls.log.error("Could not retrieve IP for %s - no master list server available!" % master_fqdn)
+            return
+
+        # don't add if *this* server has that hostname
+        if master == self.ls.address or master == self.ls.ip or master in self.ls.mirrors:
+            return
+
+        self.ls.log.info("Adding %s as mirror" % master_fqdn)
+        query("INSERT INTO mirrors (name, address, updated) VALUES (?, ?, ?)", (master_fqdn, master, int(time.time())))
+        self.ls.mirrors.load()
+        banlist.changed()
@@ -0,0 +1,109 @@
+"""
+Warm starts: pick up where the list server left off
+
+When the list server starts, it used to throw away everything it had learned from mirrors and ask every mirror for all
+of its data, so every restart cost more as the banlist and the amount of mirrors grew. Instead, the list server now
+regularly writes a compact record of its state to STATE_FILE: the servers listed on mirrors, how many banlist entries
+it has from each origin and when the last one was added, and how well each mirror could be reached. If that record is
+recent and still matches the database when the list server starts, the remote servers are put back (provisionally:
+they are delisted as usual unless their mirror confirms them in time), the banlist is kept, and mirrors are only asked
+for what changed since then.
+
+Banlist entries and mirrors that were deleted in the meantime are not part of that; mirrors keep messages like those
+for list servers they cannot reach, and send them once the list server is back (see servernet.circuit_breaker). If the
+list server was down for longer than STATE_MAX_AGE, a full sync is done as before.
+"""
+import json
+import time
+
+import config
+
+from helpers.functions import fetch_all
+from helpers.snapshot import write_atomically
+
+STATE_FORMAT = 1  # bump if the structure changes, older files are then ignored
+CLOCK_MARGIN = 300  # list server clocks may differ somewhat, so ask for a bit more than strictly needed
+
+
+def banlist_versions(address):
+    """
+    Get what the banlist looks like per origin, other than this list server
+
+    :param address: Name of this list server
+    :return: Dictionary, origin: {"count": amount of entries, "updated": when the last one was added}
+    """
+    rows = fetch_all("SELECT origin, COUNT(*) AS count, MAX(updated) AS updated FROM banlist WHERE origin != ? "
+                     "GROUP BY origin", (address,))
+    return {row["origin"]: {"count": row["count"], "updated": row["updated"] or 0} for row in rows}
+
+
+def save(path, ls):
+    """
+    Write current state to disk
+
+    :param path: File to write to
+    :param ls: List server object
+    :return: Nothing
+    """
+    state = {
+        "format": STATE_FORMAT,
+        "from": ls.address,
+        "saved": int(time.time()),
+        "servers": [dict(server) for server in fetch_all("SELECT * FROM servers WHERE remote = 1")],
+        "banlist": banlist_versions(ls.address),
+        "mirrors": ls.mirrors.health()
+    }
+
+    write_atomically(path, json.dumps(state).encode("ascii"))
+
+
+def load(path, address):
+    """
+    Read state as written by save()
+
+    :param path: File to read
+    :param address: Name of this list server; state written by another one is ignored
+    :return: State dictionary, or None if there is no usable state
+    """
+    try:
+        with open(path) as input:
+            state = json.load(input)
+    except (OSError, ValueError):
+        return None
+
+    if not isinstance(state, dict) or state.get("format") != STATE_FORMAT or state.get("from") != address:
+        return None
+
+    if not isinstance(state.get("saved"), int) or state["saved"] < time.time() - config.STATE_MAX_AGE:
+        return None
+
+    return state
+
+
+def matches(state, db, address):
+    """
+    Check whether the banlist in the database is still the banlist the state was saved with
+
+    If it is not (e.g. the database was replaced or edited by hand), the list server can not rely on mirrors only
+    sending what changed.
+
+    :param state: State dictionary, see load()
+    :param db: Database connection
+    :param address: Name of this list server
+    :return: True if the banlist has the same amount of entries per origin, added at the same times
+    """
+    rows = db.execute("SELECT origin, COUNT(*) AS count, MAX(updated) AS updated FROM banlist WHERE origin != ? "
+                      "GROUP BY origin", (address,)).fetchall()
+    current = {row[0]: {"count": row[1], "updated": row[2] or 0} for row in rows}
+
+    return current == state.get("banlist")
+
+
+def since(state):
+    """
+    Get the time from which mirrors should send changes
+
+    :param state: State dictionary, see load()
+    :return: UNIX timestamp
+    """
+    return state["saved"] - CLOCK_MARGIN
@@ -0,0 +1,339 @@
+"""
+Worker processes for the read-only list ports
+
+Python threads only ever run one at a time, so a single list server process cannot use more than one core. If WORKERS
+is configured, the ports that only serve lists (10053, 10055, 10057 and 10058) are instead served by that many worker
+processes, which all listen at those ports via SO_REUSEPORT so the OS spreads connections over them. Workers never
+touch the database: they serve the list snapshot the list server publishes to SNAPSHOT_FILE, which includes what they
+need to refuse banned clients. The list server itself keeps handling game servers (10054), ServerNet and pinging.
+
+Workers are started by the list server as `python3 -m helpers.workers [snapshot file]`.
+"""
+import subprocess
+import selectors
+import threading
+import logging
+import pathlib
+import socket
+import json
+import mmap
+import config
+import time
+import sys
+import os
+
+from helpers import snapshot, protocol
+from helpers.banlist import ban_index
+
+# port: snapshot section served at that port
+PORTS = {10053: "binary", 10055: "stats", 10057: "ascii", 10058: "motd"}
+
+SEND_TIMEOUT = 5  # seconds a client may take nothing of its response before it is disconnected
+
+
+def available():
+    """
+    Check if workers can be used on this system
+
+    :return: True if the OS supports SO_REUSEPORT
+    """
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+class worker_pool(threading.Thread):
+    """
+    Start worker processes, keep them running and keep the snapshot they serve up to date
+    """
+    looping = True
+
+    def __init__(self, ls=None, amount=1):
+        """
+        Set up pool
+
+        :param ls: List server object
+        :param amount: Amount of worker processes
+        """
+        threading.Thread.__init__(self)
+
+        self.ls = ls
+        self.amount = amount
+        self.processes = []
+
+    def run(self):
+        """
+        Start workers and restart those that have died
+
+        Keeping the snapshot they serve up to date is left to helpers.snapshot.publisher.
+
+        :return: Nothing
+        """
+        self.ls.snapshot.render()  # workers need a snapshot to serve straight away
+
+        for index in range(0, self.amount):
+            self.processes.append(self.spawn())
+        self.ls.log.info("Started %i worker processes for ports %s" % (self.amount, ", ".join([str(port) for port in PORTS])))
+
+        while self.looping:
+            time.sleep(1)
+
+            for index, process in enumerate(self.processes):
+                if process.poll() is not None:
+                    self.ls.log.error("Worker process %i exited with status %i, restarting" % (process.pid, process.returncode))
+                    self.processes[index] = self.spawn()
+
+        for process in self.processes:
+            process.terminate()
+
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    def spawn(self):
+        """
+        Start a worker process
+
+        :return: subprocess.Popen object
+        """
+        return subprocess.Popen([sys.executable, "-m", "helpers.workers", self.ls.snapshot.path],
+                                cwd=str(pathlib.Path(__file__).parent.parent))
+
+    def halt(self):
+        """
+        Stop workers
+
+        :return: Nothing
+        """
+        self.looping = False
+
+
+class snapshot_reader:
+    """
+    Memory-mapped view of the published snapshot
+
+    The list server replaces the file rather than writing to it, so a new snapshot means a new file; the old mapping
+    stays valid until it is swapped for the new one.
+    """
+
+    def __init__(self, path):
+        """
+        Set up reader
+
+        :param path: Snapshot file
+        """
+        self.path = path
+        self.inode = None
+        self.map = None
+        self.sections = {}
+        self.bans = ban_index([], [])
+
+    def refresh(self):
+        """
+        Map the snapshot file again if it has been replaced
+
+        :return: Nothing
+        """
+        try:
+            status = os.stat(self.path)
+        except OSError:
+            return  # keep serving what we have
+
+        if (status.st_ino, status.st_mtime_ns) == self.inode:
+            return
+
+        try:
+            with open(self.path, "rb") as input:
+                new_map = mmap.mmap(input.fileno(), 0, access=mmap.ACCESS_READ)
+            list_version, sections = snapshot.read(memoryview(new_map))
+            bans = json.loads(bytes(sections.pop("bans", b"{}")).decode("ascii", "ignore"))
+        except (OSError, ValueError):
+            return  # keep serving what we have
+
+        # the old mapping is closed once the sections that refer to it are no longer used
+        self.inode = (status.st_ino, status.st_mtime_ns)
+        self.map, self.sections = new_map, sections
+        self.bans = ban_index(bans.get("mirrors", []), [{"address": mask, "type": "ban", "reserved": ""} for mask in
+                                                         bans.get("bans", [])])
+
+    def banned(self, address):
+        """
+        Check if address is banned
+
+        Same as helpers.functions.banned(), but using the ban masks in the snapshot
+
+        :param address: IP address
+        :return: True if banned
+        """
+        return self.bans.banned(address)
+
+
+def serve(path):
+    """
+    Serve list ports until the list server goes away
+
+    Responses are already rendered, so one process can serve them all without needing any threads. Sockets are
+    non-blocking: responses that do not fit in the socket buffer at once are sent in parts as the client takes them, so
+    a slow client does not hold up the others.
+
+    :param path: Snapshot file
+    :return: Nothing
+    """
+    log = logging.getLogger("j2lsnek-worker")
+    log.addHandler(logging.StreamHandler())
+    log.handlers[0].setFormatter(logging.Formatter("%(asctime)-15s | %(message)s", "%d-%m-%Y %H:%M:%S"))
+
+    parent = os.getppid()
+    reader = snapshot_reader(path)
+    reader.refresh()
+
+    selector = selectors.DefaultSelector()
+    for port in PORTS:
+        server = socket.socket()
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            server.bind(("", port))
+        except OSError as e:
+            log.error("WARNING! Worker %i could not listen at port %s (%s)" % (os.getpid(), port, e.strerror))
+            sys.exit(1)
+        server.listen(128)
+        server.setblocking(False)
+        selector.register(server, selectors.EVENT_READ, port)
+
+    # port 10057 clients that may still send a conditional request: socket: time after which to stop waiting
+    waiting = {}
+    # clients that have not taken all of their response yet: socket: [rest of response, time after which to give up if
+    # they take nothing more]
+    sending = {}
+
+    def reply(client, port, query=None):
+        """
+        Send a client its response, or start to, if it does not fit in the socket buffer
+
+        :param client: Client socket
+        :param port: Port the client connected to
+        :param query: Data sent by the client, for port 10057
+        :return: Nothing
+        """
+        rest = send(client, respond(reader, port, query))
+        if rest is not None:
+            selector.register(client, selectors.EVENT_WRITE, "send")
+            sending[client] = [rest, time.monotonic() + SEND_TIMEOUT]
+
+    while os.getppid() == parent:
+        deadlines = list(waiting.values()) + [pending[1] for pending in sending.values()]
+        timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else 5
+        for key, events in selector.select(timeout=timeout):
+            if key.data == "send":
+                # a client is ready to take more of its response
+                client = key.fileobj
+                rest = send(client, sending[client][0])
+                if rest is None:
+                    selector.unregister(client)
+                    del sending[client]
+                elif len(rest) < len(sending[client][0]):
+                    sending[client] = [rest, time.monotonic() + SEND_TIMEOUT]
+                continue
+
+            if key.data == "query":
+                # a waiting client sent something
+                client = key.fileobj
+                selector.unregister(client)
+                del waiting[client]
+                try:
+                    query = client.recv(protocol.LIST_QUERY_SIZE)
+                except OSError:
+                    query = None
+                reply(client, 10057, query)
+                continue
+
+            try:
+                client, address = key.fileobj.accept()
+            except OSError:
+                continue  # someone else got to it first
+
+            reader.refresh()
+            if reader.banned(address[0]):
+                log.warning("IP %s attempted to connect but matches banlist, refused" % address[0])
+                client.close()
+                continue
+
+            client.setblocking(False)
+            if key.data == 10057 and config.LIST_QUERY_WAIT > 0:
+                selector.register(client, selectors.EVENT_READ, "query")
+                waiting[client] = time.monotonic() + config.LIST_QUERY_WAIT
+                continue
+
+            query = None
+            if key.data == 10057:
+                # not waiting, but a request that came along with the connection can still be answered
+                try:
+                    query = client.recv(protocol.LIST_QUERY_SIZE)
+                except OSError:
+                    pass
+
+            reply(client, key.data, query)
+
+        now = time.monotonic()
+
+        # clients that did not send a request get the list like always
+        for client in [client for client, expires in waiting.items() if expires <= now]:
+            selector.unregister(client)
+            del waiting[client]
+            reply(client, 10057)
+
+        # clients that stopped taking their response are not worth waiting for
+        for client in [client for client, pending in sending.items() if pending[1] <= now]:
+            selector.unregister(client)
+            del sending[client]
+            client.close()
+
+
+def respond(reader, port, query=None):
+    """
+    Get what is served at a port
+
+    :param reader: snapshot_reader
+    :param port: Port the client connected to
+    :param query: Data sent by the client, for port 10057
+    :return: Response, bytes or memoryview
+    """
+    if port == 10057:
+        return protocol.conditional_list(reader.sections.get("ascii", b""), reader.sections.get("version", b""),
+                                         query, reader.sections.get("asciiz"))
+
+    return reader.sections.get(PORTS[port], b"")
+
+
+def send(client, data):
+    """
+    Send as much of a response as the client takes right now, and close the connection once all of it is sent
+
+    :param client: Client socket, non-blocking
+    :param data: Response, or what is left of it
+    :return: What is left to send (memoryview), or None if the connection is done with
+    """
+    data = memoryview(data)
+    try:
+        sent = client.send(data) if data else 0
+    except BlockingIOError:
+        sent = 0
+    except OSError:
+        client.close()
+        return None
+
+    if sent < len(data):
+        return data[sent:]
+
+    try:
+        client.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+    client.close()
+    return None
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1])
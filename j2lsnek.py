@@ -5,14 +5,13 @@ By Stijn (https://stijn.chat)
 Thanks to DJazz for a reference implementation and zepect for some misc tips.
 """
 
-import urllib.request
-import urllib.error
 import subprocess
 import importlib
+import itertools
 import logging
 import sqlite3
+import random
 import socket
-import json
 import time
 import sys
 import os
@@ -24,6 +23,14 @@ import helpers.functions
 import helpers.listener
 import helpers.interact
 import helpers.serverpinger
+import helpers.settings
+import helpers.schema
+import helpers.startup
+import helpers.handover
+import helpers.warmstart
+import helpers.handler
+import helpers.snapshot
+import helpers.workers
 import helpers.webhooks
 import helpers.jj2
 
@@ -35,10 +42,13 @@ class listserver:
     """
     looping = True  # if False, will exit
     sockets = {}  # sockets the server is listening it
-    mirrors = []  # ServerNet connections
+    mirrors = None  # ServerNet mirror directory
     last_ping = 0  # last time this list server has sent a ping to ServerNet
     last_sync = 0  # last time this list server asked for a full sync
+    last_state = 0  # last time this list server saved its state, see helpers.warmstart
     reboot_mode = "quit"  # "quit" (default), "restart" (reload everything), or "reboot" (restart complete list server)
+    bound = {}  # sockets opened before port listeners are started, or kept open while reloading
+    sessions = []  # game server connections kept open while reloading, see helpers.handover
     banlist = {}
 
     def __init__(self):
@@ -47,6 +57,8 @@ class listserver:
         """
 
         self.start = int(time.time())
+        timings = [("start", time.perf_counter())]  # startup phases, logged once the list server is up
+        self.sequence = itertools.count(1)  # ServerNet message IDs
         self.address = socket.gethostname()
 
         # initialise logger
@@ -77,15 +89,92 @@ class listserver:
             self.log.addHandler(handler)
 
 
-        # try to get own IP
-        try:
-            self.ip = json.loads(str(urllib.request.urlopen("http://httpbin.org/ip", timeout=5).read().decode("ascii", "ignore")))["origin"]
-        except (ValueError, urllib.error.URLError, socket.timeout) as e:
-            self.log.info("Could not retrieve own IP via online API - guessing")
-            self.ip = helpers.functions.get_own_ip()  # may be wrong, but best we got
+        # list ports may be served by separate worker processes, which need the lists to be published for them
+        self.workers = config.WORKERS
+        if self.workers > 0 and not helpers.workers.available():
+            self.log.warning("Worker processes are not supported on this system, serving list ports from main process")
+            self.workers = 0
+
+        # only listen on port 10059 if auth mechanism is available
+        # check if certificates are available for auth and encryption of port 10059 traffic
+        can_auth = os.path.isfile(config.CERTFILE) and os.path.isfile(config.CERTKEY) and os.path.isfile(
+            config.CERTCHAIN)
+        ports = [10053, 10054, 10055, 10056, 10057, 10058, 10059]
+        if not can_auth:
+            ports.remove(10059)
+            self.log.warning("Not listening on port 10059 as SSL certificate authentication is not available")
+
+        if self.workers > 0:
+            ports = [port for port in ports if port not in helpers.workers.PORTS]
+
+        # optional HTTP endpoint for web sites
+        if config.HTTP_PORT and config.HTTP_PORT not in ports:
+            ports.append(config.HTTP_PORT)
+
+        # optional stream of server list changes
+        if config.SUBSCRIBE_PORT and config.SUBSCRIBE_PORT not in ports:
+            ports.append(config.SUBSCRIBE_PORT)
+
+        # if this process replaced one that restarted itself, take over its sockets and game server connections
+        self.bound, self.sessions, handed_over = helpers.handover.load(config.HANDOVER_FILE)
+        for port in [port for port in self.bound if port not in ports]:
+            self.bound.pop(port).close()
+
+        # open ports straight away: all servers are delisted while the list server is down, so the sooner they can
+        # connect again the better. connections are queued until the port listeners are started
+        for port in [port for port in ports if port not in self.bound]:
+            try:
+                self.bound[port] = helpers.listener.open_socket(port)
+            except OSError:
+                pass  # port listener will keep trying
+        timings.append(("sockets", time.perf_counter()))
+
+        # if the list server ran recently, continue with what it knew then rather than starting from scratch
+        state = helpers.warmstart.load(config.STATE_FILE, self.address) if config.STATE_INTERVAL > 0 else None
+        new_database, warm = self.prepare_database(state)
+        if warm:
+            now = int(time.time())
+            self.restore_servers([server for server in state["servers"] if
+                                  server.get("lifesign", 0) >= now - config.TIMEOUT])
+            self.log.warning("Continuing with state from %i seconds ago" % (now - state["saved"]))
+        if handed_over:
+            self.restore_servers(handed_over)
+            self.log.warning("Took over %i server connections from before restarting" % len(self.sessions))
+        timings.append(("database", time.perf_counter()))
+
+        # settings such as the MOTD rarely change, so keep them in memory
+        self.settings = helpers.settings.settings_cache()
+        self.settings.load()
+
+        # same for ServerNet mirrors, which are needed for every broadcast and incoming ServerNet connection
+        self.mirrors = helpers.servernet.mirror_directory()
+        self.mirrors.load()
+        if warm:
+            self.mirrors.restore(state["mirrors"])
+
+        # recently received ServerNet messages, to be able to ignore duplicates
+        self.message_log = helpers.servernet.message_log()
+
+        # server lists are rendered once and cached until the list changes
+        self.snapshot = helpers.snapshot.list_snapshot(
+            ls=self, path=os.path.abspath(config.SNAPSHOT_FILE) if self.workers > 0 else None,
+            folder=config.PUBLISH_FOLDER if config.PUBLISH_FOLDER else None)
+        timings.append(("caches", time.perf_counter()))
+
+        # own IP: as configured, or else what it was last time until it has been looked up again (or a guess if there
+        # is no last time)
+        self.ip = config.OWN_IP or self.settings.get("own-ip")
+        if not self.ip:
+            try:
+                self.ip = helpers.functions.get_own_ip()  # may be wrong, but best we got
+            except OSError:
+                self.ip = "127.0.0.1"
 
         # say hello
-        os.system("cls" if os.name == "nt" else "clear")  # clear screen
+        if os.name == "nt":
+            os.system("cls")
+        elif sys.stdout.isatty():
+            print("\033[H\033[2J", end="")  # clear screen
         print("\n                          .-=-.          .--.")
         print("              __        .' s n '.       /  \" )")
         print("      _     .'  '.     / l .-. e \     /  .-'\\")
@@ -97,19 +186,14 @@ class listserver:
         print("Enter 'q' to quit (q + enter).")
         print("")
 
-        self.prepare_database()
+        # looking up our IP, the master list server and asking mirrors for data can all wait until we're listening
+        helpers.startup.deferred_startup(ls=self, add_master=new_database,
+                                         since=helpers.warmstart.since(state) if warm else None).start()
+        timings.append(("other", time.perf_counter()))
 
-        # let other list servers know we're live and ask them for the latest
-        self.broadcast(action="request", data=[{"from": self.address}])
-
-        # only listen on port 10059 if auth mechanism is available
-        # check if certificates are available for auth and encryption of port 10059 traffic
-        can_auth = os.path.isfile(config.CERTFILE) and os.path.isfile(config.CERTKEY) and os.path.isfile(
-            config.CERTCHAIN)
-        ports = [10053, 10054, 10055, 10056, 10057, 10058, 10059]
-        if not can_auth:
-            ports.remove(10059)
-            self.log.warning("Not listening on port 10059 as SSL certificate authentication is not available")
+        self.log.info("Started in %i ms (%s)" % ((timings[-1][1] - timings[0][1]) * 1000, ", ".join(
+            ["%s: %i ms" % (timings[index][0], (timings[index][1] - timings[index - 1][1]) * 1000) for index in
+             range(1, len(timings))])))
 
         # "restart" to begin with, then assume the script will quit afterwards. Value may be modified back to
         # "restart" in the meantime, which will cause all port listeners to re-initialise when listen_to finishes
@@ -121,6 +205,12 @@ class listserver:
 
         # restart script if that mode was chosen
         if self.reboot_mode == "reboot":
+            if os.name != "nt":
+                # the new process takes over where this one left off, see helpers.handover
+                servers = [dict(server) for server in
+                           helpers.functions.fetch_all("SELECT * FROM servers WHERE remote = 0")]
+                helpers.handover.save(config.HANDOVER_FILE, self.bound, self.sessions, servers)
+
             if os.name == "nt":
                 from subprocess import Popen
                 import signal
@@ -141,8 +231,13 @@ class listserver:
         """
         self.log.info("Opening port listeners...")
         for port in ports:
-            self.sockets[port] = helpers.listener.port_listener(port=port, ls=self)
+            self.sockets[port] = helpers.listener.port_listener(port=port, ls=self, server=self.bound.pop(port, None))
             self.sockets[port].start()
+
+        # game server connections kept open while reloading
+        sessions, self.sessions = self.sessions, []
+        for session in sessions:
+            self.sockets[10054].resume(session)
         self.log.info("Listening.")
         print("Port listeners started.")
 
@@ -154,6 +249,18 @@ class listserver:
         pinger = helpers.serverpinger.pinger(ls=self)
         pinger.start()
 
+        # and one to keep published lists up to date, if they are published
+        publisher = None
+        if self.snapshot.publishes():
+            publisher = helpers.snapshot.publisher(ls=self)
+            publisher.start()
+
+        # and one to keep worker processes running, if any
+        workers = None
+        if self.workers > 0:
+            workers = helpers.workers.worker_pool(ls=self, amount=self.workers)
+            workers.start()
+
         while self.looping:
             current_time = int(time.time())
 
@@ -164,14 +271,23 @@ class listserver:
 
             if self.last_sync < current_time - 900:
                 # ask for sync from all servers - in case we missed any servers being listed
-                self.broadcast(action="request", data=[{"from": self.address, "fragment": "servers"}])
+                self.broadcast(action="request", data=[helpers.servernet.introduction(self.address, fragment="servers")])
                 self.last_sync = current_time
 
+            if config.STATE_INTERVAL > 0 and self.last_state < current_time - config.STATE_INTERVAL:
+                # so the list server can pick up from here if it restarts
+                self.save_state()
+                self.last_state = current_time
+
             time.sleep(config.MICROSLEEP)
 
+        # when restarting, sockets and game server connections are kept open and taken over afterwards; on Windows the
+        # new process cannot inherit them, so they are only kept if this process keeps running
+        handover = self.reboot_mode == "restart" or (self.reboot_mode == "reboot" and os.name != "nt")
+
         self.log.warning("Waiting for listeners to finish...")
         for port in self.sockets:
-            self.sockets[port].halt()
+            self.sockets[port].halt(handover=handover)
 
         for port in self.sockets:
             self.sockets[port].join()
@@ -179,43 +295,93 @@ class listserver:
         pinger.halt()
         pinger.join()
 
+        if workers:
+            workers.halt()
+            workers.join()
+
+        if publisher:
+            publisher.halt()
+            publisher.join()
+
+        if config.STATE_INTERVAL > 0:
+            self.save_state()
+
+        if self.reboot_mode != "restart":
+            self.settings.halt()
+
         self.log.info("j2lsnek succesfully shut down.")
         print("Bye!")
 
         return
 
-    def broadcast(self, action, data, recipients=None, ignore=None):
+    def broadcast(self, action, data, recipients=None, ignore=None, relay=None):
         """
         Send data to servers connected via ServerNET
 
+        If SERVERNET_FANOUT is set, messages for all mirrors are only sent to that many of them directly, which pass
+        them on to the others (see helpers.servernet.relay_plan()). Messages for specific mirrors are always sent
+        directly.
+
         :param action: Action with which to call the API
         :param data: Data to send
         :param recipients: List of IPs to send to, will default to all known mirrors
         :param ignore: List of IPs *not* to send to
+        :param relay: Tuple of origin and message ID, when passing on a message from another list server rather than
+        sending one of our own
         :return: Nothing
         """
         if not self.looping:
             return False  # shutting down
 
-        data = json.dumps({"action": action, "data": data, "origin": self.address})
+        # the ID allows the receiving end to recognise duplicates - it is unique per origin since it includes the
+        # time this list server was started. Relayed messages keep their ID, so mirrors can recognise them too
+        if relay:
+            origin, message_id = relay
+        else:
+            origin, message_id = self.address, "%i.%i" % (self.start, next(self.sequence))
+
+        payload = {"action": action, "data": data, "origin": origin, "id": message_id}
+        encoded = {}  # (binary, compressed): message, so each form is only encoded once, if any recipient needs it
+        fanout = config.SERVERNET_FANOUT if (relay or not recipients) and action in helpers.servernet.RELAY_ACTIONS \
+            else 0
 
         if not recipients:
-            recipients = helpers.functions.all_mirrors()
+            recipients = self.mirrors.all()
 
         if ignore is None:
             ignore = []
 
-        for ignored in ignore:
-            if ignored in recipients:
-                recipients.remove(ignored)
-
-        transmitters = {}
-
+        reachable = []
         for mirror in recipients:
+            if mirror in ignore:
+                continue
             if mirror == "localhost" or mirror == "127.0.0.1" or mirror == self.ip:
                 continue  # may be a mirror but should never be sent to because it risks infinite loops
-            transmitters[mirror] = helpers.servernet.broadcaster(ip=mirror, data=data, ls=self)
-            transmitters[mirror].start()
+
+            form = (action in helpers.servernet.BINARY_ACTIONS and self.mirrors.supports(mirror, "binary1"),
+                    self.mirrors.supports(mirror, "zlib"))
+            if form not in encoded:
+                encoded[form] = helpers.servernet.encode_payload(payload, binary=form[0], compress=form[1])
+
+            if not self.mirrors.allow(mirror):
+                # mirror is unreachable - message is kept for later or dropped, depending on the action
+                self.mirrors.defer(mirror, action, encoded[form])
+                continue
+
+            reachable.append((mirror, encoded[form]))
+
+        if fanout:
+            # mirrors that pass messages on are picked at random, to spread the work
+            random.shuffle(reachable)
+            relays = [mirror for mirror, message in reachable if self.mirrors.supports(mirror, "relay1")]
+            plan = helpers.servernet.relay_plan([mirror for mirror, message in reachable], fanout, relays)
+        else:
+            plan = [(mirror, []) for mirror, message in reachable]
+
+        messages = dict(reachable)
+        for mirror, relayed in plan:
+            helpers.servernet.broadcaster(ip=mirror, data=messages[mirror], ls=self, payload=payload,
+                                          relay=relayed).start()
 
         return
 
@@ -229,73 +395,36 @@ class listserver:
         """
         self.looping = False
 
-    def prepare_database(self):
+    def prepare_database(self, state=None):
         """
-        Creates database tables if they don't exist yet
+        Creates database tables if they don't exist yet, and brings existing ones up to date, see helpers.schema
 
         No lock is required for the database action since no other database shenanigans should be going on at this point
         as this is before threads get started
 
-        :return: result of connection.commit()
+        :param state: State saved before the list server stopped, see helpers.warmstart
+        :return: Tuple: True if the database is new, i.e. there was no mirrors table yet; True if the state matches the
+        database, so banlist entries from mirrors were kept
         """
-
-        dbconn = sqlite3.connect(config.DATABASE)
+        dbconn = sqlite3.connect(config.DATABASE, isolation_level=None)
         dbconn.row_factory = sqlite3.Row
-        db = dbconn.cursor()
-
-        # servers is emptied on restart, so no harm in recreating the table (just in case any columns were added/changed)
-        db.execute("DROP TABLE IF EXISTS servers")
-        db.execute(
-                "CREATE TABLE servers (id TEXT UNIQUE, ip TEXT, port INTEGER, created INTEGER DEFAULT 0, lifesign INTEGER DEFAULT 0, last_ping INTEGER DEFAULT 0, private INTEGER DEFAULT 0, remote INTEGER DEFAULT 0, origin TEXT, version TEXT DEFAULT '1.00', plusonly INTEGER DEFAULT 0, mode TEXT DEFAULT 'unknown', players INTEGER DEFAULT 0, max INTEGER DEFAULT 0, name TEXT, prefer INTEGER DEFAULT 0)")
-
-
-        try:
-            db.execute("SELECT * FROM settings")
-        except sqlite3.OperationalError:
-            self.log.info("Table 'settings' does not exist yet, creating and populating.")
-            db.execute("CREATE TABLE settings (item TEXT UNIQUE, value TEXT)")
-            db.execute("INSERT INTO settings (item, value) VALUES (?, ?), (?, ?), (?, ?)", ("motd", "", "motd-updated", "0", "motd-expires", int(time.time()) + (3 * 86400)))
-
-        # was not a setting initially, so may need to add entry
-        setting = db.execute("SELECT * FROM settings WHERE item = ?", ("motd-expires", )).fetchone()
-        if not setting:
-            db.execute("INSERT INTO settings (item, value) VALUES (?, ?)", ("motd-expires", int(time.time()) + (3 * 86400)))
-
-        try:
-            db.execute("SELECT * FROM banlist").fetchall()
-        except sqlite3.OperationalError:
-            self.log.info("Table 'banlist' does not exist yet, creating.")
-            db.execute("CREATE TABLE banlist (address TEXT, type TEXT, note TEXT, origin TEXT, reserved TEXT DEFAULT '')")
-        try:
-            db.execute("SELECT reserved FROM banlist")
-        except sqlite3.OperationalError:
-            db.execute("ALTER TABLE banlist ADD COLUMN reserved TEXT DEFAULT ''")
 
-        try:
-            db.execute("SELECT * FROM mirrors")
-        except sqlite3.OperationalError:
-            self.log.info("Table 'mirrors' does not exist yet, creating.")
-            db.execute("CREATE TABLE mirrors (name TEXT, address TEXT, lifesign INTEGER DEFAULT 0)")
-            try:
-                master_fqdn = "list.jj2.plus"
-                master = socket.gethostbyname(master_fqdn)
-                if master != self.address:  # don't add if *this* server has that hostname
-                    self.log.info("Adding %s as mirror" % master_fqdn)
-                    db.execute("INSERT INTO mirrors (name, address) VALUES (?, ?)", (master_fqdn, master))
-            except socket.gaierror:
-                self.log.error("Could not retrieve IP for %s - no master list server available!" % master_fqdn)
+        new = not helpers.schema.columns(dbconn, "mirrors")
+        helpers.schema.migrate(dbconn, self)
 
         # if this method is run, it means the list server is restarted, which breaks all open connections, so clear all
-        # servers and such - banlist will be synced upon restart
-        db.execute("DELETE FROM banlist WHERE origin != ?", (self.address, ))
-        db.execute("DELETE FROM servers")
+        # servers and such - banlist will be synced upon restart, unless it is still as it was when the state was saved.
+        # servers is emptied anyway, so no harm in recreating the table (just in case any columns were added/changed)
+        warm = state is not None and helpers.warmstart.matches(state, dbconn, self.address)
+        dbconn.execute("BEGIN")
+        helpers.schema.create_servers(dbconn)
+        if not warm:
+            dbconn.execute("DELETE FROM banlist WHERE origin != ?", (self.address, ))
+        dbconn.execute("COMMIT")
 
-        result = dbconn.commit()
-
-        db.close()
         dbconn.close()
 
-        return result
+        return new, warm
 
     def reload(self, mode=1):
         """
@@ -315,8 +444,13 @@ class listserver:
             self.log.warning("Reloading modules...")
             importlib.reload(helpers.servernet)
             importlib.reload(helpers.functions)
-            importlib.reload(helpers.listener)
             importlib.reload(helpers.jj2)
+            importlib.reload(helpers.handler)
+
+            # port listeners import the handlers when they are loaded, so those need to be reloaded first
+            for module in sorted([module for module in sys.modules if module.startswith("handlers.")]):
+                importlib.reload(sys.modules[module])
+            importlib.reload(helpers.listener)
             self.reboot_mode = "restart"
             self.halt()
         elif mode == 3:
@@ -327,6 +461,36 @@ class listserver:
             self.log.warning("Reloading configuration...")
             importlib.reload(config)
 
+    def save_state(self):
+        """
+        Save state to disk, see helpers.warmstart
+
+        :return: Nothing
+        """
+        try:
+            helpers.warmstart.save(config.STATE_FILE, self)
+        except OSError as e:
+            self.log.error("Could not save state to %s: %s" % (config.STATE_FILE, e))
+
+    def restore_servers(self, servers):
+        """
+        Put back the records of servers from before restarting
+
+        I.e. servers whose connections were handed over, or servers listed on mirrors (see helpers.warmstart). The
+        servers table is recreated on startup, so only columns that still exist are restored.
+
+        :param servers: List of server records
+        :return: Nothing
+        """
+        columns = helpers.jj2.server_columns()
+        with helpers.functions.transaction() as db:
+            for server in servers:
+                fields = [field for field in server if field in columns]
+                db.execute("INSERT OR REPLACE INTO servers (%s) VALUES (%s)" % (
+                    ", ".join(fields), ", ".join(["?"] * len(fields))), [server[field] for field in fields])
+
+        helpers.snapshot.changed()
+
     def bridge(self):
         """
         Mirror server data from another list
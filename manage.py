@@ -3,22 +3,30 @@ Barebones management script for list servers
 
 Allows giving API commands via a command-line interface, requires the SSL config options to be set and valid
 """
+import collections
 import socket
 import config
+import shlex
 import json
 import time
+import zlib
 import sys
 import ssl
 
+from helpers.servernet import SESSION_MAGIC, FRAME_HEADER
 
-def send(action, payload):
+COMMANDS = ["ban", "unban", "whitelist", "unwhitelist", "add-banlist", "delete-banlist", "add-mirror", "delete-mirror",
+            "set-motd", "reload", "request-log-from", "send-log", "profile-start", "profile-dump", "get-servers",
+            "get-banlist", "import-banlist", "export-banlist"]
+PIPELINE = 32  # commands sent ahead of the responses in batch mode
+
+
+def connect():
     """
-    Send message to server
+    Connect to the API
 
     Always tries to connect to localhost on port 10059, since that's where the API will be listening
-    :param action: API action, string
-    :param payload: API payload, dictionary
-    :return: API response, or timeout message in case of timeout
+    :return: SSL socket
     """
     connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     connection.settimeout(5)
@@ -26,24 +34,330 @@ def send(action, payload):
                                cert_reqs=ssl.CERT_NONE, server_side=False)
     ssl_sock.connect(("localhost", 10059))
 
+    return ssl_sock
+
+
+def decode(response, payload):
+    """
+    Decode an API response
+
+    :param response: Response, bytes
+    :param payload: API payload the response is for, to check whether it was asked to be compressed
+    :return: Response, string
+    """
+    if isinstance(payload, dict) and payload.get("compress") == "zlib" and response:
+        try:
+            response = zlib.decompress(response)
+        except zlib.error:
+            pass  # not compressed after all, e.g. an error message
+
+    return bytes(response).decode("ascii", "ignore")
+
+
+def send(action, payload):
+    """
+    Send message to server
+
+    :param action: API action, string
+    :param payload: API payload, dictionary
+    :return: API response, or timeout message in case of timeout
+    """
+    ssl_sock = connect()
+
     msg = json.dumps({"action": action, "data": [payload], "origin": "web"})
     ssl_sock.sendall(msg.encode("ascii", "ignore"))
 
+    # some responses (e.g. profiling results) don't fit in one packet, so read until the server hangs up
+    response = bytearray()
     try:
-        response = ssl_sock.recv(2048)
-        response = response.decode("ascii", "ignore")
+        while True:
+            chunk = ssl_sock.recv(2048)
+            if not chunk:
+                break
+            response.extend(chunk)
     except (socket.timeout, TimeoutError):
-        response = "(Connection timed out)"
+        if not response:
+            response = b"(Connection timed out)"
 
-    ssl_sock.shutdown(socket.SHUT_RDWR)
+    response = decode(response, payload)
+
+    try:
+        ssl_sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass  # server already hung up
     ssl_sock.close()
 
     return response
 
 
-if len(sys.argv) < 2 or sys.argv[1] not in ["ban", "unban", "whitelist", "unwhitelist", "add-banlist", "delete-banlist",
-                                            "add-mirror", "delete-mirror", "set-motd", "reload", "request-log-from",
-                                            "send-log"]:
+class session:
+    """
+    Admin session: many commands over one connection
+
+    Commands are sent as length-prefixed frames, and each response is read until the empty frame that ends it, see
+    servernet_handler.session(). Commands may be sent before the responses to earlier commands have been read;
+    responses arrive in the same order.
+    """
+
+    def __init__(self):
+        """
+        Connect and start session
+        """
+        self.connection = connect()
+        self.connection.settimeout(None)  # responses may take a while, e.g. for big lists
+        self.connection.sendall(SESSION_MAGIC)
+        self.buffer = bytearray()
+        self.pending = collections.deque()  # payloads of commands sent, for which the response has not been read yet
+
+    def send(self, action, payload):
+        """
+        Send command, without waiting for the response
+
+        :param action: API action, string
+        :param payload: API payload, dictionary
+        :return: Nothing
+        """
+        msg = json.dumps({"action": action, "data": [payload], "origin": "web"}).encode("ascii", "ignore")
+        self.connection.sendall(FRAME_HEADER.pack(len(msg)) + msg)
+        self.pending.append(payload)
+
+    def receive(self):
+        """
+        Read the response to the oldest command that has not been responded to yet
+
+        :return: API response, string
+        """
+        payload = self.pending.popleft()
+        response = bytearray()
+
+        while True:
+            while len(self.buffer) < FRAME_HEADER.size or \
+                    len(self.buffer) < FRAME_HEADER.size + FRAME_HEADER.unpack(self.buffer[:FRAME_HEADER.size])[0]:
+                chunk = self.connection.recv(65536)
+                if not chunk:
+                    raise ConnectionError("Connection closed by list server")
+                self.buffer.extend(chunk)
+
+            length = FRAME_HEADER.unpack(self.buffer[:FRAME_HEADER.size])[0]
+            response.extend(self.buffer[FRAME_HEADER.size:FRAME_HEADER.size + length])
+            del self.buffer[:FRAME_HEADER.size + length]
+
+            if length == 0:
+                return decode(response, payload)
+
+    def close(self):
+        """
+        End session
+
+        :return: Nothing
+        """
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass  # server already hung up
+        self.connection.close()
+
+
+def command(arguments):
+    """
+    Turn command-line arguments into an API call
+
+    :param arguments: Command and its arguments, e.g. ["ban", "127.0.0.1"]
+    :return: Tuple: API action, API payload. Raises ValueError with the correct syntax if the arguments are invalid
+    """
+    action = arguments[0]
+    if action in ["ban", "unban", "whitelist", "unwhitelist"]:
+        if len(arguments) != 2:
+            raise ValueError("%s [IP]" % action)
+
+        bantype = "whitelist" if "whitelist" in action else "ban"
+        action = "delete-banlist" if action.startswith("un") else "add-banlist"
+        payload = {"address": arguments[1], "note": "(added via CLI)", "type": bantype, "reserved": ""}
+
+    elif action in ["add-banlist", "delete-banlist"]:
+        if len(arguments) != 4:
+            raise ValueError("%s [IP] [ban/whitelist] [origin]" % action)
+
+        payload = {"address": arguments[1], "type": arguments[2], "origin": arguments[3], "note": "(added via CLI)",
+                   "reserved": ""}
+
+    elif action in ["add-mirror"]:
+        if len(arguments) != 3:
+            raise ValueError("%s [name] [IP]" % action)
+
+        try:
+            payload = {"name": arguments[1], "address": socket.gethostbyname(arguments[2])}
+        except socket.gaierror:
+            raise ValueError("%s [name] [IP] (could not retrieve IP address for %s)" % (action, arguments[2]))
+
+    elif action in ["delete-mirror"]:
+        if len(arguments) != 3:
+            raise ValueError("%s [name] [IP]" % action)
+
+        payload = {"name": arguments[1], "address": arguments[2]}
+
+    elif action == "set-motd":
+        if len(arguments) < 2:
+            raise ValueError("set-motd [text]")
+
+        payload = {"motd": " ".join(arguments[1:]), "motd-updated": int(time.time())}
+
+    elif action == "reload":
+        payload = {"from": "cli"}
+
+    elif action == "request-log-from":
+        if len(arguments) < 2:
+            raise ValueError("request-log-from [mirror IP]")
+
+        payload = {"from": arguments[1]}
+
+    elif action == "profile-start":
+        payload = {"mode": arguments[1] if len(arguments) > 1 else "timing"}
+        try:
+            if len(arguments) > 2:
+                payload["seconds"] = int(arguments[2])
+            if len(arguments) > 3:
+                payload["sample"] = float(arguments[3])
+        except ValueError:
+            raise ValueError("profile-start [timing/cprofile/tracemalloc] [seconds] [sample rate]")
+
+    elif action in ["get-servers", "get-banlist"]:
+        try:
+            payload = dict([argument.split("=", 1) for argument in arguments[1:]])
+        except ValueError:
+            raise ValueError("%s [filter=value ...]" % action)
+
+    elif action == "import-banlist":
+        if len(arguments) not in (2, 3):
+            raise ValueError("import-banlist [file] [csv/jsonl]")
+
+        format = arguments[2] if len(arguments) > 2 else ("jsonl" if arguments[1].endswith(".jsonl") else "csv")
+        try:
+            with open(arguments[1]) as input_file:
+                payload = {"format": format, "entries": input_file.read()}
+        except OSError as e:
+            raise ValueError("import-banlist [file] [csv/jsonl] (could not read %s: %s)" % (arguments[1], e))
+
+    elif action == "export-banlist":
+        try:
+            payload = dict([argument.split("=", 1) for argument in arguments[1:] if "=" in argument])
+        except ValueError:
+            raise ValueError("export-banlist [csv/jsonl] [filter=value ...]")
+        payload["format"] = "jsonl" if "jsonl" in arguments[1:] else "csv"
+
+    else:
+        # profile-dump, send-log
+        payload = {}
+
+    return action, payload
+
+
+def show(result):
+    """
+    Print API response
+
+    :param result: API response
+    :return: Nothing
+    """
+    if result == "ACK":
+        print("Command successful.")
+    else:
+        print("Response: %s" % result)
+
+
+def batch(lines):
+    """
+    Run commands from a file, one per line, over one admin session
+
+    Empty lines and lines starting with # are skipped. Up to PIPELINE commands are sent ahead of reading responses,
+    so the list server always has the next command ready.
+
+    :param lines: Lines to run
+    :return: Nothing
+    """
+    connection = session()
+    commands = []
+
+    for number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+
+        try:
+            arguments = shlex.split(line)
+            if arguments[0] not in COMMANDS:
+                raise ValueError("unknown command %s" % arguments[0])
+            commands.append((number, line) + command(arguments))
+        except ValueError as e:
+            print("Line %i: %s" % (number, e))
+
+    sent = 0
+    for number, line, action, payload in commands:
+        while len(connection.pending) >= PIPELINE:
+            show_line(commands[sent - len(connection.pending)], connection.receive())
+        connection.send(action, payload)
+        sent += 1
+
+    while connection.pending:
+        show_line(commands[sent - len(connection.pending)], connection.receive())
+
+    connection.close()
+    print("%i command(s) sent." % len(commands))
+
+
+def show_line(command, result):
+    """
+    Print the response to a command from a batch file
+
+    :param command: Tuple: line number, line, action, payload
+    :param result: API response
+    :return: Nothing
+    """
+    if result and result != "ACK":
+        print("Line %i (%s): %s" % (command[0], command[1], result))
+
+
+def shell():
+    """
+    Interactive admin session
+
+    :return: Nothing
+    """
+    connection = session()
+    print("Connected. Enter commands as on the command line, e.g. 'ban 127.0.0.1'; 'quit' to exit.")
+
+    while True:
+        try:
+            line = input("j2lsnek> ").strip()
+        except (EOFError, KeyboardInterrupt):
+            print("")
+            break
+
+        if line in ["quit", "exit"]:
+            break
+        elif not line:
+            continue
+
+        try:
+            arguments = shlex.split(line)
+            if arguments[0] not in COMMANDS:
+                raise ValueError("%s (commands: %s)" % (arguments[0], ", ".join(COMMANDS)))
+            action, payload = command(arguments)
+        except ValueError as e:
+            print("Syntax:\n %s" % e)
+            continue
+
+        connection.send(action, payload)
+        try:
+            show(connection.receive())
+        except (ConnectionError, OSError) as e:
+            print("Session ended: %s" % e)
+            return
+
+    connection.close()
+
+
+if len(sys.argv) < 2 or sys.argv[1] not in COMMANDS + ["shell", "batch"]:
     print(" Syntax: python3 manage.py [command] [arguments]\n")
     print(" Shorthand commands:")
     print("  ban [IP] (bans globally)")
@@ -55,70 +369,58 @@ if len(sys.argv) < 2 or sys.argv[1] not in ["ban", "unban", "whitelist", "unwhit
     print(" Advanced commands:")
     print("  add-banlist [IP] [ban/whitelist] [origin]")
     print("  delete-banlist [IP] [ban/whitelist] [origin]")
-    print("  add-mirror [address]")
+    print("  add-mirror [name] [address]")
     print("  delete-mirror [name] [IP]")
-    print("  request-log")
+    print("  request-log-from [mirror IP]")
     print("  send-log [lines]")
     print("  reload")
+    print("  profile-start [timing/cprofile/tracemalloc] [seconds] [sample rate]")
+    print("  profile-dump")
+    print("  get-servers [filter=value ...] (filters: origin, mode, version, players, address, limit, cursor, format, compress)")
+    print("  get-banlist [filter=value ...] (filters: origin, type, address, limit, cursor, format, compress)")
+    print("  import-banlist [file] [csv/jsonl] (columns: address, type, note, origin, reserved)")
+    print("  export-banlist [csv/jsonl] [filter=value ...] (filters: origin, type, address)")
+    print("")
+    print(" Sessions (many commands over one connection):")
+    print("  shell (enter commands interactively)")
+    print("  batch [file] (run the commands in a file, one per line)")
     sys.exit()
 
-action = sys.argv[1]
-if sys.argv[1] in ["ban", "unban", "whitelist", "unwhitelist"]:
-    action = \
-        {"ban": "add-banlist", "unban": "delete-banlist", "whitelist": "add-banlist",
-         "unwhitelist": "delete-whitelist"}[action]
-    bantype = "ban" if action.split("-")[1] == "banlist" else "whitelist"
-    if len(sys.argv) != 3:
-        print("Syntax:\n %s [IP]" % sys.argv[1])
-        sys.exit()
-
-    payload = {"address": sys.argv[2], "note": "(added via CLI)", "type": bantype}
+if sys.argv[1] == "shell":
+    shell()
+    sys.exit()
 
-elif sys.argv[1] in ["add-banlist", "delete-banlist"]:
+if sys.argv[1] == "batch":
     if len(sys.argv) != 3:
-        print("Syntax:\n %s [IP] [ban/whitelist] [origin]" % sys.argv[1])
-        sys.exit()
-
-    payload = {"address": sys.argv[2], "type": sys.argv[3], "origin": sys.argv[4]}
-
-elif sys.argv[1] in ["add-mirror"]:
-    if len(sys.argv) != 4:
-        print("Syntax:\n %s [name] [IP]" % sys.argv[1])
+        print("Syntax:\n batch [file]")
         sys.exit()
 
     try:
-        payload = {"name": sys.argv[2], "address": socket.gethostbyname(sys.argv[3])}
-    except socket.gaierror:
-        print("Could not retrieve IP address for name %s" % sys.argv[2])
-        sys.exit()
-
-elif sys.argv[1] in ["delete-mirror"]:
-    if len(sys.argv) != 4:
-        print("Syntax:\n %s [name] [IP]" % sys.argv[1])
-        sys.exit()
-
-    payload = {"name": sys.argv[2], "address": sys.argv[3]}
-
-elif sys.argv[1] == "set-motd":
-    if len(sys.argv) < 3:
-        print("Syntax:\n set-motd [text]")
+        with open(sys.argv[2]) as input_file:
+            lines = input_file.readlines()
+    except OSError as e:
+        print("Could not read %s: %s" % (sys.argv[2], e))
         sys.exit()
 
-    payload = {"motd": " ".join(sys.argv[2:]), "motd-updated": int(time.time())}
-
-elif sys.argv[1] == "reload":
-    payload = {"from": "cli"}
-
-elif sys.argv[1] == "request-log-from":
-    if len(sys.argv) < 3:
-        print("Syntax:\n request-log-from [mirror IP]")
-
-    payload = {"from": sys.argv[2]}
-
+    try:
+        batch(lines)
+    except (ConnectionError, OSError) as e:
+        print("Session ended: %s" % e)
+    sys.exit()
 
-result = send(action, payload)
+try:
+    action, payload = command(sys.argv[1:])
+except ValueError as e:
+    print("Syntax:\n %s" % e)
+    sys.exit()
 
-if result == "ACK":
-    print("Command successful.")
+if action == "import-banlist":
+    # imports can be bigger than the list server accepts as a single message, but not as a session command
+    connection = session()
+    connection.send(action, payload)
+    show(connection.receive())
+    connection.close()
+elif action == "export-banlist":
+    print(send(action, payload), end="")
 else:
-    print("Response: %s" % result)
+    show(send(action, payload))